@@ -659,6 +659,9 @@ def load_filtered_data(data_dir="./data", min_cooccur=3, decay_rate=0.005):
     # Build the PyG Data object, including edge weights
     data = Data(x=all_features, edge_index=edge_index, edge_attr=edge_weight)
     
+    # Pack interactions into CSR arrays for vectorized sampling
+    user_indptr, user_indices = build_user_item_csr(user_to_items, num_customers)
+    
     # Create metadata dictionary
     meta = {
         "num_customers": num_customers,
@@ -668,6 +671,8 @@ def load_filtered_data(data_dir="./data", min_cooccur=3, decay_rate=0.005):
         "reverse_customer_map": {v: k for k, v in customer_id_map.items()},
         "reverse_article_map": {v: k for k, v in article_id_map.items()},
         "user_to_items": user_to_items,
+        "user_indptr": user_indptr,
+        "user_indices": user_indices,
         "news_categories": news_categories,
         "product_types": product_types,
         "feature_dim": feat_dim
@@ -902,6 +907,33 @@ def create_train_test_split(data, meta, test_ratio=0.2, by_time=True):
     
     return train_user_items, test_user_items
 
+def build_user_item_csr(user_items, num_users):
+    """
+    Pack a user -> items mapping into CSR arrays.
+    
+    Args:
+        user_items (dict): Mapping from user index to an iterable of item indices
+        num_users (int): Number of users
+    
+    Returns:
+        np.ndarray, np.ndarray: Row offsets (int64, length num_users + 1) and
+                                item indices (int32, sorted and unique per user)
+    """
+    rows = {u_idx: np.unique(np.fromiter(items, dtype=np.int32)) for u_idx, items in user_items.items()}
+    
+    counts = np.zeros(num_users, dtype=np.int64)
+    for u_idx, items in rows.items():
+        counts[u_idx] = len(items)
+    
+    indptr = np.zeros(num_users + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    for u_idx, items in rows.items():
+        indices[indptr[u_idx]:indptr[u_idx + 1]] = items
+    
+    return indptr, indices
+
 if __name__ == "__main__":
     import argparse
     import pickle
@@ -971,14 +1003,17 @@ if __name__ == "__main__":
     
     # Save metadata with train/test split
     meta_with_split = meta.copy()
+    train_indptr, train_indices = build_user_item_csr(train_user_items, meta["num_customers"])
     meta_with_split.update({
         "train_user_items": train_user_items,
         "test_user_items": test_user_items,
+        "train_indptr": train_indptr,
+        "train_indices": train_indices,
         "data_dir": args.data_dir
     })
     
     with open(os.path.join(args.output_dir, "lightgcn_meta.pkl"), "wb") as f:
-        pickle.dump(meta_with_split, f)
+        pickle.dump(meta_with_split, f, protocol=pickle.HIGHEST_PROTOCOL)
     print(f"Saved metadata to {os.path.join(args.output_dir, 'lightgcn_meta.pkl')}")
     
     # Save ID mappings separately
@@ -989,7 +1024,7 @@ if __name__ == "__main__":
         "reverse_article_map": meta["reverse_article_map"]
     }
     with open(os.path.join(args.output_dir, "id_mappings.pkl"), "wb") as f:
-        pickle.dump(mappings, f)
+        pickle.dump(mappings, f, protocol=pickle.HIGHEST_PROTOCOL)
     print(f"Saved ID mappings to {os.path.join(args.output_dir, 'id_mappings.pkl')}")
     
     # Print data statistics
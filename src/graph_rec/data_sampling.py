@@ -6,11 +6,11 @@ their associated information from the customers and transactions files.
 """
 
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import numpy as np
 import os
-import random
 from datetime import datetime
-random.seed(42)  # For reproducibility
 
 def sample_dataset(
     customers_path="../input/h-and-m-personalized-fashion-recommendations/customers.csv",
@@ -32,7 +32,7 @@ def sample_dataset(
     print(f"Loading original datasets...")
     
     # Load customers dataset
-    customers_df = pd.read_csv(customers_path)
+    customers_df = pd.read_csv(customers_path, engine="pyarrow")
     print(f"Loaded {len(customers_df)} customers")
     
     # Sample random customers
@@ -43,19 +43,21 @@ def sample_dataset(
         sample_size = len(all_customer_ids)
         print(f"Sample size reduced to {sample_size} (total available customers)")
     
-    sampled_customer_ids = random.sample(list(all_customer_ids), sample_size)
+    rng = np.random.default_rng(42)  # For reproducibility
+    sampled_customer_ids = rng.choice(all_customer_ids, size=sample_size, replace=False)
     print(f"Sampled {len(sampled_customer_ids)} unique customers")
     
-    # Filter customers dataframe
+    # Filter customers dataframe (customer_id is unique per row here, so a plain hashed isin
+    # is already one lookup per customer; the large transactions filter runs inside the Arrow scan)
     sampled_customers_df = customers_df[customers_df['customer_id'].isin(sampled_customer_ids)]
     print(f"Sampled customers dataframe shape: {sampled_customers_df.shape}")
     
-    # Load and filter transactions
+    # Load and filter transactions, pushing the customer filter down into the CSV scan
     print(f"Loading transactions data...")
-    transactions_df = pd.read_csv(transactions_path)
-    print(f"Loaded {len(transactions_df)} transactions")
-    
-    sampled_transactions_df = transactions_df[transactions_df['customer_id'].isin(sampled_customer_ids)]
+    transactions_table = ds.dataset(transactions_path, format="csv").to_table(
+        filter=pc.field('customer_id').isin(list(sampled_customer_ids))
+    )
+    sampled_transactions_df = transactions_table.to_pandas()
     print(f"Sampled transactions dataframe shape: {sampled_transactions_df.shape}")
     
     # Get all unique article IDs from the sampled transactions
@@ -64,7 +66,7 @@ def sample_dataset(
     
     # Load and filter articles
     print(f"Loading articles data...")
-    articles_df = pd.read_csv(articles_path)
+    articles_df = pd.read_csv(articles_path, engine="pyarrow")
     print(f"Loaded {len(articles_df)} articles")
     
     sampled_articles_df = articles_df[articles_df['article_id'].isin(sampled_article_ids)]
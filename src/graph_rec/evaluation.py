@@ -5,6 +5,7 @@ Evaluation metrics and routines to assess recommendation performance.
 """
 
 import math
+import numpy as np
 import torch
 
 def recall_at_k(recommended, ground_truth, k):
@@ -66,20 +67,30 @@ def diversity_at_k(recommended, item_categories, k):
 def evaluate_model(model, data, meta, test_user_items, top_k=10):
     num_users = meta["num_customers"]
     model.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         all_emb = model(data.edge_index, data.edge_attr)
-    user_embs = all_emb[:num_users]
-    item_embs = all_emb[num_users:]
+        user_embs = all_emb[:num_users]
+        item_embs = all_emb[num_users:]
+        
+        # Score all test users with one GEMM and one batched topk; a single device sync follows
+        test_users = torch.tensor(list(test_user_items.keys()), dtype=torch.long, device=user_embs.device)
+        scores = user_embs[test_users] @ item_embs.t()
+        topk_idx = torch.topk(scores, top_k, dim=1).indices
+    topk_idx = topk_idx.cpu().numpy()
+    
+    # Ground-truth mask over the item space, reused across users; hits come from one gather
+    gt_arr = np.zeros(item_embs.shape[0], dtype=bool)
+    discounts = 1.0 / np.log2(np.arange(2, top_k + 2))
     
     recalls = []
     ndcgs = []
-    for u, true_items in test_user_items.items():
-        u_emb = user_embs[u].unsqueeze(0)
-        scores = torch.matmul(u_emb, item_embs.t()).squeeze(0)
-        _, topk_idx = torch.topk(scores, top_k)
-        recommended = topk_idx.cpu().tolist()
-        recalls.append(recall_at_k(recommended, true_items, top_k))
-        ndcgs.append(ndcg_at_k(recommended, true_items, top_k))
+    for true_items, recommended in zip(test_user_items.values(), topk_idx):
+        true_idx = np.fromiter(true_items, dtype=np.int64, count=len(true_items))
+        gt_arr[true_idx] = True
+        hits = gt_arr[recommended]
+        gt_arr[true_idx] = False
+        recalls.append(float(hits.sum()) / len(true_items) if len(true_items) else 0)
+        ndcgs.append(float((hits * discounts[:len(hits)]).sum()))
     
     avg_recall = sum(recalls) / len(recalls) if recalls else 0
     avg_ndcg = sum(ndcgs) / len(ndcgs) if ndcgs else 0
@@ -13,17 +13,422 @@ The script also includes functions to explain recommendations based on:
 """
 
 import os
+import json
+import hashlib
 import torch
 import pickle
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import argparse
 from collections import defaultdict
+from contextlib import nullcontext
 from tqdm import tqdm
 
+try:
+    from numba import njit, prange
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
 # Import our modules
 from model import LightGCN
 from modified_data_loader import load_filtered_data
+from data_loader import build_user_item_csr
+
+# Allow TF32 tensor-core matmuls for the fp32 scoring GEMMs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
+
+def score_matmul(query_embeddings, keys_t):
+    """
+    Dot-product scores query @ keys_t (keys_t has shape [d, num_keys]), computed under
+    reduced-precision autocast on GPU.
+    
+    Returns fp32 scores so masking and top-k behave as before.
+    """
+    device = query_embeddings.device
+    if device.type == "cuda":
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        ctx = torch.autocast(device_type="cuda", dtype=dtype)
+    else:
+        ctx = nullcontext()
+    with ctx:
+        scores = torch.matmul(query_embeddings, keys_t)
+    return scores.float()
+
+def _embeddings_key(args, data, model_path):
+    """
+    Key identifying the trained weights and graph an embedding cache was computed from.
+    
+    The graph is identified by its data directory and a digest of its edges, so a rebuilt
+    graph with the same number of edges still invalidates the cache.
+    """
+    stat = os.stat(model_path)
+    graph_digest = hashlib.blake2b(data.edge_index.cpu().numpy().tobytes(), digest_size=16)
+    if getattr(data, "edge_attr", None) is not None:
+        graph_digest.update(data.edge_attr.cpu().numpy().tobytes())
+    return [stat.st_size, stat.st_mtime_ns, os.path.abspath(args.data_dir), graph_digest.hexdigest(),
+            args.embed_dim, args.num_layers]
+
+def load_cached_embeddings(cache_path, cache_key, device):
+    """
+    Memory-map embeddings saved by save_cached_embeddings if their key matches.
+    
+    Args:
+        cache_path: Path of the .npy embeddings file
+        cache_key: Expected key (see _embeddings_key)
+        device: Device to place the embeddings on
+        
+    Returns:
+        all_embeddings tensor, or None if there is no matching cache
+    """
+    key_path = os.path.splitext(cache_path)[0] + "_key.json"
+    if not (os.path.exists(cache_path) and os.path.exists(key_path)):
+        return None
+    with open(key_path, "r") as f:
+        if json.load(f) != cache_key:
+            return None
+    # Copy-on-write mapping: pages are read lazily and the file is never modified
+    all_embeddings = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+    if device.type == "cuda":
+        all_embeddings = all_embeddings.pin_memory().to(device, non_blocking=True)
+    print(f"Loaded cached embeddings from {cache_path}")
+    return all_embeddings
+
+def save_cached_embeddings(all_embeddings, cache_path, cache_key):
+    """Save embeddings as .npy with their key next to them."""
+    np.save(cache_path, all_embeddings.contiguous().cpu().numpy())
+    with open(os.path.splitext(cache_path)[0] + "_key.json", "w") as f:
+        json.dump(cache_key, f)
+
+def precompute_embeddings(model, data, cache_path=None, cache_key=None):
+    """
+    Run the propagation once and keep the result on the model.
+    
+    Args:
+        model: Trained LightGCN model
+        data: PyTorch Geometric data object
+        cache_path: Optional .npy file to load the embeddings from / save them to
+        cache_key: Key stored with the cached embeddings; a mismatching cache is recomputed
+        
+    Returns:
+        all_embeddings: Tensor of shape [num_nodes, embed_dim]
+    """
+    device = next(model.parameters()).device
+    cached = load_cached_embeddings(cache_path, cache_key, device) if cache_path else None
+    if cached is not None:
+        model._cached_emb = cached
+        return model._cached_emb
+    
+    with torch.inference_mode():
+        model._cached_emb = model(data.edge_index, data.edge_attr)
+    if cache_path:
+        save_cached_embeddings(model._cached_emb, cache_path, cache_key)
+    return model._cached_emb
+
+def _get_embeddings(model, data, all_embeddings=None):
+    """Return precomputed embeddings if available, otherwise run the propagation."""
+    if all_embeddings is None and model is not None:
+        all_embeddings = getattr(model, "_cached_emb", None)
+    if all_embeddings is None:
+        all_embeddings = precompute_embeddings(model, data)
+    return all_embeddings
+
+def reverse_id_array(meta, map_key):
+    """
+    Index -> ID lookup array for meta[map_key], built once and kept on meta.
+    
+    Args:
+        meta: Metadata dictionary
+        map_key: "reverse_article_map" or "reverse_customer_map"
+        
+    Returns:
+        np.ndarray indexed by node-local index (int64 for numeric IDs)
+    """
+    arr_key = map_key.replace("_map", "_arr")
+    if arr_key not in meta:
+        reverse_map = meta[map_key]
+        meta[arr_key] = np.asarray([reverse_map[i] for i in range(len(reverse_map))])
+    return meta[arr_key]
+
+def items_transposed_of(meta, all_embeddings):
+    """
+    Item block of all_embeddings materialized as a contiguous (d, num_items) matrix.
+    
+    Cached on meta and reused across calls and batches, so every scoring GEMM is
+    user_emb @ items_T with a non-transposed right-hand side.
+    """
+    cached = meta.get("items_T")
+    if cached is None or cached[0] is not all_embeddings:
+        num_users = meta["num_customers"]
+        items = all_embeddings.narrow(0, num_users, all_embeddings.size(0) - num_users)
+        meta["items_T"] = (all_embeddings, items.t().contiguous())
+    return meta["items_T"][1]
+
+def offload_items(meta, all_embeddings):
+    """
+    Keep the item block used for scoring in pinned host memory instead of on the GPU.
+    
+    The catalogue is stored row-major (num_items, d) so each item chunk is one contiguous
+    slice; chunked_topk streams it to the device while scoring. Returns the (d, num_items)
+    view that items_transposed_of hands out from then on.
+    """
+    num_users = meta["num_customers"]
+    items = all_embeddings.narrow(0, num_users, all_embeddings.size(0) - num_users)
+    items_host = torch.empty(items.shape, dtype=items.dtype, pin_memory=True)
+    items_host.copy_(items)
+    meta["items_T"] = (all_embeddings, items_host.t())
+    return meta["items_T"][1]
+
+def prepare_items(meta, all_embeddings, offload=False):
+    """Build the scoring item matrix once, on device or (offload on GPU) in pinned host memory."""
+    if offload and all_embeddings.device.type == "cuda":
+        return offload_items(meta, all_embeddings)
+    return items_transposed_of(meta, all_embeddings)
+
+def _streamed_item_chunks(items_t, device, chunk_size):
+    """
+    Yield (start, end, chunk) with chunk = items_t[:, start:end] on device, for a host items_t.
+    
+    Two device buffers are filled on a side stream with async copies from pinned memory,
+    so the copy of the next chunk overlaps the GEMM of the current one.
+    """
+    items_host = items_t.t()  # (num_items, d), contiguous
+    num_items, dim = items_host.shape
+    copy_stream = torch.cuda.Stream(device)
+    buffers = [torch.empty((chunk_size, dim), dtype=items_host.dtype, device=device) for _ in range(2)]
+    ready = [torch.cuda.Event(), torch.cuda.Event()]
+    
+    def issue(slot, start):
+        end = min(start + chunk_size, num_items)
+        with torch.cuda.stream(copy_stream):
+            # Do not overwrite a buffer the compute stream is still reading
+            copy_stream.wait_stream(torch.cuda.current_stream(device))
+            buffers[slot][:end - start].copy_(items_host[start:end], non_blocking=True)
+            ready[slot].record(copy_stream)
+    
+    starts = list(range(0, num_items, chunk_size))
+    issue(0, 0)
+    for step, start in enumerate(starts):
+        slot = step % 2
+        if step + 1 < len(starts):
+            issue(1 - slot, starts[step + 1])
+        torch.cuda.current_stream(device).wait_event(ready[slot])
+        end = min(start + chunk_size, num_items)
+        yield start, end, buffers[slot][:end - start].t()
+
+def purchased_csr(meta, device):
+    """
+    User -> purchased items as CSR tensors on device, built once and kept on meta.
+    
+    Args:
+        meta: Metadata dictionary
+        device: Device for the CSR tensors
+        
+    Returns:
+        indptr (int64, length num_users + 1), indices (int32)
+    """
+    cached = meta.get("purchased_csr")
+    if cached is None or cached[0].device.type != torch.device(device).type:
+        if "user_indptr" in meta:
+            indptr, indices = meta["user_indptr"], meta["user_indices"]
+        else:
+            indptr, indices = build_user_item_csr(meta.get("user_to_items", {}), meta["num_customers"])
+        meta["purchased_csr"] = (torch.from_numpy(indptr).to(device), torch.from_numpy(indices).to(device))
+    return meta["purchased_csr"]
+
+def purchased_index(meta, user_indices, device):
+    """
+    Flat (row, item) index of the purchases of a batch of users.
+    
+    Args:
+        meta: Metadata dictionary
+        user_indices: Sequence or tensor of user indices, one per row
+        device: Device for the returned tensors
+        
+    Returns:
+        rows, cols: LongTensors usable with index_put_ on a (len(user_indices), num_items) matrix
+    """
+    indptr, indices = purchased_csr(meta, device)
+    users = torch.as_tensor(user_indices, dtype=torch.long, device=device)
+    starts = indptr[users]
+    lengths = indptr[users + 1] - starts
+    total = int(lengths.sum())
+    rows = torch.repeat_interleave(torch.arange(len(users), device=device), lengths, output_size=total)
+    # Position of every purchase inside its user's CSR row
+    row_offsets = torch.cumsum(lengths, 0) - lengths
+    within = torch.arange(total, device=device) - torch.repeat_interleave(row_offsets, lengths, output_size=total)
+    cols = indices[torch.repeat_interleave(starts, lengths, output_size=total) + within].long()
+    return rows, cols
+
+def chunked_topk(user_embeddings, items_t, k, mask_index=None, chunk_size=65536):
+    """
+    Top-k items per user without materializing the full (num_users, num_items) score matrix.
+    
+    Scores are computed one item chunk at a time and merged into a running top-k,
+    so peak memory is (batch, chunk_size) instead of (batch, num_items).
+    
+    Args:
+        user_embeddings: Tensor of shape [B, d]
+        items_t: Tensor of shape [d, num_items]
+        k: Number of items to keep per user
+        mask_index: Optional (rows, cols) of items to exclude, as returned by purchased_index
+        chunk_size: Number of items scored per GEMM
+        
+    Returns:
+        values, indices: Tensors of shape [B, k], sorted by descending score
+    """
+    num_items = items_t.size(1)
+    k = min(k, num_items)
+    if items_t.device != user_embeddings.device:
+        # Items offloaded to pinned host memory are streamed in chunk by chunk
+        chunks = _streamed_item_chunks(items_t, user_embeddings.device, chunk_size)
+    else:
+        chunks = ((start, min(start + chunk_size, num_items), items_t[:, start:start + chunk_size])
+                  for start in range(0, num_items, chunk_size))
+    top_vals, top_idx = None, None
+    for start, end, items_chunk in chunks:
+        part = score_matmul(user_embeddings, items_chunk)
+        if mask_index is not None:
+            rows, cols = mask_index
+            in_chunk = (cols >= start) & (cols < end)
+            part.index_put_((rows[in_chunk], cols[in_chunk] - start), torch.tensor(-float('inf'), device=part.device))
+        # Selection only; the k survivors are sorted once at the end
+        vals, idx = torch.topk(part, k=min(k, end - start), dim=1, sorted=False)
+        idx += start
+        if top_vals is not None:
+            vals = torch.cat([top_vals, vals], dim=1)
+            idx = torch.cat([top_idx, idx], dim=1)
+            vals, pos = torch.topk(vals, k=k, dim=1, sorted=False)
+            idx = torch.gather(idx, 1, pos)
+        top_vals, top_idx = vals, idx
+    return sort_topk(top_vals, top_idx)
+
+if _NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def topk_with_mask(scores, users, indptr, cols, offset, out_idx, out_val, filled):
+        """
+        Merge one item chunk of scores into a running per-user top-k, in parallel over users.
+        
+        Each row of out_val/out_idx is a min-heap of the best items seen so far. Purchased
+        items (the CSR row of the user) that fall inside the chunk are skipped.
+        
+        Args:
+            scores: float32 array of shape [B, C], scores of items offset..offset+C-1
+            users: int64 array of shape [B], user index of every row
+            indptr, cols: user -> purchased items CSR
+            offset: Item index of the first column of scores
+            out_idx, out_val: Arrays of shape [B, k] holding the heaps, updated in place
+            filled: int64 array of shape [B], number of heap entries in use per row
+        """
+        num_rows, num_cols = scores.shape
+        k = out_idx.shape[1]
+        for r in prange(num_rows):
+            row = scores[r]
+            u = users[r]
+            for p in range(indptr[u], indptr[u + 1]):
+                c = cols[p] - offset
+                if 0 <= c < num_cols:
+                    row[c] = -np.inf
+            vals = out_val[r]
+            idx = out_idx[r]
+            for j in range(num_cols):
+                v = row[j]
+                if filled[r] < k:
+                    # Heap not full yet: append and sift up
+                    pos = filled[r]
+                    filled[r] += 1
+                    while pos > 0:
+                        parent = (pos - 1) // 2
+                        if vals[parent] <= v:
+                            break
+                        vals[pos] = vals[parent]
+                        idx[pos] = idx[parent]
+                        pos = parent
+                    vals[pos] = v
+                    idx[pos] = j + offset
+                elif v > vals[0]:
+                    # Replace the smallest kept score and sift down
+                    pos = 0
+                    while True:
+                        child = 2 * pos + 1
+                        if child >= k:
+                            break
+                        if child + 1 < k and vals[child + 1] < vals[child]:
+                            child += 1
+                        if vals[child] >= v:
+                            break
+                        vals[pos] = vals[child]
+                        idx[pos] = idx[child]
+                        pos = child
+                    vals[pos] = v
+                    idx[pos] = j + offset
+
+def chunked_topk_numba(user_embeddings, items_t, k, users, indptr, cols, chunk_size=65536):
+    """
+    CPU counterpart of chunked_topk that masks purchases and keeps the top-k in a Numba kernel.
+    
+    Args:
+        user_embeddings: CPU tensor of shape [B, d]
+        items_t: CPU tensor of shape [d, num_items]
+        k: Number of items to keep per user
+        users: int64 array of shape [B] with the user index of every row
+        indptr, cols: User -> purchased items CSR as numpy arrays
+        chunk_size: Number of items scored per GEMM
+        
+    Returns:
+        values, indices: Arrays of shape [B, k], sorted by descending score
+    """
+    num_items = items_t.size(1)
+    k = min(k, num_items)
+    out_idx = np.empty((len(users), k), dtype=np.int64)
+    out_val = np.empty((len(users), k), dtype=np.float32)
+    filled = np.zeros(len(users), dtype=np.int64)
+    for start in range(0, num_items, chunk_size):
+        end = min(start + chunk_size, num_items)
+        part = score_matmul(user_embeddings, items_t[:, start:end]).numpy()
+        topk_with_mask(part, users, indptr, cols, start, out_idx, out_val, filled)
+    order = np.argsort(-out_val, axis=1, kind="stable")
+    return np.take_along_axis(out_val, order, 1), np.take_along_axis(out_idx, order, 1)
+
+def _masked_topk(user_embedding, items_t, mask, k, dtype):
+    """
+    Scores of one user against all items under autocast, masked and reduced to the top-k.
+    
+    All inputs have fixed shapes for a given catalogue, so the compiled version is
+    captured once and replayed for every query.
+    """
+    with torch.autocast(device_type=user_embedding.device.type, dtype=dtype):
+        scores = torch.matmul(user_embedding, items_t)
+    scores = scores.float().squeeze(0).masked_fill(mask, -float('inf'))
+    return torch.topk(scores, k=k)
+
+_compiled_masked_topk = None
+
+def compiled_masked_topk(user_embedding, items_t, mask, k):
+    """
+    _masked_topk compiled with CUDA graphs, built on first use.
+    
+    Single-user queries are dominated by kernel launch overhead; replaying one captured
+    graph for the GEMM, masking and top-k removes it.
+    """
+    global _compiled_masked_topk
+    if _compiled_masked_topk is None:
+        _compiled_masked_topk = torch.compile(_masked_topk, mode="reduce-overhead", fullgraph=True, dynamic=False)
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return _compiled_masked_topk(user_embedding, items_t, mask, k, dtype)
+
+def sort_topk(values, indices):
+    """
+    Sort an unsorted top-k selection (e.g. from topk(sorted=False)) by descending score.
+    
+    Only the k selected entries per row are sorted, instead of ordering all N scores.
+    """
+    values, order = torch.sort(values, dim=-1, descending=True)
+    return values, torch.gather(indices, -1, order)
 
 def load_model_and_data(args):
     """
@@ -33,9 +438,9 @@ def load_model_and_data(args):
         args: Command line arguments
         
     Returns:
-        model: Trained LightGCN model
+        model: Trained LightGCN model (None when --query_only is served from the embeddings cache)
         data: PyTorch Geometric data object
-        meta: Metadata dictionary
+        meta: Metadata dictionary, with the propagated embeddings under "all_embeddings"
     """
     # Set device
     device = torch.device(args.device if torch.cuda.is_available() and args.device == "cuda" else "cpu")
@@ -52,29 +457,64 @@ def load_model_and_data(args):
         data, meta = load_filtered_data(data_dir=args.data_dir)
     
     data = data.to(device)
+    # Edge tensors are moved once here and passed to the model as-is from then on
+    data.edge_index = data.edge_index.contiguous()
+    if getattr(data, "edge_attr", None) is not None:
+        data.edge_attr = data.edge_attr.contiguous()
+    assert data.edge_index.device.type == device.type, f"edge_index on {data.edge_index.device}, expected {device}"
+
+    # Purchases as device CSR for masking, and vectorized index -> ID lookups
+    purchased_csr(meta, device)
+    reverse_id_array(meta, "reverse_article_map")
+    reverse_id_array(meta, "reverse_customer_map")
+    
+    model_path = os.path.join(args.model_dir, args.model_file)
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file not found: {model_path}")
+    # The embeddings are cached on disk only when --embeddings_cache is given
+    cache_path = args.embeddings_cache
+    cache_key = _embeddings_key(args, data, model_path) if cache_path else None
+    
+    # Queries only need the propagated embeddings; skip building the model when they are cached
+    if args.query_only and cache_path:
+        cached = load_cached_embeddings(cache_path, cache_key, device)
+        if cached is not None:
+            meta["all_embeddings"] = cached
+            prepare_items(meta, cached, offload=args.offload_items)
+            return None, data, meta
     
     # Load model
     num_users = meta["num_customers"]
     num_items = meta["num_articles"]
     
-    model = LightGCN(
-        num_users=num_users,
-        num_items=num_items,
-        embed_dim=args.embed_dim,
-        num_layers=args.num_layers
-    ).to(device)
+    # Build on the meta device: the random init would be overwritten by the checkpoint anyway
+    with torch.device("meta"):
+        model = LightGCN(
+            num_users=num_users,
+            num_items=num_items,
+            embed_dim=args.embed_dim,
+            num_layers=args.num_layers
+        )
     
-    model_path = os.path.join(args.model_dir, args.model_file)
-    if os.path.exists(model_path):
-        print(f"Loading model from {model_path}")
-        model.load_state_dict(torch.load(model_path, map_location=device))
-    else:
-        raise FileNotFoundError(f"Model file not found: {model_path}")
+    print(f"Loading model from {model_path}")
+    # Memory-map the checkpoint and adopt its tensors instead of copying into fresh parameters
+    state_dict = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model = model.to(device)
     
     model.eval()
+    # Inference-only propagation: bfloat16 activations with an fp32 layer average
+    if device.type == "cuda" and torch.cuda.is_bf16_supported():
+        model.propagation_dtype = torch.bfloat16
+    
+    # Propagate once; every recommendation call reuses the result
+    meta["all_embeddings"] = precompute_embeddings(model, data, cache_path=cache_path, cache_key=cache_key)
+    prepare_items(meta, meta["all_embeddings"], offload=args.offload_items)
     return model, data, meta
 
-def get_recommendations_for_user(model, data, meta, customer_id, top_k=10, exclude_purchased=True):
+@torch.inference_mode()
+def get_recommendations_for_user(model, data, meta, customer_id, top_k=10, exclude_purchased=True,
+                                 all_embeddings=None):
     """
     Generate recommendations for a specific user.
     
@@ -85,13 +525,12 @@ def get_recommendations_for_user(model, data, meta, customer_id, top_k=10, exclu
         customer_id: Customer ID (string)
         top_k: Number of recommendations to generate
         exclude_purchased: Whether to exclude items the user has already purchased
+        all_embeddings: Optional precomputed propagated embeddings
         
     Returns:
         recommendations: List of recommended article IDs
         scores: Corresponding scores
     """
-    device = next(model.parameters()).device
-    num_users = meta["num_customers"]
     customer_id_map = meta["customer_id_map"]
     
     if customer_id not in customer_id_map:
@@ -100,32 +539,51 @@ def get_recommendations_for_user(model, data, meta, customer_id, top_k=10, exclu
     
     user_idx = customer_id_map[customer_id]
     
-    with torch.no_grad():
-        all_embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
-    
-    user_embedding = all_embeddings[user_idx].unsqueeze(0)
-    item_embeddings = all_embeddings[num_users:]
+    all_embeddings = _get_embeddings(model, data, all_embeddings)
     
-    scores = torch.matmul(user_embedding, item_embeddings.t()).squeeze(0)
+    user_embedding = all_embeddings.narrow(0, user_idx, 1)
+    items_t = items_transposed_of(meta, all_embeddings)
     
-    # Exclude already purchased items if requested
-    if exclude_purchased:
-        purchased_items = meta.get("user_to_items", {}).get(user_idx, [])
-        for item_idx in purchased_items:
-            scores[item_idx] = -float('inf')
+    device = all_embeddings.device
+    k = min(top_k, items_t.size(1))
     
-    # Get top-k recommendations
-    scores, indices = torch.topk(scores, k=min(top_k, len(scores)))
-    scores = scores.cpu().numpy()
-    indices = indices.cpu().numpy()
+    if items_t.device != device:
+        mask_index = purchased_index(meta, [user_idx], device) if exclude_purchased else None
+        scores, indices = chunked_topk(user_embedding, items_t, k, mask_index=mask_index)
+        scores = scores.squeeze(0).cpu().numpy()
+        indices = indices.squeeze(0).cpu().numpy()
+    elif device.type == "cuda":
+        # Fixed-shape purchase mask, so the compiled kernel is reused for every user
+        mask = torch.zeros(items_t.size(1), dtype=torch.bool, device=device)
+        if exclude_purchased:
+            _, cols = purchased_index(meta, [user_idx], device)
+            mask[cols] = True
+        scores, indices = compiled_masked_topk(user_embedding, items_t, mask, k)
+        scores = scores.cpu().numpy()
+        indices = indices.cpu().numpy()
+    else:
+        scores = score_matmul(user_embedding, items_t).squeeze(0)
+        
+        # Exclude already purchased items if requested
+        if exclude_purchased:
+            _, cols = purchased_index(meta, [user_idx], device)
+            scores.index_fill_(0, cols, -float('inf'))
+        
+        # For a single row, partitioning in numpy beats a full top-k kernel; only the
+        # k selected scores are then sorted
+        scores = scores.numpy()
+        indices = np.argpartition(scores, -k)[-k:] if k < len(scores) else np.arange(len(scores))
+        indices = indices[np.argsort(-scores[indices], kind="stable")]
+        scores = scores[indices]
     
     # Convert to article IDs
-    reverse_article_map = meta["reverse_article_map"]
-    recommendations = [reverse_article_map[idx] for idx in indices]
+    recommendations = reverse_id_array(meta, "reverse_article_map")[indices].tolist()
     
     return recommendations, scores
 
-def get_recommendations_batch(model, data, meta, customer_ids, top_k=10, exclude_purchased=True):
+@torch.inference_mode()
+def get_recommendations_batch(model, data, meta, customer_ids, top_k=10, exclude_purchased=True,
+                              all_embeddings=None):
     """
     Generate recommendations for a batch of users.
     
@@ -136,56 +594,56 @@ def get_recommendations_batch(model, data, meta, customer_ids, top_k=10, exclude
         customer_ids: List of customer IDs
         top_k: Number of recommendations to generate
         exclude_purchased: Whether to exclude items the user has already purchased
+        all_embeddings: Optional precomputed propagated embeddings
         
     Returns:
         recommendations_dict: Dictionary mapping customer IDs to their recommendations
     """
-    device = next(model.parameters()).device
-    num_users = meta["num_customers"]
     customer_id_map = meta["customer_id_map"]
-    reverse_article_map = meta["reverse_article_map"]
+    reverse_article_arr = reverse_id_array(meta, "reverse_article_map")
     
-    # Filter valid customer IDs
-    valid_customers = [cid for cid in customer_ids if cid in customer_id_map]
-    if not valid_customers:
+    # Filter valid customer IDs and map them to user indices in one vectorized pass
+    customer_ser = pd.Series(customer_ids, dtype=object)
+    mapped = customer_ser.map(customer_id_map)
+    valid = mapped.notna().to_numpy()
+    if not valid.any():
         print("No valid customer IDs provided.")
         return {}
+    valid_customers = customer_ser[valid].tolist()
+    user_indices = mapped[valid].to_numpy(np.int64)
     
-    user_indices = [customer_id_map[cid] for cid in valid_customers]
-    user_indices_tensor = torch.tensor(user_indices, dtype=torch.long, device=device)
+    all_embeddings = _get_embeddings(model, data, all_embeddings)
+    device = all_embeddings.device
     
-    with torch.no_grad():
-        all_embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
+    user_indices_tensor = torch.from_numpy(user_indices).to(device, non_blocking=True)
     
-    user_embeddings = all_embeddings[user_indices_tensor]
-    item_embeddings = all_embeddings[num_users:]
+    user_embeddings = torch.index_select(all_embeddings, 0, user_indices_tensor)
+    items_t = items_transposed_of(meta, all_embeddings)
     
-    # Calculate scores for all users and items
-    scores = torch.matmul(user_embeddings, item_embeddings.t())
-    
-    recommendations_dict = {}
-    for i, cid in enumerate(valid_customers):
-        user_scores = scores[i]
-        
-        # Exclude already purchased items if requested
-        if exclude_purchased:
-            user_idx = customer_id_map[cid]
-            purchased_items = meta.get("user_to_items", {}).get(user_idx, [])
-            for item_idx in purchased_items:
-                user_scores[item_idx] = -float('inf')
+    mask_index = purchased_index(meta, user_indices_tensor, device) if exclude_purchased else None
+    if items_t.device != device:
+        # Offloaded items: stream the catalogue through chunked scoring
+        _, indices = chunked_topk(user_embeddings, items_t, top_k, mask_index=mask_index)
+    else:
+        # Calculate scores for all users and items
+        scores = score_matmul(user_embeddings, items_t)
         
-        # Get top-k recommendations
-        user_scores, indices = torch.topk(user_scores, k=min(top_k, len(user_scores)))
-        user_scores = user_scores.cpu().numpy()
-        indices = indices.cpu().numpy()
+        # Exclude already purchased items if requested, for the whole batch at once
+        if mask_index is not None:
+            scores.index_put_(mask_index, torch.tensor(-float('inf'), device=device))
         
-        # Convert to article IDs
-        recommendations = [reverse_article_map[idx] for idx in indices]
-        recommendations_dict[cid] = recommendations
+        _, indices = sort_topk(*torch.topk(scores, k=min(top_k, scores.size(1)), dim=1, sorted=False))
+    
+    # Get top-k recommendations for the whole batch with a single device-to-host copy
+    indices = indices.cpu().numpy()
+    
+    # Convert to article IDs
+    recommendations_dict = dict(zip(valid_customers, reverse_article_arr[indices].tolist()))
     
     return recommendations_dict
 
-def explain_recommendation(model, data, meta, customer_id, article_id, n_similar=5):
+@torch.inference_mode()
+def explain_recommendation(model, data, meta, customer_id, article_id, n_similar=5, all_embeddings=None):
     """
     Explain why an item was recommended to a user.
     
@@ -196,15 +654,15 @@ def explain_recommendation(model, data, meta, customer_id, article_id, n_similar
         customer_id: Customer ID
         article_id: Article ID to explain
         n_similar: Number of similar users/items to consider
+        all_embeddings: Optional precomputed propagated embeddings
         
     Returns:
         explanation: Dictionary with explanation information
     """
-    device = next(model.parameters()).device
     customer_id_map = meta["customer_id_map"]
     article_id_map = meta["article_id_map"]
-    reverse_customer_map = meta["reverse_customer_map"]
-    reverse_article_map = meta["reverse_article_map"]
+    reverse_customer_arr = reverse_id_array(meta, "reverse_customer_map")
+    reverse_article_arr = reverse_id_array(meta, "reverse_article_map")
     num_users = meta["num_customers"]
     
     if customer_id not in customer_id_map or article_id not in article_id_map:
@@ -214,25 +672,30 @@ def explain_recommendation(model, data, meta, customer_id, article_id, n_similar
     user_idx = customer_id_map[customer_id]
     item_idx = article_id_map[article_id]
     
-    with torch.no_grad():
-        all_embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
+    all_embeddings = _get_embeddings(model, data, all_embeddings)
     
     user_embedding = all_embeddings[user_idx]
     item_embedding = all_embeddings[num_users + item_idx]
-    all_user_embeddings = all_embeddings[:num_users]
-    all_item_embeddings = all_embeddings[num_users:]
+    num_items = all_embeddings.size(0) - num_users
+    
+    # Score the user against all users and the item against all items with one GEMM:
+    # row 0 keeps the user block, row 1 the item block, and the rest is masked out
+    query = torch.stack([user_embedding, item_embedding], dim=0)
+    similarities = score_matmul(query, all_embeddings.t())
+    similarities[0, num_users:] = -float('inf')
+    similarities[1, :num_users] = -float('inf')
+    # Exclude the user and the item themselves
+    similarities[0, user_idx] = -float('inf')
+    similarities[1, num_users + item_idx] = -float('inf')
+    k_users, k_items = min(n_similar*3, num_users), min(n_similar*3, num_items)
+    _, similar_indices = torch.topk(similarities, k=max(k_users, k_items), dim=1)
+    similar_indices = similar_indices.cpu().numpy()
     
     # Find similar users who might have purchased this item
-    user_similarities = torch.matmul(user_embedding.unsqueeze(0), all_user_embeddings.t()).squeeze(0)
-    user_similarities[user_idx] = -float('inf')  # Exclude the user themselves
-    _, similar_user_indices = torch.topk(user_similarities, k=min(n_similar*3, len(user_similarities)))
-    similar_user_indices = similar_user_indices.cpu().numpy()
+    similar_user_indices = similar_indices[0][similar_indices[0] < num_users][:k_users]
     
     # Find similar items the user has purchased
-    item_similarities = torch.matmul(item_embedding.unsqueeze(0), all_item_embeddings.t()).squeeze(0)
-    item_similarities[item_idx] = -float('inf')  # Exclude the item itself
-    _, similar_item_indices = torch.topk(item_similarities, k=min(n_similar*3, len(item_similarities)))
-    similar_item_indices = similar_item_indices.cpu().numpy()
+    similar_item_indices = similar_indices[1][similar_indices[1] >= num_users][:k_items] - num_users
     
     # Get purchased items for similar users
     purchased_by_similar_users = []
@@ -256,13 +719,15 @@ def explain_recommendation(model, data, meta, customer_id, article_id, n_similar
         "customer_id": customer_id,
         "article_id": article_id,
         "similarity_score": torch.dot(user_embedding, item_embedding).item(),
-        "similar_users": [reverse_customer_map[idx] for idx in purchased_by_similar_users],
-        "similar_items": [reverse_article_map[idx] for idx in similar_items_purchased]
+        "similar_users": reverse_customer_arr[np.asarray(purchased_by_similar_users, dtype=np.int64)].tolist(),
+        "similar_items": reverse_article_arr[np.asarray(similar_items_purchased, dtype=np.int64)].tolist()
     }
     
     return explanation
 
-def generate_all_recommendations(model, data, meta, output_file, top_k=10, batch_size=100):
+@torch.inference_mode()
+def generate_all_recommendations(model, data, meta, output_file, top_k=10, batch_size=100,
+                                 all_embeddings=None, item_chunk_size=65536):
     """
     Generate recommendations for all users and save to a file.
     
@@ -273,61 +738,94 @@ def generate_all_recommendations(model, data, meta, output_file, top_k=10, batch
         output_file: Path to save the recommendations
         top_k: Number of recommendations per user
         batch_size: Batch size for processing
+        all_embeddings: Optional precomputed propagated embeddings
+        item_chunk_size: Number of items scored per GEMM
     """
-    device = next(model.parameters()).device
     customer_id_map = meta["customer_id_map"]
-    reverse_article_map = meta["reverse_article_map"]
-    num_users = meta["num_customers"]
+    reverse_article_arr = reverse_id_array(meta, "reverse_article_map")
     
     all_customer_ids = list(customer_id_map.keys())
     total_batches = (len(all_customer_ids) + batch_size - 1) // batch_size
     
     # Prepare for batch processing
-    with torch.no_grad():
-        all_embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
+    all_embeddings = _get_embeddings(model, data, all_embeddings)
+    device = all_embeddings.device
+    
+    items_t = items_transposed_of(meta, all_embeddings)
+    
+    # Results are streamed to the CSV one batch at a time; the writer is opened on the
+    # first batch, once the column types are known
+    writer = None
     
-    item_embeddings = all_embeddings[num_users:]
+    def add_results(batch_customer_ids, batch_indices):
+        nonlocal writer
+        # Convert to article IDs and write, one vectorized table per batch
+        num_recs = batch_indices.shape[1]
+        table = pa.Table.from_arrays([
+            pa.array(np.repeat(np.asarray(batch_customer_ids), num_recs)),
+            pa.array(reverse_article_arr[batch_indices.ravel()]),
+            pa.array(np.tile(np.arange(1, num_recs + 1), len(batch_customer_ids)))
+        ], names=["customer_id", "article_id", "rank"])
+        if writer is None:
+            writer = pa_csv.CSVWriter(output_file, table.schema)
+        writer.write_table(table)
     
-    # Create results dataframe
-    results = []
+    # On CPU, masking and top-k selection run in one compiled pass over each score chunk
+    use_numba = _NUMBA_AVAILABLE and device.type == "cpu"
+    if use_numba:
+        indptr, cols = (t.numpy() for t in purchased_csr(meta, device))
     
-    for batch_idx in tqdm(range(0, len(all_customer_ids), batch_size), desc="Generating recommendations"):
+    # On GPU, top-k indices go to two pinned host slots with async copies; a batch is
+    # converted while the next one is being scored, so there is no blocking copy per batch
+    use_staging = device.type == "cuda"
+    if use_staging:
+        num_recs = min(top_k, items_t.size(1))
+        idx_host = [torch.empty((batch_size, num_recs), dtype=torch.long, pin_memory=True) for _ in range(2)]
+        copied = [torch.cuda.Event(), torch.cuda.Event()]
+    pending = None
+    
+    for step, batch_idx in enumerate(tqdm(range(0, len(all_customer_ids), batch_size), desc="Generating recommendations")):
         batch_customer_ids = all_customer_ids[batch_idx:batch_idx + batch_size]
         batch_user_indices = [customer_id_map[cid] for cid in batch_customer_ids]
         batch_user_indices_tensor = torch.tensor(batch_user_indices, dtype=torch.long, device=device)
         
         # Get user embeddings for this batch
-        batch_user_embeddings = all_embeddings[batch_user_indices_tensor]
+        batch_user_embeddings = torch.index_select(all_embeddings, 0, batch_user_indices_tensor)
         
-        # Calculate scores
-        batch_scores = torch.matmul(batch_user_embeddings, item_embeddings.t())
+        if use_numba:
+            _, batch_indices = chunked_topk_numba(
+                batch_user_embeddings, items_t, top_k, batch_user_indices_tensor.numpy(),
+                indptr, cols, chunk_size=item_chunk_size
+            )
+            add_results(batch_customer_ids, batch_indices)
+            continue
         
-        # Process each user in the batch
-        for i, customer_id in enumerate(batch_customer_ids):
-            user_idx = batch_user_indices[i]
-            user_scores = batch_scores[i]
-            
-            # Exclude already purchased items
-            purchased_items = meta.get("user_to_items", {}).get(user_idx, [])
-            for item_idx in purchased_items:
-                user_scores[item_idx] = -float('inf')
-            
-            # Get top-k recommendations
-            _, indices = torch.topk(user_scores, k=min(top_k, len(user_scores)))
-            indices = indices.cpu().numpy()
-            
-            # Convert to article IDs and add to results
-            for rank, item_idx in enumerate(indices):
-                article_id = reverse_article_map[item_idx]
-                results.append({
-                    "customer_id": customer_id,
-                    "article_id": article_id,
-                    "rank": rank + 1
-                })
-    
-    # Create and save dataframe
-    results_df = pd.DataFrame(results)
-    results_df.to_csv(output_file, index=False)
+        # Score item chunks, excluding already purchased items, and keep the running top-k
+        _, batch_indices = chunked_topk(
+            batch_user_embeddings, items_t, top_k,
+            mask_index=purchased_index(meta, batch_user_indices, device), chunk_size=item_chunk_size
+        )
+        
+        if use_staging:
+            slot = step % 2
+            host = idx_host[slot][:len(batch_customer_ids)]
+            host.copy_(batch_indices, non_blocking=True)
+            copied[slot].record()
+            if pending is not None:
+                copied[pending[0]].synchronize()
+                add_results(pending[1], pending[2].numpy())
+            pending = (slot, batch_customer_ids, host)
+        else:
+            add_results(batch_customer_ids, batch_indices.numpy())
+    
+    if pending is not None:
+        copied[pending[0]].synchronize()
+        add_results(pending[1], pending[2].numpy())
+    
+    if writer is not None:
+        writer.close()
+    else:
+        pd.DataFrame(columns=["customer_id", "article_id", "rank"]).to_csv(output_file, index=False)
     print(f"Recommendations saved to {output_file}")
 
 def load_article_metadata(data_dir):
@@ -348,14 +846,41 @@ def load_article_metadata(data_dir):
         print(f"Articles file not found at {articles_path}")
         return None
 
-def format_recommendation(article_id, score, articles_df=None):
+def build_article_index(articles_df):
+    """
+    Index article metadata by article ID for O(1) lookups.
+    
+    Args:
+        articles_df: DataFrame with article metadata (or None)
+        
+    Returns:
+        dict: Article ID -> formatted metadata fields, or None if no metadata is available
+    """
+    if articles_df is None:
+        return None
+    
+    fields = {
+        "product_name": "prod_name",
+        "product_type": "product_type_name",
+        "product_group": "product_group_name",
+        "color": "colour_group_name",
+        "department": "department_name"
+    }
+    articles = articles_df.drop_duplicates("article_id").set_index("article_id")
+    info = pd.DataFrame({
+        key: articles[col] if col in articles.columns else None
+        for key, col in fields.items()
+    }, index=articles.index)
+    return info.to_dict(orient="index")
+
+def format_recommendation(article_id, score, article_index=None):
     """
     Format article recommendation with additional metadata.
     
     Args:
         article_id: Article ID
         score: Recommendation score
-        articles_df: DataFrame with article metadata
+        article_index: Article metadata indexed by article ID (see build_article_index)
         
     Returns:
         dict: Formatted recommendation
@@ -365,16 +890,8 @@ def format_recommendation(article_id, score, articles_df=None):
         "score": score
     }
     
-    if articles_df is not None:
-        article_info = articles_df[articles_df["article_id"] == article_id]
-        if not article_info.empty:
-            rec.update({
-                "product_name": article_info["prod_name"].values[0],
-                "product_type": article_info["product_type_name"].values[0],
-                "product_group": article_info["product_group_name"].values[0],
-                "color": article_info["colour_group_name"].values[0] if "colour_group_name" in article_info.columns else None,
-                "department": article_info["department_name"].values[0] if "department_name" in article_info.columns else None
-            })
+    if article_index is not None:
+        rec.update(article_index.get(article_id) or {})
     
     return rec
 
@@ -382,16 +899,18 @@ def main(args):
     """Main function to generate recommendations."""
     # Load model and data
     model, data, meta = load_model_and_data(args)
+    all_embeddings = meta["all_embeddings"]
     
-    # Load article metadata
-    articles_df = load_article_metadata(args.data_dir)
+    # Load article metadata, indexed once by article ID
+    article_index = build_article_index(load_article_metadata(args.data_dir))
     
     # Check recommendation mode
     if args.customer_id:
         # Single customer mode
         recommendations, scores = get_recommendations_for_user(
             model, data, meta, args.customer_id, 
-            top_k=args.top_k, exclude_purchased=not args.include_purchased
+            top_k=args.top_k, exclude_purchased=not args.include_purchased,
+            all_embeddings=all_embeddings
         )
         
         if not recommendations:
@@ -400,7 +919,7 @@ def main(args):
         
         print(f"\nTop {len(recommendations)} recommendations for customer {args.customer_id}:")
         for i, (article_id, score) in enumerate(zip(recommendations, scores)):
-            rec = format_recommendation(article_id, score, articles_df)
+            rec = format_recommendation(article_id, score, article_index)
             print(f"\n{i+1}. Article: {rec['article_id']} (Score: {score:.4f})")
             if 'product_name' in rec:
                 print(f"   Product: {rec['product_name']}")
@@ -412,7 +931,9 @@ def main(args):
         
         # Provide explanation for top recommendation if requested
         if args.explain and recommendations:
-            explanation = explain_recommendation(model, data, meta, args.customer_id, recommendations[0])
+            explanation = explain_recommendation(
+                model, data, meta, args.customer_id, recommendations[0], all_embeddings=all_embeddings
+            )
             print("\nWhy this item was recommended:")
             print(f"Similarity score: {explanation['similarity_score']:.4f}")
             
@@ -424,7 +945,7 @@ def main(args):
             if explanation['similar_items']:
                 print("\nSimilar items the user has purchased:")
                 for idx, item_id in enumerate(explanation['similar_items'][:3]):
-                    item_info = format_recommendation(item_id, 0, articles_df)
+                    item_info = format_recommendation(item_id, 0, article_index)
                     print(f"  Item {idx+1}: {item_id} - {item_info.get('product_name', 'Unknown')}")
     
     elif args.customers_file:
@@ -436,7 +957,8 @@ def main(args):
             print(f"Generating recommendations for {len(customer_ids)} customers...")
             recommendations_dict = get_recommendations_batch(
                 model, data, meta, customer_ids, 
-                top_k=args.top_k, exclude_purchased=not args.include_purchased
+                top_k=args.top_k, exclude_purchased=not args.include_purchased,
+                all_embeddings=all_embeddings
             )
             
             # Save to file
@@ -461,7 +983,8 @@ def main(args):
         output_file = args.output_file or "all_recommendations.csv"
         generate_all_recommendations(
             model, data, meta, output_file, 
-            top_k=args.top_k, batch_size=args.batch_size
+            top_k=args.top_k, batch_size=args.batch_size,
+            all_embeddings=all_embeddings, item_chunk_size=args.item_chunk_size
         )
     
     else:
@@ -505,8 +1028,16 @@ def parse_args():
                         help="Output file for batch or all-customers mode")
     parser.add_argument("--batch_size", type=int, default=100,
                         help="Batch size for processing all customers")
+    parser.add_argument("--item_chunk_size", type=int, default=65536,
+                        help="Items scored per GEMM in all-customers mode (bounds score memory)")
     
     # Other arguments
+    parser.add_argument("--embeddings_cache", type=str, default=None,
+                        help="Path of a propagated-embeddings cache (.npy) to load from / save to (default: no cache)")
+    parser.add_argument("--query_only", action="store_true",
+                        help="Serve from --embeddings_cache without building the model when it is valid")
+    parser.add_argument("--offload_items", action="store_true",
+                        help="Keep the item embeddings in pinned host memory and stream them to the GPU in chunks")
     parser.add_argument("--device", type=str, default="cuda",
                         choices=["cuda", "cpu"], help="Device to use")
     
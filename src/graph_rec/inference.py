@@ -17,7 +17,7 @@ def load_model(model_path, num_users, num_items, embed_dim=64, num_layers=3, mod
     else:
         model = LightGCN(num_users, num_items, embed_dim=embed_dim, num_layers=num_layers).to(device)
     print(f"Loading model from {model_path}")
-    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True))
     model.eval()
     return model
 
@@ -36,8 +36,10 @@ def get_recommendations_for_user(model, data, meta, user_id, top_k=10):
     _, topk_idx = torch.topk(scores, top_k)
     topk_idx = topk_idx.cpu().tolist()
     
-    article_id_map = meta["article_id_map"]
-    reverse_article_map = {v: k for k, v in article_id_map.items()}
+    # Saved with the meta by data_loader; only older meta files need it built (once)
+    if "reverse_article_map" not in meta:
+        meta["reverse_article_map"] = {v: k for k, v in meta["article_id_map"].items()}
+    reverse_article_map = meta["reverse_article_map"]
     recommendations = [reverse_article_map[i] for i in topk_idx]
     return recommendations
 
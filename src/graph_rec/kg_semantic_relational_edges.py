@@ -1,15 +1,51 @@
+import array
+import hashlib
 import json
+import os
 import networkx as nx
 import torch
 from torch_geometric.data import Data
 from sentence_transformers import SentenceTransformer
 import numpy as np
-from scipy.spatial.distance import cosine
+from numba import njit, prange
 
 # Import chromadb and its settings
 import chromadb
 from chromadb.config import Settings
 
+@njit(parallel=True, cache=True)
+def _pairwise_above_threshold(M, thr):
+    """
+    Find pairs (i, j), i < j, of L2-normalized rows whose dot product is at least thr,
+    without materializing the full similarity matrix.
+    """
+    N, D = M.shape
+    # First pass counts the matches per row so the second pass can write in parallel.
+    counts = np.zeros(N, dtype=np.int64)
+    for i in prange(N):
+        c = 0
+        for j in range(i + 1, N):
+            s = 0.0
+            for d in range(D):
+                s += M[i, d] * M[j, d]
+            if s >= thr:
+                c += 1
+        counts[i] = c
+    offsets = np.zeros(N + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    pairs = np.empty((offsets[N], 2), dtype=np.int64)
+    for i in prange(N):
+        k = offsets[i]
+        for j in range(i + 1, N):
+            s = 0.0
+            for d in range(D):
+                s += M[i, d] * M[j, d]
+            if s >= thr:
+                pairs[k, 0] = i
+                pairs[k, 1] = j
+                k += 1
+    return pairs
+
 class KnowledgeGraphDataset:
     def __init__(self, json_path=None, embedding_model_name="all-MiniLM-L6-v2", semantic_threshold=0.8):
         """
@@ -22,15 +58,20 @@ class KnowledgeGraphDataset:
         """
         self.json_path = json_path
         self.nodes = {}    # Key: entity name, Value: dict with id, aggregated chunk texts, and labels.
-        self.relations = []  # List of edges: (src_id, tgt_id, relation)
+        # Edges as typed arrays: source ids, target ids, and relation codes into _rel_vocab.
+        self._src = array.array('q')
+        self._tgt = array.array('q')
+        self._rel_codes = array.array('i')
+        self._rel_vocab = {}
         self.node_counter = 0
         self.semantic_threshold = semantic_threshold
+        self.embedding_model_name = embedding_model_name
 
         if self.json_path:
             self.load_data()
 
         # Initialize the embedding model
-        self.embedder = SentenceTransformer(embedding_model_name)
+        self.embedder = self._load_embedder(embedding_model_name)
 
         # Initialize the Chroma vector database client and collection.
         self.chroma_client = chromadb.Client(
@@ -42,6 +83,47 @@ class KnowledgeGraphDataset:
         except Exception:
             self.collection = self.chroma_client.create_collection("kg_embeddings")
 
+    def _load_embedder(self, model_name):
+        """
+        Load the SentenceTransformer: ONNX Runtime on CPU, half precision with SDPA attention on GPU.
+        """
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if device == "cpu":
+            try:
+                # Exports the model to ONNX on first use if no ONNX file is available.
+                return SentenceTransformer(model_name, device=device, backend="onnx")
+            except Exception:
+                # sentence-transformers < 3.2 or optimum/onnxruntime missing: use PyTorch.
+                pass
+        model_kwargs = {"torch_dtype": torch.float16} if device == "cuda" else {}
+        try:
+            # Dispatch attention to F.scaled_dot_product_attention.
+            embedder = SentenceTransformer(
+                model_name, device=device,
+                model_kwargs={**model_kwargs, "attn_implementation": "sdpa"}
+            )
+        except (TypeError, ValueError):
+            # Older transformers: fall back to the BetterTransformer conversion.
+            embedder = SentenceTransformer(model_name, device=device, model_kwargs=model_kwargs)
+            try:
+                embedder._first_module().auto_model.to_bettertransformer()
+            except Exception:
+                pass
+        return embedder
+
+    @property
+    def relations(self):
+        """
+        List of edges as (src_id, tgt_id, relation) tuples.
+        """
+        names = list(self._rel_vocab)
+        return [(s, t, names[c]) for s, t, c in zip(self._src, self._tgt, self._rel_codes)]
+
+    def _append_edge(self, src, tgt, relation):
+        self._src.append(src)
+        self._tgt.append(tgt)
+        self._rel_codes.append(self._rel_vocab.setdefault(relation, len(self._rel_vocab)))
+
     def load_data(self):
         with open(self.json_path, "r") as f:
             self.data = json.load(f)
@@ -73,7 +155,7 @@ class KnowledgeGraphDataset:
         """
         source_id = self.add_node(source, chunk_text)
         target_id = self.add_node(target)
-        self.relations.append((source_id, target_id, relation))
+        self._append_edge(source_id, target_id, relation)
 
     def construct_graph(self):
         """
@@ -90,7 +172,7 @@ class KnowledgeGraphDataset:
                 if label:
                     # Add an edge representing the type relationship (belongs_to)
                     label_id = self.add_node(label)
-                    self.relations.append((self.nodes[entity]["id"], self.nodes[label]["id"], "belongs_to"))
+                    self._append_edge(self.nodes[entity]["id"], self.nodes[label]["id"], "belongs_to")
             # Process relation triplets
             for triplet in entry.get("relation_triplets", []):
                 source = triplet.get("source")
@@ -114,54 +196,130 @@ class KnowledgeGraphDataset:
             G.add_edge(src, tgt, relation=relation)
         return G
 
-    def compute_node_embeddings(self):
+    def _text_key(self, text):
+        """
+        Hash an aggregated text together with the embedding model name.
+        """
+        payload = f"{self.embedding_model_name}\0{text}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+    def _encode(self, texts, batch_size):
+        """
+        Encode texts as normalized fp32 embeddings, longest first so batches pad to similar lengths.
+        Identical texts are encoded once and fanned back out.
+        """
+        row_of = {}
+        inverse = np.fromiter((row_of.setdefault(t, len(row_of)) for t in texts), dtype=np.int64, count=len(texts))
+        uniq = list(row_of)
+        order = np.argsort([-len(t) for t in uniq], kind="stable")
+        embs = self.embedder.encode(
+            [uniq[k] for k in order],
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=True,
+            normalize_embeddings=True
+        )
+        # Store fp32 embeddings so downstream PyG features keep their dtype.
+        return embs[np.argsort(order)][inverse].astype(np.float32, copy=False)
+
+    def compute_node_embeddings(self, batch_size=256, chroma_chunk_size=10000, cache_path=None):
         """
         Compute a semantic embedding for each node by aggregating its chunk_texts.
+        All node texts are encoded in batches with a single encode call.
+        If cache_path is given, embeddings are kept in a .npy file (with a JSON index of
+        text hash -> row next to it) and only texts missing from the cache are encoded.
         Also adds the embedding into the Chroma vector database.
         """
-        self.embeddings = {}
+        entities, ids, texts = [], [], []
         for entity, node_data in self.nodes.items():
             # Aggregate all chunk texts; if none available, fallback to the entity name.
             aggregated_text = " ".join(node_data["chunk_texts"]) if node_data["chunk_texts"] else entity
-            embedding = self.embedder.encode(aggregated_text)
-            self.embeddings[node_data["id"]] = embedding
-            # Add the embedding to the Chroma vector DB
+            entities.append(entity)
+            ids.append(node_data["id"])
+            texts.append(aggregated_text)
+
+        if cache_path is None:
+            embs = self._encode(texts, batch_size)
+        else:
+            index_path = os.path.splitext(cache_path)[0] + "_index.json"
+            cache, index = None, {}
+            if os.path.exists(cache_path) and os.path.exists(index_path):
+                cache = np.load(cache_path, mmap_mode="r")
+                with open(index_path, "r") as f:
+                    index = json.load(f)
+            keys = [self._text_key(t) for t in texts]
+            missing = {}
+            for k, key in enumerate(keys):
+                if key not in index and key not in missing:
+                    missing[key] = k
+            if missing:
+                new_embs = self._encode([texts[k] for k in missing.values()], batch_size)
+                for key in missing:
+                    index[key] = len(index)
+                cache = new_embs if cache is None else np.concatenate([cache, new_embs])
+                # Write to a temporary file first so a memory-mapped old cache is never truncated.
+                tmp_path = cache_path + ".tmp.npy"
+                np.save(tmp_path, cache)
+                os.replace(tmp_path, cache_path)
+                with open(index_path, "w") as f:
+                    json.dump(index, f)
+            embs = np.asarray(cache[[index[key] for key in keys]], dtype=np.float32)
+
+        self.embeddings = {id_: embs[k] for k, id_ in enumerate(ids)}
+        # Add the embeddings to the Chroma vector DB in bulk, chunked to bound memory.
+        for start in range(0, len(ids), chroma_chunk_size):
+            stop = start + chroma_chunk_size
             self.collection.add(
-                documents=[aggregated_text],
-                metadatas=[{"entity": entity}],
-                ids=[str(node_data["id"])],
-                embeddings=[embedding.tolist()]
+                documents=texts[start:stop],
+                metadatas=[{"entity": e} for e in entities[start:stop]],
+                ids=[str(i) for i in ids[start:stop]],
+                embeddings=embs[start:stop].tolist()
             )
 
-    def add_semantic_edges(self):
+    def add_semantic_edges(self, memory_budget=2**30):
         """
-        Compute pairwise cosine similarity between node embeddings.
+        Compute pairwise cosine similarity between node embeddings with one matrix product.
+        If the NxN similarity matrix would exceed memory_budget bytes, stream the pairs
+        through a parallel Numba kernel instead.
         If similarity exceeds the threshold, add a semantic edge.
         """
         node_ids = list(self.embeddings.keys())
-        for i in range(len(node_ids)):
-            for j in range(i + 1, len(node_ids)):
-                emb1 = self.embeddings[node_ids[i]]
-                emb2 = self.embeddings[node_ids[j]]
-                sim = 1 - cosine(emb1, emb2)
-                if sim >= self.semantic_threshold:
-                    # Add semantic similarity edges in both directions.
-                    self.relations.append((node_ids[i], node_ids[j], "semantic_sim"))
-                    self.relations.append((node_ids[j], node_ids[i], "semantic_sim"))
+        M = np.stack([self.embeddings[i] for i in node_ids]).astype(np.float32)
+        M /= np.linalg.norm(M, axis=1, keepdims=True)
+        N = len(node_ids)
+        if N * N * 4 > memory_budget:
+            idx = _pairwise_above_threshold(M, np.float32(self.semantic_threshold))
+        else:
+            S = M @ M.T
+            idx = np.argwhere(np.triu(S >= self.semantic_threshold, k=1))
+        # Add semantic similarity edges in both directions, appended in bulk.
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        a, b = node_ids[idx[:, 0]], node_ids[idx[:, 1]]
+        self._src.frombytes(np.stack([a, b], axis=1).tobytes())
+        self._tgt.frombytes(np.stack([b, a], axis=1).tobytes())
+        code = self._rel_vocab.setdefault("semantic_sim", len(self._rel_vocab))
+        self._rel_codes.extend(array.array('i', [code]) * (2 * len(idx)))
 
     def get_graph_data(self):
         """
         Convert the nodes and relations into a PyTorch Geometric Data object.
         Uses node embeddings as feature vectors.
         """
-        edge_index = torch.tensor(
-            [(src, tgt) for src, tgt, _ in self.relations],
-            dtype=torch.long
-        ).t().contiguous()
-        edge_attr = [relation for _, _, relation in self.relations]
+        # Copy out of the array buffers so later appends are not blocked by exported views.
+        src = np.frombuffer(self._src, dtype=np.int64)
+        tgt = np.frombuffer(self._tgt, dtype=np.int64)
+        edge_index = torch.from_numpy(np.stack([src, tgt]))
+        codes = np.frombuffer(self._rel_codes, dtype=np.int32)
+        edge_type = torch.from_numpy(codes.astype(np.int64))
+        relation_names = list(self._rel_vocab)
+        edge_attr = [relation_names[c] for c in codes.tolist()]
         num_nodes = len(self.nodes)
-        # Create feature matrix using computed embeddings.
-        x = torch.stack([torch.tensor(self.embeddings[i], dtype=torch.float) for i in range(num_nodes)])
+        # Create feature matrix using computed embeddings, filled by node id.
+        dim = len(next(iter(self.embeddings.values())))
+        features = np.empty((num_nodes, dim), dtype=np.float32)
+        for i, emb in self.embeddings.items():
+            features[i] = emb
+        x = torch.from_numpy(features)
         metadata = {
             node_data["id"]: {
                 "entity": node_data["entity"],
@@ -170,7 +328,10 @@ class KnowledgeGraphDataset:
             }
             for node_data in self.nodes.values()
         }
-        return Data(x=x, edge_index=edge_index, edge_attr=edge_attr, metadata=metadata)
+        return Data(
+            x=x, edge_index=edge_index, edge_attr=edge_attr, edge_type=edge_type,
+            relation_names=relation_names, metadata=metadata
+        )
 
     def save_as_gml(self, output_path):
         """
@@ -182,11 +343,16 @@ class KnowledgeGraphDataset:
 if __name__ == "__main__":
     import argparse
 
+    # CPU encode threads; override with the KG_THREADS environment variable.
+    torch.set_num_threads(int(os.environ.get("KG_THREADS", os.cpu_count())))
+    torch.set_num_interop_threads(1)
+
     parser = argparse.ArgumentParser(description="Construct a Knowledge Graph with Semantic Edges and Chroma Vector DB")
     parser.add_argument("--json_path", type=str, default="enriched_data_ner_relation.json", help="Path to the JSON data file")
     parser.add_argument("--output_gml", type=str, default="output_graph.gml", help="Path to output GML file")
     parser.add_argument("--semantic_threshold", type=float, default=0.8, help="Threshold for semantic similarity edge creation")
     parser.add_argument("--embedding_model", type=str, default="all-MiniLM-L6-v2", help="SentenceTransformer embedding model name")
+    parser.add_argument("--embedding_cache", type=str, default="emb_cache.npy", help="Path to the on-disk embedding cache (.npy)")
     args = parser.parse_args()
 
     # Initialize the dataset and construct the initial graph
@@ -198,7 +364,7 @@ if __name__ == "__main__":
     kg_dataset.construct_graph()
     
     # Compute node embeddings and store them in the vector DB
-    kg_dataset.compute_node_embeddings()
+    kg_dataset.compute_node_embeddings(cache_path=args.embedding_cache)
     
     # Add additional semantic edges based on embedding similarity
     kg_dataset.add_semantic_edges()
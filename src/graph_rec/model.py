@@ -8,205 +8,254 @@ incorporates edge weights during message passing.
 
 import torch
 import torch.nn as nn
-from torch_scatter import scatter_add
 from torch_geometric.utils import degree
 
-class LightGCN(nn.Module):
+def adj_coefficients(edge_index, num_nodes, edge_weight=None, dtype=torch.float):
     """
-    Standard LightGCN model for backward compatibility with existing code.
+    Compute the symmetric-normalized coefficient of every edge.
+    
+    Args:
+        edge_index: Tensor of shape [2, num_edges] with source and target nodes
+        num_nodes: Number of nodes
+        edge_weight: Optional tensor of shape [num_edges] with edge weights
+        dtype: Floating point dtype of the coefficients
+        
+    Returns:
+        Tensor of shape [num_edges] with deg(src)^-1/2 * deg(dst)^-1/2 * weight
     """
-    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3):
-        super().__init__()
-        self.num_users = num_users
-        self.num_items = num_items
-        self.num_nodes = num_users + num_items
-        self.embed_dim = embed_dim
-        self.num_layers = num_layers
-        self.embeddings = nn.Embedding(self.num_nodes, embed_dim)
-        nn.init.xavier_uniform_(self.embeddings.weight)
+    row, col = edge_index
+    deg = degree(row, num_nodes, dtype=dtype)
+    # rsqrt, with nodes without outgoing edges (deg 0) mapped to 0 instead of inf. Those
+    # nodes can still be edge targets, so clamping deg to 1 would change their coefficients
+    deg_sqrt_inv = deg.rsqrt_().nan_to_num_(posinf=0.0)
     
-    def forward(self, edge_index, edge_weight=None):
-        x0 = self.embeddings.weight  # [N, d]
-        row, col = edge_index
-        deg = degree(row, x0.size(0), dtype=x0.dtype)
-        deg_sqrt_inv = torch.pow(deg, -0.5)
-        deg_sqrt_inv[deg_sqrt_inv == float('inf')] = 0
+    norm = deg_sqrt_inv[row] * deg_sqrt_inv[col]
+    if edge_weight is not None:
+        norm = norm * edge_weight
+    return norm
+
+def normalized_adjacency(edge_index, num_nodes, edge_weight=None, dtype=torch.float, coeff=None):
+    """
+    Build the normalized propagation matrix as a sparse CSR tensor.
+    
+    Entry (dst, src) sums the coefficients of the edges src -> dst, so one sparse
+    matmul aggregates every node's incoming messages without materializing a
+    [num_edges, embed_dim] message tensor.
+    
+    Args:
+        edge_index: Tensor of shape [2, num_edges] with source and target nodes
+        num_nodes: Number of nodes
+        edge_weight: Optional tensor of shape [num_edges] with edge weights
+        dtype: Floating point dtype of the matrix
+        coeff: Optional precomputed adj_coefficients of the edges
         
-        H_l = x0
-        out = x0 / (self.num_layers + 1)
-        for _ in range(self.num_layers):
-            # If edge_weight is provided, incorporate it.
-            if edge_weight is not None:
-                norm = deg_sqrt_inv[row] * deg_sqrt_inv[col] * edge_weight
-            else:
-                norm = deg_sqrt_inv[row] * deg_sqrt_inv[col]
-            msg = H_l[row] * norm.view(-1, 1)
-            H_next = scatter_add(msg, col, dim=0, dim_size=x0.size(0))
-            H_l = H_next
-            out += H_l / (self.num_layers + 1)
-        return out
+    Returns:
+        Sparse CSR tensor of shape [num_nodes, num_nodes]
+    """
+    row, col = edge_index
+    norm = coeff if coeff is not None else adj_coefficients(edge_index, num_nodes, edge_weight, dtype=dtype)
+    adj = torch.sparse_coo_tensor(torch.stack([col, row]), norm.detach(), (num_nodes, num_nodes), check_invariants=False)
+    return adj.coalesce().to_sparse_csr()
+
+def propagation_operator(edge_index, num_nodes, edge_weight=None, dtype=torch.float, coeff=None):
+    """
+    Normalized propagation operator for the device of edge_index.
     
-    def recommend(self, user_ids, edge_index, edge_weight=None, top_k=10):
-        all_emb = self.forward(edge_index, edge_weight)
-        user_emb = all_emb[user_ids]
-        item_emb = all_emb[self.num_users:]
-        scores = torch.matmul(user_emb, item_emb.t())
-        _, topk_indices = torch.topk(scores, top_k, dim=1)
-        return topk_indices
+    A sparse CSR matrix (see normalized_adjacency) everywhere except on XLA, which has
+    no sparse matmul; there the (row, col, coefficient) edge list is returned instead.
+    """
+    if coeff is None:
+        coeff = adj_coefficients(edge_index, num_nodes, edge_weight, dtype=dtype)
+    if edge_index.device.type == "xla":
+        row, col = edge_index
+        return row, col, coeff.detach()
+    return normalized_adjacency(edge_index, num_nodes, edge_weight, dtype=dtype, coeff=coeff)
 
+def propagate(op, H, bias=None):
+    """
+    One propagation step, op @ H (+ bias), for an operator from propagation_operator.
+    
+    With a bias the sparse matmul and the add run as one addmm. The XLA edge-list form
+    aggregates with index_add_, which reduces over a 1-D index, instead of a scatter
+    that broadcasts the index to [num_edges, embed_dim].
+    """
+    if isinstance(op, tuple):
+        row, col, coeff = op
+        base = H.new_zeros(H.shape) if bias is None else bias.clone()
+        return base.index_add_(0, col, H[row] * coeff.unsqueeze(1))
+    if bias is not None:
+        return torch.addmm(bias, op, H)
+    return torch.sparse.mm(op, H)
 
-class EnhancedLightGCN(nn.Module):
+def graph_key(*tensors):
     """
-    Enhanced LightGCN model with edge type embeddings and improved message passing.
+    Cache key for a set of graph tensors: their identity plus their in-place version counter.
+    
+    A cached adjacency stays valid while the same tensor objects are passed and none of
+    them has been modified in place (e.g. edge weights updated between epochs).
     """
-    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3, num_edge_types=3):
-        super().__init__()
-        self.num_users = num_users
-        self.num_items = num_items
-        self.num_nodes = num_users + num_items
-        self.embed_dim = embed_dim
-        self.num_layers = num_layers
-        self.num_edge_types = num_edge_types
-        
-        # Node embeddings
-        self.embeddings = nn.Embedding(self.num_nodes, embed_dim)
-        
-        # Edge type embeddings (0: purchase, 1: co-occurrence, 2: other custom edges)
-        self.edge_type_emb = nn.Embedding(num_edge_types, embed_dim)
-        
-        # Initialize weights
-        nn.init.xavier_uniform_(self.embeddings.weight)
-        nn.init.xavier_uniform_(self.edge_type_emb.weight)
+    return tuple((t, None if t is None else t._version) for t in tensors)
+
+def same_graph_key(key, other):
+    """Compare two graph_key results by tensor identity and version."""
+    return key is not None and all(a is b and va == vb for (a, va), (b, vb) in zip(key, other))
+
+def chunked_item_topk(user_emb, item_emb, top_k, chunk_size=8192):
+    """
+    Top-k item indices per user, scoring the catalogue one item chunk at a time.
     
-    def forward(self, edge_index, edge_weight=None, edge_type=None):
-        """
-        Forward pass for the enhanced LightGCN model.
-        
-        Args:
-            edge_index: Tensor of shape [2, num_edges] with source and target nodes
-            edge_weight: Optional tensor of shape [num_edges] with edge weights
-            edge_type: Optional tensor of shape [num_edges] with edge type indices
-            
-        Returns:
-            Tensor of shape [num_nodes, embed_dim] with node embeddings
-        """
-        x0 = self.embeddings.weight  # [N, d]
-        row, col = edge_index
-        deg = degree(row, x0.size(0), dtype=x0.dtype)
-        deg_sqrt_inv = torch.pow(deg, -0.5)
-        deg_sqrt_inv[deg_sqrt_inv == float('inf')] = 0
-        
-        H_l = x0
-        out = x0 / (self.num_layers + 1)
-        
-        for _ in range(self.num_layers):
-            # Prepare messages
-            if edge_type is not None:
-                # Include edge type influence
-                edge_influence = self.edge_type_emb(edge_type)
-                msg = H_l[row] + edge_influence * 0.1  # Scale down edge type influence
-            else:
-                msg = H_l[row]
-            
-            # Apply edge weights if provided
-            if edge_weight is not None:
-                msg = msg * edge_weight.view(-1, 1)
-            
-            # Apply graph normalization
-            norm = deg_sqrt_inv[row] * deg_sqrt_inv[col]
-            msg = msg * norm.view(-1, 1)
-            
-            # Aggregate messages
-            H_next = scatter_add(msg, col, dim=0, dim_size=x0.size(0))
-            H_l = H_next
-            out += H_l / (self.num_layers + 1)
-            
-        return out
+    Each chunk's scores are merged into a running top-k, so peak score memory is
+    [num_users, chunk_size + top_k] instead of [num_users, num_items].
     
-    def recommend(self, user_ids, edge_index, edge_weight=None, edge_type=None, top_k=10):
-        """
-        Generate top-k recommendations for given users.
+    Args:
+        user_emb: Tensor of shape [U, d]
+        item_emb: Tensor of shape [I, d]
+        top_k: Number of items to keep per user
+        chunk_size: Number of items scored per matmul
         
-        Args:
-            user_ids: Tensor of user indices
-            edge_index: Graph edge indices
-            edge_weight: Optional edge weights
-            edge_type: Optional edge types
-            top_k: Number of recommendations to generate
-            
-        Returns:
-            Tensor of shape [len(user_ids), top_k] with recommended item indices
-        """
-        all_emb = self.forward(edge_index, edge_weight, edge_type)
-        user_emb = all_emb[user_ids]
-        item_emb = all_emb[self.num_users:]
-        scores = torch.matmul(user_emb, item_emb.t())
-        _, topk_indices = torch.topk(scores, top_k, dim=1)
-        return topk_indices
+    Returns:
+        Tensor of shape [U, min(top_k, I)] with item indices, best first
+    """
+    num_items = item_emb.size(0)
+    k = min(top_k, num_items)
+    top_vals, top_idx = None, None
+    for start in range(0, num_items, chunk_size):
+        scores = torch.matmul(user_emb, item_emb[start:start + chunk_size].t())
+        idx = torch.arange(start, start + scores.size(1), device=scores.device).expand_as(scores)
+        if top_vals is not None:
+            scores = torch.cat([top_vals, scores], dim=1)
+            idx = torch.cat([top_idx, idx], dim=1)
+        top_vals, pos = torch.topk(scores, k=min(k, scores.size(1)), dim=1)
+        top_idx = torch.gather(idx, 1, pos)
+    return top_idx
 
+def propagation_dtype(model, x0):
+    """
+    Dtype the layers are propagated in: model.propagation_dtype (e.g. bfloat16) for
+    inference on CUDA when set, otherwise the embedding dtype.
+    
+    Propagation is linear, so low-precision activations are safe; the layer average is
+    still accumulated in the embedding dtype. CPU sparse CSR matmul has no bfloat16 kernel.
+    """
+    dtype = getattr(model, "propagation_dtype", None)
+    if dtype is None or model.training or x0.device.type != "cuda":
+        return x0.dtype
+    return dtype
 
-"""
-model.py
+def layer_sum(op, x0, dtype, num_layers, bias=None):
+    """
+    Average of x0 and its num_layers propagations by op (see propagate).
+    
+    Layers are propagated in dtype and summed in the dtype of x0, scaled once at the end.
+    The running in-place sum needs one add kernel and no extra buffer per layer, unlike
+    stacking all layers for a single reduction.
+    """
+    H_l = x0.to(dtype)
+    out = x0.clone()
+    for _ in range(num_layers):
+        H_l = propagate(op, H_l, bias=bias)
+        # add_ promotes a low-precision H_l into out directly, without a cast copy
+        out.add_(H_l)
+    return out.mul_(1.0 / (num_layers + 1))
 
-Enhanced LightGCN model that supports edge weights, edge types, and heterogeneous graphs.
-This model can handle different types of edges (purchases, co-occurrences, etc.) and
-incorporates edge weights during message passing.
-"""
+def capture_layer_sum(op, x0, dtype, num_layers, bias=None):
+    """
+    Capture layer_sum in a CUDA graph, so later calls replay all its kernels with one launch.
+    
+    The graph reads x0 and bias from static copies and writes to a static output, so the
+    returned function copies its inputs in, replays, and returns a clone of the output.
+    op is baked into the graph and must stay alive and unchanged while it is replayed.
+    
+    Returns:
+        Function (x0, bias=None) -> layer_sum(op, x0, dtype, num_layers, bias)
+    """
+    static_x0 = x0.detach().clone()
+    static_bias = None if bias is None else bias.detach().clone()
+    # Warm up on a side stream so lazy initialization (e.g. cuSPARSE handles) is not captured
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(2):
+            layer_sum(op, static_x0, dtype, num_layers, static_bias)
+    torch.cuda.current_stream().wait_stream(stream)
+    
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_out = layer_sum(op, static_x0, dtype, num_layers, static_bias)
+    
+    def replay(x0, bias=None):
+        static_x0.copy_(x0)
+        if static_bias is not None:
+            static_bias.copy_(bias)
+        graph.replay()
+        return static_out.clone()
+    return replay
 
-import torch
-import torch.nn as nn
-from torch_scatter import scatter_add
-from torch_geometric.utils import degree
+def run_layers(model, op, x0, dtype, bias=None):
+    """
+    layer_sum for a LightGCN model, replayed from a CUDA graph when model.cuda_graph is set.
+    
+    Graphs are only used without autograd (e.g. evaluation or a no_grad propagation refresh),
+    and are recaptured whenever the model's cached operator is rebuilt or autocast is toggled
+    (the captured kernels are fixed to the autocast state at capture time).
+    """
+    if not (getattr(model, "cuda_graph", False) and x0.device.type == "cuda" and not torch.is_grad_enabled()):
+        return layer_sum(op, x0, dtype, model.num_layers, bias)
+    autocast = torch.is_autocast_enabled()
+    cache = model._graph_cache
+    if cache is None or cache[0] is not model._adj_cache or cache[1] != autocast:
+        cache = (model._adj_cache, autocast, capture_layer_sum(op, x0, dtype, model.num_layers, bias))
+        model._graph_cache = cache
+    return cache[2](x0, bias)
 
 class LightGCN(nn.Module):
     """
     Standard LightGCN model for backward compatibility with existing code.
     """
-    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3):
+    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3, sparse=False):
         super().__init__()
         self.num_users = num_users
         self.num_items = num_items
         self.num_nodes = num_users + num_items
         self.embed_dim = embed_dim
         self.num_layers = num_layers
-        self.embeddings = nn.Embedding(self.num_nodes, embed_dim)
+        # sparse=True gives row-sparse gradients to lookups (for SparseAdam); see train.cached_bpr_step
+        self.embeddings = nn.Embedding(self.num_nodes, embed_dim, sparse=sparse)
         nn.init.xavier_uniform_(self.embeddings.weight)
     
+        self._adj_cache = None
+        # Optional reduced-precision dtype for inference propagation (see propagation_dtype)
+        self.propagation_dtype = None
+        # Replay gradient-free propagation from a captured CUDA graph (see run_layers)
+        self.cuda_graph = False
+        self._graph_cache = None
+    
     def forward(self, edge_index, edge_weight=None):
         x0 = self.embeddings.weight  # [N, d]
-        row, col = edge_index
-        deg = degree(row, x0.size(0), dtype=x0.dtype)
-        deg_sqrt_inv = torch.pow(deg, -0.5)
-        deg_sqrt_inv[deg_sqrt_inv == float('inf')] = 0
+        dtype = propagation_dtype(self, x0)
+        # Edge weights are folded into the cached normalized adjacency
+        key = graph_key(edge_index, edge_weight)
+        if self._adj_cache is None or not same_graph_key(self._adj_cache[0], key) or self._adj_cache[1] != dtype:
+            coeff = adj_coefficients(edge_index, x0.size(0), edge_weight, dtype=x0.dtype).to(dtype)
+            adj = propagation_operator(edge_index, x0.size(0), edge_weight, dtype=dtype, coeff=coeff)
+            self._adj_cache = (key, dtype, adj)
+        adj = self._adj_cache[2]
         
-        H_l = x0
-        out = x0 / (self.num_layers + 1)
-        for _ in range(self.num_layers):
-            # If edge_weight is provided, incorporate it.
-            if edge_weight is not None:
-                norm = deg_sqrt_inv[row] * deg_sqrt_inv[col] * edge_weight
-            else:
-                norm = deg_sqrt_inv[row] * deg_sqrt_inv[col]
-            msg = H_l[row] * norm.view(-1, 1)
-            H_next = scatter_add(msg, col, dim=0, dim_size=x0.size(0))
-            H_l = H_next
-            out += H_l / (self.num_layers + 1)
-        return out
+        # Sum the layers and scale once at the end
+        return run_layers(self, adj, x0, dtype)
     
-    def recommend(self, user_ids, edge_index, edge_weight=None, top_k=10):
+    def recommend(self, user_ids, edge_index, edge_weight=None, top_k=10, item_chunk_size=8192):
         all_emb = self.forward(edge_index, edge_weight)
         user_emb = all_emb[user_ids]
         item_emb = all_emb[self.num_users:]
-        scores = torch.matmul(user_emb, item_emb.t())
-        _, topk_indices = torch.topk(scores, top_k, dim=1)
-        return topk_indices
+        return chunked_item_topk(user_emb, item_emb, top_k, chunk_size=item_chunk_size)
 
 
 class EnhancedLightGCN(nn.Module):
     """
     Enhanced LightGCN model with edge type embeddings and improved message passing.
     """
-    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3, num_edge_types=3):
+    def __init__(self, num_users, num_items, embed_dim=64, num_layers=3, num_edge_types=3, sparse=False):
         super().__init__()
         self.num_users = num_users
         self.num_items = num_items
@@ -215,8 +264,8 @@ class EnhancedLightGCN(nn.Module):
         self.num_layers = num_layers
         self.num_edge_types = num_edge_types
         
-        # Node embeddings
-        self.embeddings = nn.Embedding(self.num_nodes, embed_dim)
+        # Node embeddings; sparse=True gives row-sparse gradients to lookups (for SparseAdam)
+        self.embeddings = nn.Embedding(self.num_nodes, embed_dim, sparse=sparse)
         
         # Edge type embeddings (0: purchase, 1: co-occurrence, 2: other custom edges)
         self.edge_type_emb = nn.Embedding(num_edge_types, embed_dim)
@@ -224,6 +273,14 @@ class EnhancedLightGCN(nn.Module):
         # Initialize weights
         nn.init.xavier_uniform_(self.embeddings.weight)
         nn.init.xavier_uniform_(self.edge_type_emb.weight)
+        
+        # Normalized sparse adjacency, rebuilt only when the graph tensors change
+        self._adj_cache = None
+        # Optional reduced-precision dtype for inference propagation (see propagation_dtype)
+        self.propagation_dtype = None
+        # Replay gradient-free propagation from a captured CUDA graph (see run_layers)
+        self.cuda_graph = False
+        self._graph_cache = None
     
     def forward(self, edge_index, edge_weight=None, edge_type=None):
         """
@@ -238,39 +295,35 @@ class EnhancedLightGCN(nn.Module):
             Tensor of shape [num_nodes, embed_dim] with node embeddings
         """
         x0 = self.embeddings.weight  # [N, d]
-        row, col = edge_index
-        deg = degree(row, x0.size(0), dtype=x0.dtype)
-        deg_sqrt_inv = torch.pow(deg, -0.5)
-        deg_sqrt_inv[deg_sqrt_inv == float('inf')] = 0
+        dtype = propagation_dtype(self, x0)
+        # Edge weights and normalization are folded into the cached sparse adjacency
+        key = graph_key(edge_index, edge_weight, edge_type)
+        if self._adj_cache is None or not same_graph_key(self._adj_cache[0], key) or self._adj_cache[1] != dtype:
+            # Edge coefficients are computed once and shared by the adjacency and the type term
+            coeff = adj_coefficients(edge_index, x0.size(0), edge_weight, dtype=x0.dtype)
+            adj = propagation_operator(edge_index, x0.size(0), edge_weight, dtype=dtype, coeff=coeff.to(dtype))
+            type_agg = None
+            if edge_type is not None:
+                # Per node, the summed coefficients of incoming edges of each type, as one
+                # weighted bincount over (node, type) cells instead of an atomic scatter
+                cell = edge_index[1] * self.num_edge_types + edge_type
+                type_agg = torch.bincount(cell, weights=coeff.detach(), minlength=x0.size(0) * self.num_edge_types)
+                # The 0.1 scale of the edge type influence is folded in here, once per graph
+                type_agg = (type_agg * 0.1).view(x0.size(0), self.num_edge_types).to(x0.dtype)
+            self._adj_cache = (key, dtype, adj, type_agg)
+        adj, type_agg = self._adj_cache[2], self._adj_cache[3]
         
-        H_l = x0
-        out = x0 / (self.num_layers + 1)
+        # The edge type term of every message is independent of H_l, so its
+        # aggregate is the same in every layer
+        type_msg = None
+        if type_agg is not None:
+            type_msg = torch.matmul(type_agg, self.edge_type_emb.weight).to(dtype)  # Pre-scaled by 0.1
         
-        for _ in range(self.num_layers):
-            # Prepare messages
-            if edge_type is not None:
-                # Include edge type influence
-                edge_influence = self.edge_type_emb(edge_type)
-                msg = H_l[row] + edge_influence * 0.1  # Scale down edge type influence
-            else:
-                msg = H_l[row]
-            
-            # Apply edge weights if provided
-            if edge_weight is not None:
-                msg = msg * edge_weight.view(-1, 1)
-            
-            # Apply graph normalization
-            norm = deg_sqrt_inv[row] * deg_sqrt_inv[col]
-            msg = msg * norm.view(-1, 1)
-            
-            # Aggregate messages
-            H_next = scatter_add(msg, col, dim=0, dim_size=x0.size(0))
-            H_l = H_next
-            out += H_l / (self.num_layers + 1)
-            
-        return out
+        # Sum the layers and scale once at the end; each layer aggregates messages and adds
+        # the edge type term with one sparse addmm (index_add_ on XLA) instead of per-edge copies
+        return run_layers(self, adj, x0, dtype, bias=type_msg)
     
-    def recommend(self, user_ids, edge_index, edge_weight=None, edge_type=None, top_k=10):
+    def recommend(self, user_ids, edge_index, edge_weight=None, edge_type=None, top_k=10, item_chunk_size=8192):
         """
         Generate top-k recommendations for given users.
         
@@ -280,6 +333,7 @@ class EnhancedLightGCN(nn.Module):
             edge_weight: Optional edge weights
             edge_type: Optional edge types
             top_k: Number of recommendations to generate
+            item_chunk_size: Number of items scored at a time (bounds score memory)
             
         Returns:
             Tensor of shape [len(user_ids), top_k] with recommended item indices
@@ -287,9 +341,7 @@ class EnhancedLightGCN(nn.Module):
         all_emb = self.forward(edge_index, edge_weight, edge_type)
         user_emb = all_emb[user_ids]
         item_emb = all_emb[self.num_users:]
-        scores = torch.matmul(user_emb, item_emb.t())
-        _, topk_indices = torch.topk(scores, top_k, dim=1)
-        return topk_indices
+        return chunked_item_topk(user_emb, item_emb, top_k, chunk_size=item_chunk_size)
 
 
 if __name__ == "__main__":
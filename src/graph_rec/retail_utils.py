@@ -11,6 +11,7 @@ from collections import defaultdict
 import datetime
 import torch
 import random
+from numba import njit, prange
 
 def preprocess_retail_data(df):
     """
@@ -22,29 +23,31 @@ def preprocess_retail_data(df):
     Returns:
         pd.DataFrame: Cleaned and preprocessed data
     """
-    # Make a copy to avoid modifying the original
-    df = df.copy()
+    # Filter out returns and canceled orders (negative quantities) and
+    # remove missing customer IDs for user-item interactions
+    unit_price = df['UnitPrice'].to_numpy()
+    mask = (df['Quantity'].to_numpy() > 0) & df['CustomerID'].notna().to_numpy()
     
-    # Convert data types
-    df['InvoiceDate'] = pd.to_datetime(df['InvoiceDate'])
+    # Remove outliers (optional), with quantiles taken over the valid rows only
+    q1, q3 = np.nanquantile(unit_price[mask], [0.01, 0.99])
+    mask &= (unit_price >= q1) & (unit_price <= q3)
     
-    # Filter out returns and canceled orders (negative quantities)
-    df = df[df['Quantity'] > 0]
+    # Single selection; the result is a new frame so the caller's data is untouched
+    df = df.loc[mask].copy()
     
-    # Remove missing customer IDs for user-item interactions
-    df = df.dropna(subset=['CustomerID'])
+    # Convert data types
+    df['InvoiceDate'] = pd.to_datetime(df['InvoiceDate'], cache=True)
     
     # Convert CustomerID to integer if it's not already
     df['CustomerID'] = df['CustomerID'].astype(int)
     
+    # Store ID-like columns as categoricals so downstream groupbys hash integer codes
+    for col in ['StockCode', 'CustomerID', 'Country']:
+        df[col] = df[col].astype('category')
+    
     # Calculate total value per transaction
     df['TotalValue'] = df['Quantity'] * df['UnitPrice']
     
-    # Remove outliers (optional)
-    q1 = df['UnitPrice'].quantile(0.01)
-    q3 = df['UnitPrice'].quantile(0.99)
-    df = df[(df['UnitPrice'] >= q1) & (df['UnitPrice'] <= q3)]
-    
     return df
 
 def create_product_id_mapping(df):
@@ -57,25 +60,24 @@ def create_product_id_mapping(df):
     Returns:
         dict: Mapping from product ID to index
         dict: Reverse mapping from index to product ID
-        list: List of product details for each index
+        dict: Product details as columns (StockCode, Description, AvgPrice), one entry per index
     """
     # Get unique products
     products = df[['StockCode', 'Description', 'UnitPrice']].drop_duplicates()
-    products['AvgPrice'] = products.groupby('StockCode')['UnitPrice'].transform('mean')
+    products['AvgPrice'] = products.groupby('StockCode', observed=True)['UnitPrice'].transform('mean')
     
     # Create forward and reverse mappings
     product_ids = products['StockCode'].unique()
     product_to_idx = {pid: idx for idx, pid in enumerate(product_ids)}
     idx_to_product = {idx: pid for pid, idx in product_to_idx.items()}
     
-    # Create product details dictionary
-    product_details = []
-    for _, row in products.drop_duplicates('StockCode').iterrows():
-        product_details.append({
-            'StockCode': row['StockCode'],
-            'Description': row['Description'],
-            'AvgPrice': row['AvgPrice']
-        })
+    # Create product details as column arrays
+    unique_products = products.drop_duplicates('StockCode')
+    product_details = {
+        'StockCode': unique_products['StockCode'].to_numpy(),
+        'Description': unique_products['Description'].to_numpy(),
+        'AvgPrice': unique_products['AvgPrice'].to_numpy(dtype=np.float32)
+    }
     
     return product_to_idx, idx_to_product, product_details
 
@@ -89,7 +91,7 @@ def create_customer_id_mapping(df):
     Returns:
         dict: Mapping from customer ID to index
         dict: Reverse mapping from index to customer ID
-        list: List of customer details for each index
+        dict: Customer details as columns (CustomerID, Country)
     """
     # Get unique customers
     customers = df[['CustomerID', 'Country']].drop_duplicates()
@@ -99,32 +101,32 @@ def create_customer_id_mapping(df):
     customer_to_idx = {cid: idx for idx, cid in enumerate(customer_ids)}
     idx_to_customer = {idx: cid for cid, idx in customer_to_idx.items()}
     
-    # Create customer details with country information
-    customer_details = []
-    for _, row in customers.iterrows():
-        customer_details.append({
-            'CustomerID': row['CustomerID'],
-            'Country': row['Country']
-        })
+    # Create customer details with country information as column arrays
+    customer_details = {
+        'CustomerID': customers['CustomerID'].to_numpy(),
+        'Country': customers['Country'].to_numpy()
+    }
     
     return customer_to_idx, idx_to_customer, customer_details
 
-def compute_rfm_features(df, customer_ids):
+def compute_rfm_features(df, customer_ids, latest_date=None):
     """
     Compute RFM (Recency, Frequency, Monetary) features for customers.
     
     Args:
         df (pd.DataFrame): Retail transaction data
         customer_ids (list): List of customer IDs to compute features for
+        latest_date (pd.Timestamp, optional): Reference date. If None, uses max date
         
     Returns:
         torch.Tensor: Tensor of RFM features for each customer
     """
     # Get the latest date in the dataset
-    latest_date = df['InvoiceDate'].max()
+    if latest_date is None:
+        latest_date = df['InvoiceDate'].max()
     
     # Group by customer
-    customer_stats = df.groupby('CustomerID').agg({
+    customer_stats = df.groupby('CustomerID', observed=True).agg({
         'InvoiceDate': lambda x: (latest_date - x.max()).days,  # Recency
         'InvoiceNo': 'nunique',                                 # Frequency
         'TotalValue': 'sum'                                     # Monetary
@@ -145,21 +147,14 @@ def compute_rfm_features(df, customer_ids):
     # Invert recency (lower is better)
     customer_stats['Recency'] = 1 - customer_stats['Recency']
     
-    # Create feature tensor
-    features = []
-    for cid in customer_ids:
-        if cid in customer_stats['CustomerID'].values:
-            cust_info = customer_stats[customer_stats['CustomerID'] == cid].iloc[0]
-            feature = [
-                float(cust_info['Recency']),
-                float(cust_info['Frequency']),
-                float(cust_info['Monetary'])
-            ]
-        else:
-            feature = [0.0, 0.0, 0.0]
-        features.append(feature)
+    # Create feature tensor (customers without transactions get zeros)
+    stats_values = customer_stats[['Recency', 'Frequency', 'Monetary']].to_numpy(dtype=np.float32)
+    positions = pd.Index(np.asarray(customer_stats['CustomerID'])).get_indexer(customer_ids)
+    features = np.zeros((len(customer_ids), 3), dtype=np.float32)
+    found = positions >= 0
+    features[found] = stats_values[positions[found]]
     
-    return torch.tensor(features, dtype=torch.float)
+    return _host_tensor(features, np.float32)
 
 def compute_product_features(df, product_ids):
     """
@@ -173,7 +168,7 @@ def compute_product_features(df, product_ids):
         torch.Tensor: Tensor of product features
     """
     # Group by product
-    product_stats = df.groupby('StockCode').agg({
+    product_stats = df.groupby('StockCode', observed=True).agg({
         'Quantity': 'sum',                # Total quantity sold
         'UnitPrice': 'mean',              # Average price
         'CustomerID': 'nunique',          # Number of unique customers
@@ -192,24 +187,17 @@ def compute_product_features(df, product_ids):
         else:
             product_stats[col] = 0
     
-    # Create feature tensor
-    features = []
-    for pid in product_ids:
-        if pid in product_stats['StockCode'].values:
-            prod_info = product_stats[product_stats['StockCode'] == pid].iloc[0]
-            feature = [
-                float(prod_info['Popularity']),
-                float(prod_info['Price']),
-                float(prod_info['CustomerDiversity']),
-                float(prod_info['GeoDiversity'])
-            ]
-        else:
-            feature = [0.0, 0.0, 0.0, 0.0]
-        features.append(feature)
+    # Create feature tensor (products without transactions get zeros)
+    feature_cols = ['Popularity', 'Price', 'CustomerDiversity', 'GeoDiversity']
+    stats_values = product_stats[feature_cols].to_numpy(dtype=np.float32)
+    positions = pd.Index(np.asarray(product_stats['StockCode'])).get_indexer(product_ids)
+    features = np.zeros((len(product_ids), len(feature_cols)), dtype=np.float32)
+    found = positions >= 0
+    features[found] = stats_values[positions[found]]
     
-    return torch.tensor(features, dtype=torch.float)
+    return _host_tensor(features, np.float32)
 
-def create_transaction_edges(df, customer_to_idx, product_to_idx, time_decay_rate=0.005):
+def create_transaction_edges(df, customer_to_idx, product_to_idx, time_decay_rate=0.005, latest_date=None):
     """
     Create transaction edges between customers and products with time decay weights.
     
@@ -218,42 +206,131 @@ def create_transaction_edges(df, customer_to_idx, product_to_idx, time_decay_rat
         customer_to_idx (dict): Mapping from customer ID to index
         product_to_idx (dict): Mapping from product ID to index
         time_decay_rate (float): Rate for exponential time decay
+        latest_date (pd.Timestamp, optional): Reference date. If None, uses max date
         
     Returns:
         torch.Tensor: Edge index tensor
         torch.Tensor: Edge weight tensor
     """
     # Get the latest date in the dataset
-    latest_date = df['InvoiceDate'].max()
+    if latest_date is None:
+        latest_date = df['InvoiceDate'].max()
     
-    cust_src, prod_dst, weights = [], [], []
+    # Get indices, dropping rows whose customer or product has no index
+    cust_src = _map_ids(df['CustomerID'], customer_to_idx)
+    prod_dst = _map_ids(df['StockCode'], product_to_idx)
+    valid = (cust_src >= 0) & (prod_dst >= 0)
     
-    for _, row in df.iterrows():
-        cid = row['CustomerID']
-        pid = row['StockCode']
-        
-        if cid in customer_to_idx and pid in product_to_idx:
-            # Get indices
-            cust_idx = customer_to_idx[cid]
-            prod_idx = product_to_idx[pid]
-            
-            # Calculate time decay weight
-            days_diff = (latest_date - row['InvoiceDate']).days
-            time_weight = np.exp(-time_decay_rate * days_diff)
-            
-            # Multiply by quantity for weighted importance
-            weight = time_weight * row['Quantity']
-            
-            cust_src.append(cust_idx)
-            prod_dst.append(prod_idx)
-            weights.append(float(weight))
+    # Calculate time decay weight
+    days_diff = (latest_date - df['InvoiceDate']).dt.days.to_numpy()[valid]
+    time_weight = np.exp(-time_decay_rate * days_diff)
+    
+    # Multiply by quantity for weighted importance
+    weights = time_weight * df['Quantity'].to_numpy()[valid]
     
     # Create edge index tensor
-    edge_index = torch.tensor([cust_src, prod_dst], dtype=torch.long)
-    edge_weight = torch.tensor(weights, dtype=torch.float)
+    edge_index = torch.from_numpy(np.stack([cust_src[valid], prod_dst[valid]]))
+    edge_weight = torch.from_numpy(weights.astype(np.float32))
     
     return edge_index, edge_weight
 
+def _host_tensor(array, dtype):
+    """
+    Wrap a NumPy array as a CPU tensor, pinned when CUDA is available so it
+    can be copied to the GPU with non_blocking=True.
+    
+    Args:
+        array (np.ndarray): Source array
+        dtype (np.dtype): Target dtype
+        
+    Returns:
+        torch.Tensor: CPU tensor sharing memory with the converted array
+    """
+    tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=dtype))
+    if torch.cuda.is_available():
+        tensor = tensor.pin_memory()
+    return tensor
+
+def _map_ids(ids, id_to_idx):
+    """
+    Map a column of raw IDs to indices, using -1 for IDs without an index.
+    
+    Args:
+        ids (pd.Series): Raw ID values
+        id_to_idx (dict): Mapping from ID to index
+        
+    Returns:
+        np.ndarray: int64 array of indices
+    """
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        # Hash each category once, then gather per row through the integer codes
+        lookup = pd.Series(ids.cat.categories).map(id_to_idx).fillna(-1).to_numpy(dtype=np.int64)
+        codes = ids.cat.codes.to_numpy()
+        return np.where(codes >= 0, lookup[codes], -1)
+    return pd.Series(np.asarray(ids)).map(id_to_idx).fillna(-1).to_numpy(dtype=np.int64)
+
+def _group_members(keys, values):
+    """
+    Group values by key into CSR form, keeping the original order inside each group.
+    
+    Args:
+        keys (pd.Series): Group key for each value
+        values (np.ndarray): int64 values to group
+        
+    Returns:
+        np.ndarray: Group offsets (indptr), length num_groups + 1
+        np.ndarray: Values ordered by group
+    """
+    group_ids, _ = pd.factorize(keys, sort=True)
+    order = np.argsort(group_ids, kind='stable')
+    indptr = np.zeros(group_ids.max() + 2 if len(group_ids) else 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(group_ids))
+    return indptr, np.ascontiguousarray(values[order], dtype=np.int64)
+
+@njit(parallel=True, cache=True)
+def _group_pairs(indptr, members, window):
+    """
+    Emit (src, dst) pairs between members of the same group, in parallel over groups.
+    
+    Each member is paired with the following window - 1 members of its group,
+    or with all following members when window <= 0.
+    
+    Args:
+        indptr (np.ndarray): Group offsets into members
+        members (np.ndarray): Group members ordered by group
+        window (int): Pairing window size (<= 0 for all pairs)
+        
+    Returns:
+        np.ndarray: Source members
+        np.ndarray: Destination members
+    """
+    num_groups = indptr.shape[0] - 1
+    counts = np.zeros(num_groups, dtype=np.int64)
+    for g in prange(num_groups):
+        start, end = indptr[g], indptr[g + 1]
+        total = 0
+        for i in range(start, end):
+            stop = end if window <= 0 else min(i + window, end)
+            total += max(stop - i - 1, 0)
+        counts[g] = total
+    
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    src = np.empty(offsets[-1], dtype=np.int64)
+    dst = np.empty(offsets[-1], dtype=np.int64)
+    
+    for g in prange(num_groups):
+        start, end = indptr[g], indptr[g + 1]
+        pos = offsets[g]
+        for i in range(start, end):
+            stop = end if window <= 0 else min(i + window, end)
+            for j in range(i + 1, stop):
+                src[pos] = members[i]
+                dst[pos] = members[j]
+                pos += 1
+    
+    return src, dst
+
 def create_market_basket_edges(df, product_to_idx, min_support=5):
     """
     Create market basket edges between products frequently bought together.
@@ -267,39 +344,31 @@ def create_market_basket_edges(df, product_to_idx, min_support=5):
         torch.Tensor: Edge index tensor
         torch.Tensor: Edge weight tensor
     """
-    # Group transactions by invoice
-    invoice_groups = df.groupby('InvoiceNo')
-    
-    # Count co-occurrences
-    cooccur = defaultdict(lambda: defaultdict(int))
-    
-    for _, group in invoice_groups:
-        # Get list of products in this transaction
-        products = list(set(group['StockCode']))
-        products = [p for p in products if p in product_to_idx]
-        
-        # Count pairwise co-occurrences
-        for i in range(len(products)):
-            for j in range(i+1, len(products)):
-                a, b = product_to_idx[products[i]], product_to_idx[products[j]]
-                cooccur[a][b] += 1
-                cooccur[b][a] += 1
+    # Distinct (invoice, product index) pairs, i.e. list(set(...)) per transaction
+    baskets = pd.DataFrame({
+        'InvoiceNo': df['InvoiceNo'].to_numpy(),
+        'item': _map_ids(df['StockCode'], product_to_idx)
+    })
+    baskets = baskets[(baskets['item'] >= 0) & baskets['InvoiceNo'].notna()].drop_duplicates()
+    indptr, members = _group_members(baskets['InvoiceNo'], baskets['item'].to_numpy())
+    
+    # Count pairwise co-occurrences on the undirected (min, max) pair key
+    src, dst = _group_pairs(indptr, members, 0)
+    num_products = len(product_to_idx)
+    pair_keys = np.minimum(src, dst) * num_products + np.maximum(src, dst)
+    pair_keys, counts = np.unique(pair_keys, return_counts=True)
     
     # Create edges above minimum support
-    src, dst, weights = [], [], []
-    for a, nbrs in cooccur.items():
-        for b, count in nbrs.items():
-            if count >= min_support:
-                src.append(a)
-                dst.append(b)
-                weights.append(float(count))
-    
-    if not src:  # No edges found
+    keep = counts >= min_support
+    if not keep.any():  # No edges found
         return None, None
     
-    # Create edge index tensor
-    edge_index = torch.tensor([src, dst], dtype=torch.long)
-    edge_weight = torch.tensor(weights, dtype=torch.float)
+    a, b = np.divmod(pair_keys[keep], num_products)
+    weights = counts[keep].astype(np.float32)
+    
+    # Create edge index tensor (both directions)
+    edge_index = torch.from_numpy(np.stack([np.concatenate([a, b]), np.concatenate([b, a])]))
+    edge_weight = torch.from_numpy(np.concatenate([weights, weights]))
     
     return edge_index, edge_weight
 
@@ -316,28 +385,23 @@ def create_country_edges(df, customer_to_idx):
     """
     # Get unique (customer, country) pairs
     customer_country = df[['CustomerID', 'Country']].drop_duplicates()
+    customers = _map_ids(customer_country['CustomerID'], customer_to_idx)
+    valid = (customers >= 0) & customer_country['Country'].notna().to_numpy()
     
     # Group by country
-    country_groups = customer_country.groupby('Country')
+    indptr, members = _group_members(customer_country['Country'][valid], customers[valid])
     
-    src, dst = [], []
-    for _, group in country_groups:
-        customers = [customer_to_idx[cid] for cid in group['CustomerID'] if cid in customer_to_idx]
-        
-        # Connect customers from the same country (limit to reasonable number)
-        for i in range(len(customers)):
-            for j in range(i+1, min(i+10, len(customers))):
-                src.append(customers[i])
-                dst.append(customers[j])
-                # Add reverse edge for undirected graph
-                src.append(customers[j])
-                dst.append(customers[i])
+    # Connect customers from the same country (limit to reasonable number)
+    src, dst = _group_pairs(indptr, members, 10)
     
-    if not src:  # No edges found
+    if len(src) == 0:  # No edges found
         return None
     
-    # Create edge index tensor
-    edge_index = torch.tensor([src, dst], dtype=torch.long)
+    # Create edge index tensor, interleaving each edge with its reverse for the undirected graph
+    edge_index = torch.from_numpy(np.stack([
+        np.column_stack([src, dst]).ravel(),
+        np.column_stack([dst, src]).ravel()
+    ]))
     
     return edge_index
 
@@ -355,14 +419,18 @@ def get_test_customers(df, customer_to_idx, product_to_idx, test_ratio=0.2, min_
     Returns:
         dict: Dictionary mapping customer indices to sets of product indices for testing
     """
-    # Filter customers with enough transactions
-    customer_counts = df.groupby('CustomerID').size()
-    eligible_customers = customer_counts[customer_counts >= min_transactions].index
+    # Filter customers with enough transactions (sorted by ID, as groupby().size() was, so the
+    # seeded draw below picks the same test customers)
+    customer_counts = df['CustomerID'].value_counts().sort_index()
+    eligible_customers = customer_counts.index[customer_counts.to_numpy() >= min_transactions]
     
     # Select test customers
     num_test = int(len(eligible_customers) * test_ratio)
     test_customers = np.random.choice(eligible_customers, size=num_test, replace=False)
     
+    # Products purchased by each customer, computed in a single pass
+    products_per_customer = df.groupby('CustomerID', observed=True)['StockCode'].unique()
+    
     # Create test set
     test_user_items = {}
     for cid in test_customers:
@@ -371,7 +439,7 @@ def get_test_customers(df, customer_to_idx, product_to_idx, test_ratio=0.2, min_
             
         user_idx = customer_to_idx[cid]
         # Get products this customer has purchased
-        products = df[df['CustomerID'] == cid]['StockCode'].unique()
+        products = products_per_customer.get(cid, [])
         product_indices = [product_to_idx[pid] for pid in products if pid in product_to_idx]
         
         if product_indices:
@@ -418,46 +486,187 @@ def create_user_item_dict(df, customer_to_idx, product_to_idx):
     """
     user_to_items = defaultdict(set)
     
-    for _, row in df.iterrows():
-        cid = row['CustomerID']
-        pid = row['StockCode']
-        
-        if cid in customer_to_idx and pid in product_to_idx:
-            user_idx = customer_to_idx[cid]
-            item_idx = product_to_idx[pid]
-            user_to_items[user_idx].add(item_idx)
+    user_idx = _map_ids(df['CustomerID'], customer_to_idx)
+    item_idx = _map_ids(df['StockCode'], product_to_idx)
+    valid = (user_idx >= 0) & (item_idx >= 0)
+    
+    for u, i in zip(user_idx[valid].tolist(), item_idx[valid].tolist()):
+        user_to_items[u].add(i)
     
     return user_to_items
 
-def sample_negatives(user_to_items, num_items, num_neg=5):
+@njit(parallel=True, cache=True)
+def _sample_negatives_kernel(indptr, pos_items, rows, num_items, num_neg, seed):
+    """
+    Draw num_neg distinct negatives per row by rejection sampling, in parallel over rows.
+    
+    Numba's per-thread RNG is not seeded by np.random.seed on the host, so each row
+    seeds it with seed + row: results are reproducible and independent of scheduling.
+    
+    Args:
+        indptr (np.ndarray): Row offsets into pos_items
+        pos_items (np.ndarray): Positive items, sorted within each row
+        rows (np.ndarray): Rows to sample for (each must have at least num_neg free items)
+        num_items (int): Total number of items
+        num_neg (int): Number of negatives per row
+        seed (int): Base seed, drawn from the host's (seeded) NumPy RNG
+        
+    Returns:
+        np.ndarray: Negative items of shape (len(rows), num_neg)
+    """
+    out = np.empty((len(rows), num_neg), dtype=np.int64)
+    for r in prange(len(rows)):
+        np.random.seed(seed + r)
+        start, end = indptr[rows[r]], indptr[rows[r] + 1]
+        filled = 0
+        while filled < num_neg:
+            cand = np.random.randint(0, num_items)
+            
+            # Reject positives
+            loc = start + np.searchsorted(pos_items[start:end], cand)
+            if loc < end and pos_items[loc] == cand:
+                continue
+            
+            # Reject repeated draws so negatives stay distinct
+            repeated = False
+            for j in range(filled):
+                if out[r, j] == cand:
+                    repeated = True
+                    break
+            if repeated:
+                continue
+            
+            out[r, filled] = cand
+            filled += 1
+    return out
+
+def sample_negatives(user_to_items, num_items, num_neg=5, oversample=2, device=None):
     """
     Sample negative items for each user.
     
+    On the CPU, a parallel Numba kernel rejection-samples each user's negatives
+    against their sorted positives. When a device is given, candidates are drawn
+    for all users at once with torch.randint and rejected via torch.isin.
+    Neither path materializes a per-user list of all non-interacted items.
+    
     Args:
         user_to_items (dict): Dictionary mapping user indices to sets of item indices
         num_items (int): Total number of items
         num_neg (int): Number of negative samples per user
+        oversample (int): Candidates drawn per requested negative in each round (device path)
+        device (torch.device, optional): Device to sample on (defaults to the CPU kernel)
         
     Returns:
         dict: Dictionary mapping user indices to lists of negative item indices
     """
-    user_to_negs = {}
-    all_items = set(range(num_items))
+    users = list(user_to_items.keys())
+    if not users:
+        return {}
+    
+    # Pack positives into CSR form, sorted within each user
+    pos_lists = [np.sort(np.fromiter(user_to_items[u], dtype=np.int64)) for u in users]
+    counts = np.array([len(items) for items in pos_lists], dtype=np.int64)
+    indptr = np.zeros(len(users) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    pos_items = np.concatenate(pos_lists)
+    
+    # If not enough candidates, use all available with replacement
+    exact_negs = _sample_free_items_with_replacement(
+        indptr, pos_items, np.nonzero(counts > num_items - num_neg)[0], num_items, num_neg
+    )
+    
+    sampled_rows = np.nonzero(counts <= num_items - num_neg)[0]
+    if device is None or torch.device(device).type == 'cpu':
+        seed = np.random.randint(2**31)
+        neg_samples = _sample_negatives_kernel(indptr, pos_items, sampled_rows, num_items, num_neg, seed)
+        neg_lists = dict(zip(sampled_rows.tolist(), neg_samples.tolist()))
+    else:
+        neg_lists = _sample_negatives_torch(
+            user_to_items, users, indptr, pos_items, sampled_rows, num_items, num_neg, oversample, device, exact_negs
+        )
     
-    for user_idx, pos_items in user_to_items.items():
-        # Get items not interacted with
-        neg_candidates = list(all_items - pos_items)
-        
-        # Sample negative items
-        if len(neg_candidates) >= num_neg:
-            neg_samples = random.sample(neg_candidates, num_neg)
-        else:
-            # If not enough candidates, use all available with replacement
-            neg_samples = random.choices(neg_candidates, k=num_neg)
-            
-        user_to_negs[user_idx] = neg_samples
+    return {
+        user_idx: exact_negs.get(row, neg_lists.get(row))
+        for row, user_idx in enumerate(users)
+    }
+
+def _sample_free_items_with_replacement(indptr, pos_items, rows, num_items, num_neg):
+    """
+    Sample num_neg free items with replacement for each of a few nearly saturated rows.
+    
+    The free items of all rows are listed at once from a dense rows x items mask
+    and sampled with one batched draw.
+    
+    Returns:
+        dict: Mapping from row to list of negative item indices (empty if no item is free)
+    """
+    if len(rows) == 0:
+        return {}
     
-    return user_to_negs
+    # Mark each row's positives as taken
+    free = np.ones((len(rows), num_items), dtype=bool)
+    for i, row in enumerate(rows):
+        free[i, pos_items[indptr[row]:indptr[row + 1]]] = False
+    
+    # Free items of every row, concatenated row by row
+    free_rows, free_items = np.nonzero(free)
+    num_free = np.bincount(free_rows, minlength=len(rows))
+    starts = np.cumsum(num_free) - num_free
+    draws = starts[:, None] + (np.random.random((len(rows), num_neg)) * num_free[:, None]).astype(np.int64)
+    
+    return {
+        row: free_items[draws[i]].tolist() if num_free[i] > 0 else []
+        for i, row in enumerate(rows.tolist())
+    }
+
+def _sample_negatives_torch(user_to_items, users, indptr, pos_items, sampled_rows, num_items, num_neg,
+                            oversample, device, exact_negs):
+    """
+    Rejection-sample negatives for all rows at once with torch on the given device.
+    
+    Rows whose candidates run out before num_neg valid draws are sampled exactly
+    from their free items and recorded in exact_negs.
+    
+    Returns:
+        dict: Mapping from row to list of negative item indices
+    """
+    # Flatten positives into (row * num_items + item) keys for membership tests
+    rows = np.repeat(np.arange(len(users), dtype=np.int64), np.diff(indptr))
+    pos_keys = torch.from_numpy(rows * num_items + pos_items).to(device)
+    
+    neg_samples = torch.empty((len(users), num_neg), dtype=torch.long, device=device)
+    pending = torch.from_numpy(sampled_rows).to(device)
+    num_draws = num_neg * oversample
+    
+    while pending.numel() > 0:
+        cand = torch.randint(0, num_items, (pending.numel(), num_draws), device=device)
+        keys = pending.unsqueeze(1) * num_items + cand
+        valid = ~torch.isin(keys, pos_keys)
+        
+        # Reject repeated draws within a row so negatives stay distinct
+        sorted_keys, order = torch.sort(keys, dim=1, stable=True)
+        dup_sorted = torch.zeros_like(valid)
+        dup_sorted[:, 1:] = sorted_keys[:, 1:] == sorted_keys[:, :-1]
+        valid &= ~torch.zeros_like(valid).scatter_(1, order, dup_sorted)
+        
+        # Keep the first num_neg valid draws of every row that has enough
+        rank = valid.cumsum(dim=1)
+        done = rank[:, -1] >= num_neg
+        take = valid & (rank <= num_neg) & done.unsqueeze(1)
+        neg_samples[pending[done]] = cand[take].view(-1, num_neg)
+        
+        pending = pending[~done]
+        num_draws *= 2
+        
+        # Users with almost no free items: sample their candidate list directly
+        if num_draws > num_items:
+            for row in pending.cpu().tolist():
+                free_items = np.setdiff1d(np.arange(num_items), pos_items[indptr[row]:indptr[row + 1]], assume_unique=True)
+                exact_negs[row] = np.random.choice(free_items, num_neg, replace=False).tolist()
+            break
+    
+    neg_lists = neg_samples.cpu().tolist()
+    return {row: neg_lists[row] for row in sampled_rows.tolist()}
 
 def compute_price_similarity(df, product_to_idx, num_products):
     """
@@ -473,7 +682,7 @@ def compute_price_similarity(df, product_to_idx, num_products):
         torch.Tensor: Edge weight tensor
     """
     # Get average price per product
-    avg_prices = df.groupby('StockCode')['UnitPrice'].mean()
+    avg_prices = df.groupby('StockCode', observed=True)['UnitPrice'].mean()
     
     # Find price ranges
     price_min = avg_prices.min()
@@ -510,8 +719,8 @@ def compute_price_similarity(df, product_to_idx, num_products):
         return None, None
     
     # Create edge index tensor
-    edge_index = torch.tensor([src, dst], dtype=torch.long)
-    edge_weight = torch.tensor(weights, dtype=torch.float)
+    edge_index = torch.from_numpy(np.array([src, dst], dtype=np.int64))
+    edge_weight = torch.from_numpy(np.array(weights, dtype=np.float32))
     
     return edge_index, edge_weight
 
@@ -529,39 +738,25 @@ def compute_category_similarity(df, product_to_idx):
         torch.Tensor: Edge weight tensor
     """
     # Extract first word of description as a simple category
-    product_categories = {}
-    for _, row in df[['StockCode', 'Description']].drop_duplicates().iterrows():
-        if pd.isna(row['Description']):
-            continue
-            
-        pid = row['StockCode']
-        if pid in product_to_idx:
-            # Use first word as category
-            category = row['Description'].split()[0].lower()
-            if category not in product_categories:
-                product_categories[category] = []
-            product_categories[category].append(product_to_idx[pid])
+    desc_df = df[['StockCode', 'Description']].drop_duplicates().dropna(subset=['Description'])
+    categories = desc_df['Description'].str.split(n=1).str[0].str.lower()
+    products = _map_ids(desc_df['StockCode'], product_to_idx)
+    valid = (products >= 0) & categories.notna().to_numpy()
     
-    # Create edges between products in the same category
-    src, dst, weights = [], [], []
-    for category, products in product_categories.items():
-        for i in range(len(products)):
-            for j in range(i+1, len(products)):
-                src.append(products[i])
-                dst.append(products[j])
-                weights.append(1.0)  # Equal weight for all category similarity edges
-                
-                # Add reverse edge
-                src.append(products[j])
-                dst.append(products[i])
-                weights.append(1.0)
+    # Create edges between all products in the same category
+    indptr, members = _group_members(categories[valid], products[valid])
+    src, dst = _group_pairs(indptr, members, 0)
     
-    if not src:  # No edges found
+    if len(src) == 0:  # No edges found
         return None, None
     
-    # Create edge index tensor
-    edge_index = torch.tensor([src, dst], dtype=torch.long)
-    edge_weight = torch.tensor(weights, dtype=torch.float)
+    # Create edge index tensor, interleaving each edge with its reverse
+    edge_index = torch.from_numpy(np.stack([
+        np.column_stack([src, dst]).ravel(),
+        np.column_stack([dst, src]).ravel()
+    ]))
+    # Equal weight for all category similarity edges
+    edge_weight = torch.ones(edge_index.size(1), dtype=torch.float)
     
     return edge_index, edge_weight
 
@@ -586,7 +781,10 @@ def prepare_retail_graph_data(df, num_customers, num_products,
     customer_ids = list(customer_to_idx.keys())
     product_ids = list(product_to_idx.keys())
     
-    customer_features = compute_rfm_features(df, customer_ids)
+    # Latest date in the dataset, shared by all recency computations
+    latest_date = df['InvoiceDate'].max()
+    
+    customer_features = compute_rfm_features(df, customer_ids, latest_date=latest_date)
     product_features = compute_product_features(df, product_ids)
     
     # Create different edge types
@@ -594,7 +792,7 @@ def prepare_retail_graph_data(df, num_customers, num_products,
     
     if 'transaction' in edge_types:
         transaction_edges, transaction_weights = create_transaction_edges(
-            df, customer_to_idx, product_to_idx)
+            df, customer_to_idx, product_to_idx, latest_date=latest_date)
         edge_data['transaction'] = (transaction_edges, transaction_weights)
     
     if 'basket' in edge_types:
@@ -606,7 +804,7 @@ def prepare_retail_graph_data(df, num_customers, num_products,
     if 'country' in edge_types:
         country_edges = create_country_edges(df, customer_to_idx)
         if country_edges is not None:
-            edge_data['country'] = (country_edges, torch.ones(country_edges.size(1)))
+            edge_data['country'] = (country_edges, torch.ones(country_edges.size(1), dtype=torch.float))
     
     if 'price' in edge_types:
         price_edges, price_weights = compute_price_similarity(
@@ -627,20 +825,23 @@ def prepare_retail_graph_data(df, num_customers, num_products,
     test_user_items = get_test_customers(df, customer_to_idx, product_to_idx)
     
     # Create combined edge index and edge weight tensors
-    all_edge_indices = []
-    all_edge_weights = []
-    all_edge_types = []
-    
     edge_type_map = {edge_type: i for i, edge_type in enumerate(edge_data.keys())}
     
-    for edge_type, (edge_index, edge_weight) in edge_data.items():
-        all_edge_indices.append(edge_index)
-        all_edge_weights.append(edge_weight)
-        all_edge_types.append(torch.full((edge_index.size(1),), edge_type_map[edge_type]))
+    # Allocate the combined tensors once and copy each edge type into its slice.
+    # Pinned host memory lets the later move to the GPU run with non_blocking=True.
+    total_edges = sum(edge_index.size(1) for edge_index, _ in edge_data.values())
+    pin = torch.cuda.is_available()
+    combined_edge_index = torch.empty((2, total_edges), dtype=torch.long, pin_memory=pin)
+    combined_edge_weight = torch.empty(total_edges, dtype=torch.float, pin_memory=pin)
+    combined_edge_type = torch.empty(total_edges, dtype=torch.long, pin_memory=pin)
     
-    combined_edge_index = torch.cat(all_edge_indices, dim=1)
-    combined_edge_weight = torch.cat(all_edge_weights)
-    combined_edge_type = torch.cat(all_edge_types)
+    offset = 0
+    for edge_type, (edge_index, edge_weight) in edge_data.items():
+        num_edges = edge_index.size(1)
+        combined_edge_index[:, offset:offset + num_edges].copy_(edge_index)
+        combined_edge_weight[offset:offset + num_edges].copy_(edge_weight)
+        combined_edge_type[offset:offset + num_edges].fill_(edge_type_map[edge_type])
+        offset += num_edges
     
     # Prepare metadata
     meta = {
@@ -650,7 +851,8 @@ def prepare_retail_graph_data(df, num_customers, num_products,
         "product_id_map": product_to_idx,
         "user_to_items": user_to_items,
         "test_user_items": test_user_items,
-        "edge_type_map": edge_type_map
+        "edge_type_map": edge_type_map,
+        "latest_date": latest_date
     }
     
     # Create PyG Data object
@@ -676,34 +878,73 @@ def prepare_batch_for_training(user_to_items, num_products, batch_size=64, neg_r
     Returns:
         tuple: Batch of users, positive items, and negative items
     """
-    users = list(user_to_items.keys())
-    
-    # Randomly select users for this batch
-    batch_users = random.sample(users, min(batch_size, len(users)))
-    
-    pos_items = []
-    neg_items = []
-    final_users = []
+    users = np.fromiter(user_to_items.keys(), dtype=np.int64, count=len(user_to_items))
+    
+    # Randomly select users for this batch by slicing a permutation
+    batch_users = users[np.random.permutation(len(users))[:batch_size]]
+    batch_users = batch_users[[len(user_to_items[user]) > 0 for user in batch_users]]
+    
+    # Select a positive item per user, repeated for each of its negatives
+    pos_items = np.fromiter(
+        (random.choice(list(user_to_items[user])) for user in batch_users), dtype=np.int64, count=len(batch_users)
+    )
+    final_users = np.repeat(batch_users, neg_ratio)
+    pos_items = np.repeat(pos_items, neg_ratio)
+    
+    # Sample negative items, resampling only the collisions
+    neg_items = np.random.randint(0, num_products, size=len(final_users))
+    collide = np.array([neg in user_to_items[user] for user, neg in zip(final_users, neg_items)], dtype=bool)
+    while collide.any():
+        idx = np.flatnonzero(collide)
+        neg_items[idx] = np.random.randint(0, num_products, size=len(idx))
+        collide[idx] = [neg_items[i] in user_to_items[final_users[i]] for i in idx]
+    
+    return torch.from_numpy(final_users), torch.from_numpy(pos_items), torch.from_numpy(neg_items)
+
+@njit(parallel=True, cache=True)
+def _ranking_metrics(topk, true_ptr, true_idx, k_values):
+    """
+    Compute Recall@k, Precision@k and NDCG@k for every user in parallel.
     
-    for user in batch_users:
-        user_pos_items = list(user_to_items[user])
-        if not user_pos_items:
-            continue
-            
-        # Select a positive item
-        pos_item = random.choice(user_pos_items)
+    Args:
+        topk (np.ndarray): [num_users, max_k] matrix of recommended item indices
+        true_ptr (np.ndarray): CSR offsets into true_idx, length num_users + 1
+        true_idx (np.ndarray): Ground-truth item indices, sorted within each user
+        k_values (np.ndarray): Cutoffs to evaluate
         
-        # Sample negative items
-        for _ in range(neg_ratio):
-            neg_item = random.randint(0, num_products - 1)
-            while neg_item in user_to_items[user]:
-                neg_item = random.randint(0, num_products - 1)
+    Returns:
+        tuple: Recall, precision and NDCG matrices of shape [num_users, len(k_values)]
+    """
+    num_users = topk.shape[0]
+    num_k = k_values.shape[0]
+    recalls = np.zeros((num_users, num_k))
+    precisions = np.zeros((num_users, num_k))
+    ndcgs = np.zeros((num_users, num_k))
+    
+    for u in prange(num_users):
+        truth = true_idx[true_ptr[u]:true_ptr[u + 1]]
+        num_true = truth.shape[0]
+        
+        for j in range(num_k):
+            k = k_values[j]
+            hits = 0
+            dcg = 0.0
+            for i in range(k):
+                item = topk[u, i]
+                pos = np.searchsorted(truth, item)
+                if pos < num_true and truth[pos] == item:
+                    hits += 1
+                    dcg += 1.0 / np.log2(i + 2)
             
-            final_users.append(user)
-            pos_items.append(pos_item)
-            neg_items.append(neg_item)
+            idcg = 0.0
+            for i in range(min(num_true, k)):
+                idcg += 1.0 / np.log2(i + 2)
+            
+            recalls[u, j] = hits / num_true
+            precisions[u, j] = hits / k
+            ndcgs[u, j] = dcg / idcg if idcg > 0 else 0.0
     
-    return torch.tensor(final_users), torch.tensor(pos_items), torch.tensor(neg_items)
+    return recalls, precisions, ndcgs
 
 def compute_metrics_for_recommendations(model, data, meta, k_values=[5, 10, 20]):
     """
@@ -731,59 +972,46 @@ def compute_metrics_for_recommendations(model, data, meta, k_values=[5, 10, 20])
     
     user_embs = all_emb[:num_customers]
     item_embs = all_emb[num_customers:num_customers + num_products]
+    user_to_items = meta.get("user_to_items", {})
+    max_k = max(k_values)
     
-    # Compute metrics for each test user
-    recalls = {k: [] for k in k_values}
-    precisions = {k: [] for k in k_values}
-    ndcgs = {k: [] for k in k_values}
+    # Skip users with no positive items
+    eval_users = [user_idx for user_idx, true_items in test_user_items.items() if true_items]
+    if not eval_users:
+        return {f'{name}@{k}': 0.0 for k in k_values for name in ('Recall', 'Precision', 'NDCG')}
     
-    for user_idx, true_items in test_user_items.items():
-        # Skip users with no positive items
-        if not true_items:
-            continue
-            
-        # Get recommendations
-        user_emb = user_embs[user_idx].unsqueeze(0)
-        scores = torch.matmul(user_emb, item_embs.t()).squeeze(0)
-        
-        # Remove items the user has already interacted with
-        for item in user_to_items.get(user_idx, set()):
-            scores[item] = -float('inf')
-        
-        # Get top-k recommendations
-        _, topk_idx = torch.topk(scores, max(k_values))
-        topk_idx = topk_idx.cpu().tolist()
-        
-        # Compute metrics for different k values
-        for k in k_values:
-            topk = topk_idx[:k]
-            hits = len(set(topk) & true_items)
-            
-            # Recall@k = hits / |true_items|
-            recall = hits / len(true_items)
-            recalls[k].append(recall)
-            
-            # Precision@k = hits / k
-            precision = hits / k
-            precisions[k].append(precision)
-            
-            # NDCG@k
-            dcg = 0.0
-            idcg = sum(1.0 / np.log2(i + 2) for i in range(min(len(true_items), k)))
-            
-            for i, item in enumerate(topk):
-                if item in true_items:
-                    dcg += 1.0 / np.log2(i + 2)
-            
-            ndcg = dcg / idcg if idcg > 0 else 0.0
-            ndcgs[k].append(ndcg)
+    device = all_emb.device
+    users_tensor = torch.tensor(eval_users, dtype=torch.long, device=device)
+    
+    # Score all test users against all items in a single matmul
+    scores = torch.matmul(user_embs.index_select(0, users_tensor), item_embs.t())
+    
+    # Remove items the users have already interacted with
+    seen = [np.fromiter(user_to_items.get(u, ()), dtype=np.int64) for u in eval_users]
+    seen_counts = np.array([len(items) for items in seen], dtype=np.int64)
+    if seen_counts.sum() > 0:
+        rows = torch.from_numpy(np.repeat(np.arange(len(eval_users)), seen_counts)).to(device)
+        cols = torch.from_numpy(np.concatenate(seen)).to(device)
+        scores[rows, cols] = -float('inf')
+    
+    # Get top-k recommendations
+    topk_mat = torch.topk(scores, max_k, dim=1).indices.cpu().numpy().astype(np.int64)
+    true_lists = [np.sort(np.fromiter(test_user_items[u], dtype=np.int64)) for u in eval_users]
+    
+    # Pack ground truth as CSR so the metric kernel works on flat int arrays
+    true_ptr = np.zeros(len(true_lists) + 1, dtype=np.int64)
+    true_ptr[1:] = np.cumsum([len(t) for t in true_lists])
+    true_idx = np.concatenate(true_lists)
+    k_arr = np.asarray(k_values, dtype=np.int64)
+    
+    recalls, precisions, ndcgs = _ranking_metrics(topk_mat, true_ptr, true_idx, k_arr)
     
     # Calculate average metrics
     results = {}
-    for k in k_values:
-        results[f'Recall@{k}'] = np.mean(recalls[k]) if recalls[k] else 0.0
-        results[f'Precision@{k}'] = np.mean(precisions[k]) if precisions[k] else 0.0
-        results[f'NDCG@{k}'] = np.mean(ndcgs[k]) if ndcgs[k] else 0.0
+    for j, k in enumerate(k_values):
+        results[f'Recall@{k}'] = float(recalls[:, j].mean())
+        results[f'Precision@{k}'] = float(precisions[:, j].mean())
+        results[f'NDCG@{k}'] = float(ndcgs[:, j].mean())
     
     return results
 
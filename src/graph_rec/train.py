@@ -14,7 +14,10 @@ Features:
 
 import os
 import torch
+import torch.nn.functional as F
 import torch.optim as optim
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 import numpy as np
 import random
 import pickle
@@ -26,8 +29,7 @@ import matplotlib.pyplot as plt
 
 # Import models and utilities
 from model import LightGCN, EnhancedLightGCN
-from data_loader import load_filtered_data
-from evaluation import recall_at_k, ndcg_at_k
+from data_loader import load_filtered_data, build_user_item_csr
 
 def set_seed(seed):
     """Set random seeds for reproducibility."""
@@ -39,9 +41,259 @@ def set_seed(seed):
         torch.cuda.manual_seed_all(seed)
         torch.backends.cudnn.deterministic = True
 
+def csr_keys(indptr, indices, num_items):
+    """Flatten CSR user-item pairs into sorted user * num_items + item keys for membership tests."""
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int64), np.diff(indptr))
+    return rows * num_items + indices
+
+def pack_user_item_bits(indptr, indices, num_items):
+    """Pack CSR user-item pairs into a (num_users, ceil(num_items / 64)) int64 bit-matrix."""
+    num_users = len(indptr) - 1
+    rows = np.repeat(np.arange(num_users, dtype=np.int64), np.diff(indptr))
+    items = indices.astype(np.uint64)
+    bits = np.zeros((num_users, (num_items + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(bits, (rows, (items >> np.uint64(6)).astype(np.int64)), np.uint64(1) << (items & np.uint64(63)))
+    return bits.view(np.int64)
+
+def csr_contains(pos_keys, users, items, num_items):
+    """Vectorized test of whether each (user, item) pair is a positive interaction."""
+    keys = users * num_items + items
+    loc = np.minimum(np.searchsorted(pos_keys, keys), len(pos_keys) - 1)
+    return pos_keys[loc] == keys
+
+def csr_gather(indptr, indices, users):
+    """Return (row, item) pairs for the given users' CSR rows, with rows numbered by position in users."""
+    starts = indptr[users]
+    counts = indptr[users + 1] - starts
+    rows = np.repeat(np.arange(len(users), dtype=np.int64), counts)
+    # Offset of each element within its row, added to the row start
+    offsets = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, indices[np.repeat(starts, counts) + offsets].astype(np.int64)
+
+def sample_bpr_batch(batch_users, indptr, indices, pos_keys, num_items):
+    """Sample one positive and one negative item per user, resampling only colliding negatives."""
+    starts = indptr[batch_users]
+    counts = indptr[batch_users + 1] - starts
+    valid = counts > 0
+    users = batch_users[valid]
+    
+    # Sample positive items
+    pos_items = indices[starts[valid] + np.random.randint(0, counts[valid])].astype(np.int64)
+    
+    # Sample negative items, resampling only the collisions
+    neg_items = np.random.randint(0, num_items, size=len(users))
+    collide = csr_contains(pos_keys, users, neg_items, num_items)
+    while collide.any():
+        idx = np.flatnonzero(collide)
+        neg_items[idx] = np.random.randint(0, num_items, size=len(idx))
+        collide[idx] = csr_contains(pos_keys, users[idx], neg_items[idx], num_items)
+    
+    return users, pos_items, neg_items
+
+def seed_worker(worker_id):
+    """Give each DataLoader worker its own NumPy/random seed."""
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+class BPRSampler(IterableDataset):
+    """Iterable dataset yielding shuffled (users, pos_items, neg_items) BPR batches."""
+    def __init__(self, indptr, indices, num_items, batch_size, num_workers=0, drop_last=False):
+        self.indptr = indptr
+        self.indices = indices
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.num_shards = max(num_workers, 1)
+        self.users = np.flatnonzero(np.diff(indptr))
+        self.pos_keys = csr_keys(indptr, indices, num_items)
+    
+    def _worker_users(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return self.users
+        # Each worker handles a disjoint shard of the users
+        return self.users[worker_info.id::worker_info.num_workers]
+    
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(self.users[w::self.num_shards]) // self.batch_size for w in range(self.num_shards))
+        return sum(-(-len(self.users[w::self.num_shards]) // self.batch_size) for w in range(self.num_shards))
+    
+    def __iter__(self):
+        users = np.random.permutation(self._worker_users())
+        for start in range(0, len(users), self.batch_size):
+            batch = sample_bpr_batch(
+                users[start:start + self.batch_size], self.indptr, self.indices, self.pos_keys, self.num_items
+            )
+            if len(batch[0]) == 0 or (self.drop_last and len(batch[0]) < self.batch_size):
+                continue
+            yield tuple(torch.from_numpy(arr) for arr in batch)
+
+class PinnedBatchStager:
+    """Copies (users, pos_items, neg_items) batches to a CUDA device through reused pinned buffers."""
+    def __init__(self, batch_size, device, num_slots=2):
+        # Rows are (user, pos_item, neg_item) so a partial batch is a contiguous prefix
+        self.host = [torch.empty((batch_size, 3), dtype=torch.long, pin_memory=True) for _ in range(num_slots)]
+        self.dev = [torch.empty((batch_size, 3), dtype=torch.long, device=device) for _ in range(num_slots)]
+        self.copied = [None] * num_slots
+        self.slot = 0
+    
+    def stage(self, users, pos_items, neg_items):
+        slot = self.slot
+        self.slot = (slot + 1) % len(self.host)
+        
+        # Wait for the previous copy out of this slot before overwriting it
+        if self.copied[slot] is not None:
+            self.copied[slot].synchronize()
+        
+        n = len(users)
+        host = self.host[slot][:n]
+        host[:, 0].copy_(users)
+        host[:, 1].copy_(pos_items)
+        host[:, 2].copy_(neg_items)
+        
+        dev = self.dev[slot][:n]
+        dev.copy_(host, non_blocking=True)
+        self.copied[slot] = torch.cuda.Event()
+        self.copied[slot].record()
+        return dev[:, 0], dev[:, 1], dev[:, 2]
+
+class DeviceBPRSampler:
+    """Yields shuffled (users, pos_items, neg_items) BPR batches sampled on the training device."""
+    def __init__(self, indptr, indices, num_items, batch_size, device, drop_last=False,
+                 max_bitmask_bytes=512 * 2**20):
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.device = device
+        self.drop_last = drop_last
+        self.indptr = torch.from_numpy(indptr).to(device)
+        self.indices = torch.from_numpy(indices.astype(np.int64)).to(device)
+        self.users = torch.from_numpy(np.flatnonzero(np.diff(indptr))).to(device)
+        
+        # Membership is a bit test on a packed users x items bit-matrix when it fits,
+        # otherwise a binary search over sorted user * num_items + item keys
+        num_users = len(indptr) - 1
+        num_words = (num_items + 63) // 64
+        self.pos_bits = None
+        self.pos_keys = None
+        if num_users * num_words * 8 <= max_bitmask_bytes:
+            self.pos_bits = torch.from_numpy(pack_user_item_bits(indptr, indices, num_items)).to(device)
+        else:
+            self.pos_keys = torch.from_numpy(csr_keys(indptr, indices, num_items)).to(device)
+    
+    def __len__(self):
+        if self.drop_last:
+            return len(self.users) // self.batch_size
+        return -(-len(self.users) // self.batch_size)
+    
+    def _contains(self, users, items):
+        if self.pos_bits is not None:
+            words = self.pos_bits[users, items >> 6]
+            return ((words >> (items & 63)) & 1).bool()
+        keys = users * self.num_items + items
+        loc = torch.searchsorted(self.pos_keys, keys).clamp_(max=len(self.pos_keys) - 1)
+        return self.pos_keys[loc] == keys
+    
+    def sample(self, users):
+        starts = self.indptr[users]
+        counts = self.indptr[users + 1] - starts
+        
+        # Sample positive items
+        offsets = (torch.rand(len(users), dtype=torch.float64, device=self.device) * counts).long()
+        pos_items = self.indices[starts + offsets]
+        
+        # Sample negative items, resampling only the collisions
+        neg_items = torch.randint(0, self.num_items, (len(users),), device=self.device)
+        collide = self._contains(users, neg_items)
+        while collide.any():
+            idx = collide.nonzero(as_tuple=True)[0]
+            neg_items[idx] = torch.randint(0, self.num_items, (len(idx),), device=self.device)
+            collide[idx] = self._contains(users[idx], neg_items[idx])
+        
+        return users, pos_items, neg_items
+    
+    def __iter__(self):
+        users = self.users[torch.randperm(len(self.users), device=self.device)]
+        for start in range(0, len(users), self.batch_size):
+            batch_users = users[start:start + self.batch_size]
+            if self.drop_last and len(batch_users) < self.batch_size:
+                continue
+            yield self.sample(batch_users)
+
+def propagate(model, edge_index, edge_weight, edge_type=None):
+    """Run the LightGCN propagation, passing edge types only to the enhanced model."""
+    if edge_type is None:
+        return model(edge_index, edge_weight)
+    return model(edge_index, edge_weight, edge_type)
+
+def bpr_loss(user_embeddings, pos_item_embeddings, neg_item_embeddings, reg_weight):
+    """Compute the L2-regularized BPR loss from gathered embeddings."""
+    # BPR loss
+    pos_scores = torch.sum(user_embeddings * pos_item_embeddings, dim=1)
+    neg_scores = torch.sum(user_embeddings * neg_item_embeddings, dim=1)
+    # -log(sigmoid(x)) == softplus(-x), stable for large negative margins
+    loss = F.softplus(neg_scores - pos_scores).mean()
+    
+    # L2 regularization
+    reg_loss = 1/2 * ((user_embeddings * user_embeddings).sum() + 
+                    (pos_item_embeddings * pos_item_embeddings).sum() + 
+                    (neg_item_embeddings * neg_item_embeddings).sum()) / len(user_embeddings)
+    return loss + reg_weight * reg_loss
+
+def bpr_step(model, users, pos_items, neg_items, edge_index, edge_weight, edge_type, num_users, reg_weight,
+             checkpoint_propagation=False):
+    """Run the LightGCN forward pass and return the L2-regularized BPR loss for a batch."""
+    if checkpoint_propagation:
+        # Keep only the output; per-layer activations are recomputed during backward
+        all_embeddings = checkpoint(propagate, model, edge_index, edge_weight, edge_type, use_reentrant=False)
+    else:
+        all_embeddings = propagate(model, edge_index, edge_weight, edge_type)
+    # F.embedding gathers rows with the embedding backward (one index_add into the grad)
+    # instead of the generic advanced-indexing backward
+    return bpr_loss(
+        F.embedding(users, all_embeddings),
+        F.embedding(num_users + pos_items, all_embeddings),
+        F.embedding(num_users + neg_items, all_embeddings),
+        reg_weight
+    )
+
+def cached_bpr_step(model, propagated, base_weight, users, pos_items, neg_items, num_users, reg_weight):
+    """
+    BPR loss on cached propagated embeddings, refreshing only the self-connection term.
+    
+    Gradients flow into the embedding table through its 1/(num_layers+1) share of the
+    LightGCN output, while the neighbour contributions stay as cached.
+    """
+    weight = model.embeddings.weight
+    scale = 1 / (model.num_layers + 1)
+    
+    def gather(nodes):
+        # With a sparse embedding table only the gathered rows receive gradients
+        looked_up = F.embedding(nodes, weight, sparse=model.embeddings.sparse)
+        return propagated[nodes] + (looked_up - base_weight[nodes]) * scale
+    
+    return bpr_loss(gather(users), gather(num_users + pos_items), gather(num_users + neg_items), reg_weight)
+
+class MultiOptimizer:
+    """Drive several optimizers (e.g. SparseAdam + Adam) through one zero_grad/step interface."""
+    def __init__(self, *optimizers):
+        self.optimizers = [opt for opt in optimizers if opt is not None]
+    
+    def zero_grad(self):
+        for opt in self.optimizers:
+            opt.zero_grad()
+    
+    def step(self):
+        for opt in self.optimizers:
+            opt.step()
+
 def train_model(args):
     """Train LightGCN or EnhancedLightGCN model on the filtered H&M dataset."""
     set_seed(args.seed)
+    if args.sparse_embeddings and args.propagation_freq <= 1:
+        # Full propagation touches every embedding row, so its gradient is dense
+        raise ValueError("--sparse_embeddings requires --propagation_freq > 1")
     
     # Set device
     device = torch.device(args.device if torch.cuda.is_available() and args.device == "cuda" else "cpu")
@@ -53,7 +305,11 @@ def train_model(args):
     # Load data
     if args.load_processed and os.path.exists(os.path.join(args.data_dir, "processed/lightgcn_data.pt")):
         print("Loading processed data...")
-        data = torch.load(os.path.join(args.data_dir, "processed/lightgcn_data.pt"), map_location=device)
+        # Memory-map the saved graph on the host; tensors are paged in as they are copied to the device
+        data = torch.load(
+            os.path.join(args.data_dir, "processed/lightgcn_data.pt"),
+            map_location="cpu", mmap=True, weights_only=False
+        )
         with open(os.path.join(args.data_dir, "processed/lightgcn_meta.pkl"), "rb") as f:
             meta = pickle.load(f)
     else:
@@ -64,7 +320,7 @@ def train_model(args):
             decay_rate=args.decay_rate
         )
     
-    data = data.to(device)
+    data = data.to(device, non_blocking=True)
     train_user_items = meta.get("train_user_items", {})
     test_user_items = meta.get("test_user_items", {})
     
@@ -104,7 +360,8 @@ def train_model(args):
             num_users=num_users,
             num_items=num_items,
             embed_dim=args.embed_dim,
-            num_layers=args.num_layers
+            num_layers=args.num_layers,
+            sparse=args.sparse_embeddings
         ).to(device)
     else:
         print("Using enhanced LightGCN model with edge type embeddings")
@@ -113,15 +370,36 @@ def train_model(args):
             num_items=num_items,
             embed_dim=args.embed_dim,
             num_layers=args.num_layers,
-            num_edge_types=args.num_edge_types
+            num_edge_types=args.num_edge_types,
+            sparse=args.sparse_embeddings
         ).to(device)
     
     # Define optimizer
-    optimizer = optim.Adam(
-        model.parameters(),
-        lr=args.lr,
-        weight_decay=args.weight_decay
-    )
+    if args.sparse_embeddings:
+        # SparseAdam updates only the embedding rows a batch touched (it has no weight decay;
+        # the BPR L2 term regularizes those rows); the remaining parameters stay on Adam
+        dense_params = [p for name, p in model.named_parameters() if not name.startswith("embeddings.")]
+        optimizer = MultiOptimizer(
+            optim.SparseAdam(list(model.embeddings.parameters()), lr=args.lr),
+            optim.Adam(dense_params, lr=args.lr, weight_decay=args.weight_decay) if dense_params else None
+        )
+    else:
+        optimizer = optim.Adam(
+            model.parameters(),
+            lr=args.lr,
+            weight_decay=args.weight_decay
+        )
+    
+    # Replay gradient-free propagations (cached-propagation refreshes, evaluation) from CUDA graphs
+    model.cuda_graph = args.cuda_graph and device.type == "cuda"
+    
+    # bf16 autocast only applies on CUDA; the optimizer keeps FP32 weights
+    use_amp = args.amp and device.type == "cuda"
+    
+    # Fuse the forward pass and loss into compiled kernels if requested
+    step_fn = bpr_step
+    if args.compile:
+        step_fn = torch.compile(bpr_step, mode="reduce-overhead", dynamic=False)
     
     # Training loop
     best_recall = 0.0
@@ -129,84 +407,104 @@ def train_model(args):
     train_losses = []
     test_recalls = []
     test_ndcgs = []
+    reducer = None
     
     print("\nStarting training...")
-    train_users = list(train_user_items.keys())
+    if "train_indptr" in meta:
+        train_indptr, train_indices = meta["train_indptr"], meta["train_indices"]
+    else:
+        train_indptr, train_indices = build_user_item_csr(train_user_items, num_users)
+    
+    # Compiled steps need static batch shapes, so the last partial batch is dropped
+    if args.gpu_sampling:
+        # Sample BPR batches directly on the device, avoiding per-batch host-to-device copies
+        sampler = DeviceBPRSampler(
+            train_indptr, train_indices, num_items, args.batch_size, device, drop_last=args.compile
+        )
+        loader = sampler
+    else:
+        # Sample BPR batches in worker processes so sampling overlaps with GPU compute
+        sampler = BPRSampler(
+            train_indptr, train_indices, num_items, args.batch_size, args.num_workers, drop_last=args.compile
+        )
+        loader = DataLoader(
+            sampler,
+            batch_size=None,
+            num_workers=args.num_workers,
+            persistent_workers=args.num_workers > 0,
+            worker_init_fn=seed_worker
+        )
+    
+    # Stage host batches through reused pinned buffers for asynchronous copies
+    stager = None
+    if device.type == "cuda" and not args.gpu_sampling:
+        stager = PinnedBatchStager(args.batch_size, device)
     
     for epoch in range(args.num_epochs):
         model.train()
-        random.shuffle(train_users)
-        total_loss = 0.0
+        # Running loss stays on the device so batches don't sync with the host
+        total_loss = torch.zeros((), device=device)
         total_batches = 0
         
         # Training loop
-        pbar = tqdm(range(0, len(train_users), args.batch_size), desc=f"Epoch {epoch+1}/{args.num_epochs}")
-        for batch_idx in pbar:
-            batch_users = train_users[batch_idx:batch_idx + args.batch_size]
-            if not batch_users:
-                continue
-                
-            pos_items, neg_items = [], []
-            valid_users = []
-            for i, user in enumerate(batch_users):
-                if not train_user_items[user]:
-                    continue
-                    
-                # Sample positive item
-                pos_item = random.choice(list(train_user_items[user]))
-                
-                # Sample negative item
-                neg_item = random.randint(0, num_items - 1)
-                while neg_item in train_user_items[user]:
-                    neg_item = random.randint(0, num_items - 1)
-                
-                valid_users.append(user)
-                pos_items.append(pos_item)
-                neg_items.append(neg_item)
-            
-            if not valid_users:
-                continue
-                
-            # Convert to tensors
-            users_tensor = torch.tensor(valid_users, dtype=torch.long, device=device)
-            pos_items_tensor = torch.tensor(pos_items, dtype=torch.long, device=device)
-            neg_items_tensor = torch.tensor(neg_items, dtype=torch.long, device=device)
-            
-            # Forward pass
-            if args.model_type == "standard":
-                all_embeddings = model(data.edge_index, data.edge_attr)
+        pbar = tqdm(loader, total=len(sampler), desc=f"Epoch {epoch+1}/{args.num_epochs}")
+        for users_tensor, pos_items_tensor, neg_items_tensor in pbar:
+            if stager is not None:
+                users_tensor, pos_items_tensor, neg_items_tensor = stager.stage(
+                    users_tensor, pos_items_tensor, neg_items_tensor
+                )
             else:
-                all_embeddings = model(data.edge_index, data.edge_attr, data.edge_type)
-                
-            user_embeddings = all_embeddings[users_tensor]
-            pos_item_embeddings = all_embeddings[num_users + pos_items_tensor]
-            neg_item_embeddings = all_embeddings[num_users + neg_items_tensor]
+                users_tensor = users_tensor.to(device, non_blocking=True)
+                pos_items_tensor = pos_items_tensor.to(device, non_blocking=True)
+                neg_items_tensor = neg_items_tensor.to(device, non_blocking=True)
             
-            # BPR loss
-            pos_scores = torch.sum(user_embeddings * pos_item_embeddings, dim=1)
-            neg_scores = torch.sum(user_embeddings * neg_item_embeddings, dim=1)
-            loss = -torch.mean(torch.log(torch.sigmoid(pos_scores - neg_scores) + 1e-8))
-            
-            # L2 regularization
-            reg_loss = 1/2 * (user_embeddings.norm(2).pow(2) + 
-                            pos_item_embeddings.norm(2).pow(2) + 
-                            neg_item_embeddings.norm(2).pow(2)) / len(users_tensor)
-            loss += args.reg_weight * reg_loss
+            # Forward pass and BPR loss, in bf16 autocast if requested (no GradScaler needed)
+            with torch.autocast("cuda", dtype=torch.bfloat16, enabled=use_amp):
+                if args.propagation_freq > 1:
+                    # Refresh the cached propagation every propagation_freq batches
+                    if total_batches % args.propagation_freq == 0:
+                        with torch.no_grad():
+                            propagated = propagate(model, data.edge_index, data.edge_attr, edge_type)
+                            base_weight = model.embeddings.weight.detach().clone()
+                    loss = cached_bpr_step(
+                        model, propagated, base_weight, users_tensor, pos_items_tensor, neg_items_tensor,
+                        num_users, args.reg_weight
+                    )
+                else:
+                    loss = step_fn(
+                        model, users_tensor, pos_items_tensor, neg_items_tensor,
+                        data.edge_index, data.edge_attr, edge_type, num_users, args.reg_weight,
+                        args.checkpoint_propagation
+                    )
             
             # Backward pass and optimize
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
             
-            total_loss += loss.item()
+            total_loss += loss.detach()
             total_batches += 1
-            pbar.set_postfix({"loss": f"{loss.item():.4f}"})
+            if total_batches % args.log_every == 0:
+                pbar.set_postfix({"loss": f"{loss.item():.4f}"})
         
         # Calculate average loss
-        avg_loss = total_loss / total_batches if total_batches > 0 else 0
+        avg_loss = (total_loss / total_batches).item() if total_batches > 0 else 0
         train_losses.append(avg_loss)
         print(f"Epoch {epoch+1}/{args.num_epochs} - Avg. Loss: {avg_loss:.4f}")
         
+        # Plot embeddings, fitting UMAP on the first call and reusing it afterwards
+        if args.visualize_every > 0 and (epoch + 1) % args.visualize_every == 0:
+            # Imported here so runs without plots do not load umap/networkx/sklearn
+            from visualization import visualize_embeddings
+            with torch.no_grad():
+                all_embeddings = propagate(model, data.edge_index, data.edge_attr, edge_type)
+            reducer = visualize_embeddings(
+                all_embeddings,
+                title=f"{args.model_type} LightGCN embeddings (epoch {epoch+1})",
+                reducer=reducer,
+                save_path=os.path.join(args.output_dir, f"{args.model_type}_embeddings_epoch{epoch+1}.png")
+            )
+        
         # Evaluate on test set every few epochs
         if (epoch + 1) % args.eval_freq == 0 or epoch == args.num_epochs - 1:
             recall, ndcg = evaluate(model, data, meta, test_user_items, device, args.model_type, top_k=args.top_k)
@@ -238,7 +536,7 @@ def train_model(args):
     meta["best_recall"] = best_recall
     
     with open(os.path.join(args.output_dir, meta_filename), "wb") as f:
-        pickle.dump(meta, f)
+        pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
     
     # Plot training curves
     plot_training_curves(train_losses, test_recalls, test_ndcgs, args)
@@ -259,39 +557,43 @@ def evaluate(model, data, meta, test_user_items, device, model_type="standard",
     user_embeddings = all_embeddings[:num_users]
     item_embeddings = all_embeddings[num_users:]
     
-    recalls = []
-    ndcgs = []
+    test_users = np.array([user for user, true_items in test_user_items.items() if true_items], dtype=np.int64)
+    if len(test_users) == 0:
+        return 0, 0
     
-    for user, true_items in test_user_items.items():
-        if not true_items:
-            continue
-            
-        # Get user embedding
-        user_embedding = user_embeddings[user].unsqueeze(0)
-        
-        # Calculate scores for all items
-        scores = torch.matmul(user_embedding, item_embeddings.t()).squeeze(0)
-        
-        # Filter out training items
-        train_items = meta.get("train_user_items", {}).get(user, set())
-        for item in train_items:
-            scores[item] = -float('inf')
-        
-        # Get top-k recommendations
-        _, indices = torch.topk(scores, k=top_k)
-        recommended_items = indices.cpu().tolist()
-        
-        # Calculate metrics
-        recall = recall_at_k(recommended_items, true_items, top_k)
-        ndcg = ndcg_at_k(recommended_items, true_items, top_k)
-        
-        recalls.append(recall)
-        ndcgs.append(ndcg)
+    # Score all test users against all items in one GEMM
+    users_tensor = torch.from_numpy(test_users).to(device)
+    scores = torch.matmul(user_embeddings[users_tensor], item_embeddings.t())
+    
+    # Filter out training items
+    if "train_indptr" in meta:
+        train_indptr, train_indices = meta["train_indptr"], meta["train_indices"]
+    else:
+        train_indptr, train_indices = build_user_item_csr(meta.get("train_user_items", {}), num_users)
+    rows, cols = csr_gather(train_indptr, train_indices, test_users)
+    scores.index_put_(
+        (torch.from_numpy(rows).to(device), torch.from_numpy(cols).to(device)),
+        torch.tensor(-float('inf'), device=device)
+    )
+    
+    # Get top-k recommendations
+    _, indices = torch.topk(scores, k=top_k, dim=1)
+    
+    # Pad each user's test items to [num_test_users, max_true] with a -1 sentinel
+    test_indptr, test_indices = build_user_item_csr(test_user_items, num_users)
+    rows, items = csr_gather(test_indptr, test_indices, test_users)
+    num_true = test_indptr[test_users + 1] - test_indptr[test_users]
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(num_true) - num_true, num_true)
+    true_items = torch.full((len(test_users), num_true.max()), -1, dtype=torch.long, device=device)
+    true_items[torch.from_numpy(rows).to(device), torch.from_numpy(slots).to(device)] = torch.from_numpy(items).to(device)
     
-    avg_recall = sum(recalls) / len(recalls) if recalls else 0
-    avg_ndcg = sum(ndcgs) / len(ndcgs) if ndcgs else 0
+    # Calculate metrics over the whole users x top_k hit matrix on the device
+    hits = (indices.unsqueeze(-1) == true_items.unsqueeze(1)).any(dim=-1).float()
+    discount = 1.0 / torch.log2(torch.arange(2, top_k + 2, device=device, dtype=torch.float))
+    recalls = hits.sum(dim=1) / torch.from_numpy(num_true).to(device)
+    ndcgs = (hits * discount).sum(dim=1)
     
-    return avg_recall, avg_ndcg
+    return recalls.mean().item(), ndcgs.mean().item()
 
 def plot_training_curves(train_losses, test_recalls, test_ndcgs, args):
     """Plot training and evaluation curves."""
@@ -363,12 +665,32 @@ def parse_args():
                         help="Weight decay for Adam optimizer")
     parser.add_argument("--reg_weight", type=float, default=1e-4, 
                         help="Weight for L2 regularization")
+    parser.add_argument("--propagation_freq", type=int, default=1, 
+                        help="Re-run graph propagation every N batches, training on cached embeddings in between")
+    parser.add_argument("--sparse_embeddings", action="store_true", 
+                        help="Row-sparse embedding gradients with SparseAdam (requires --propagation_freq > 1)")
+    parser.add_argument("--checkpoint_propagation", action="store_true", 
+                        help="Recompute LightGCN layer activations in backward instead of storing them")
+    parser.add_argument("--amp", action="store_true", 
+                        help="Run the forward pass and BPR loss under bf16 autocast on CUDA")
+    parser.add_argument("--compile", action="store_true", 
+                        help="Compile the forward pass and BPR loss with torch.compile")
+    parser.add_argument("--cuda_graph", action="store_true", 
+                        help="Capture gradient-free LightGCN propagation in a CUDA graph and replay it")
+    parser.add_argument("--gpu_sampling", action="store_true", 
+                        help="Sample BPR batches on the training device instead of in DataLoader workers")
+    parser.add_argument("--num_workers", type=int, default=4, 
+                        help="Number of DataLoader workers for BPR sampling (0 samples in the main process)")
     
     # Evaluation arguments
     parser.add_argument("--top_k", type=int, default=10, 
                         help="K value for evaluation metrics")
     parser.add_argument("--eval_freq", type=int, default=5, 
                         help="Evaluate every N epochs")
+    parser.add_argument("--log_every", type=int, default=50, 
+                        help="Show the batch loss in the progress bar every N batches")
+    parser.add_argument("--visualize_every", type=int, default=0, 
+                        help="Plot embeddings with UMAP every N epochs (0 disables)")
     
     # Other arguments
     parser.add_argument("--seed", type=int, default=42, 
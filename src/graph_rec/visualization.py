@@ -9,51 +9,98 @@ This module provides visualization routines:
 
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 import torch
 import umap
 from sklearn.manifold import TSNE
 
+try:
+    import cupy
+    from cuml.manifold import UMAP as cuUMAP, TSNE as cuTSNE
+    _CUML_AVAILABLE = True
+except ImportError:
+    _CUML_AVAILABLE = False
+
 def plot_subgraph(data, num_nodes=100):
     """
     Plots a subgraph with a limited number of nodes.
     """
-    edge_index = data.edge_index.cpu().numpy()
     G = nx.Graph()
     # Use only the first num_nodes nodes for visualization.
-    for i in range(num_nodes):
-        G.add_node(i)
-    for src, dst in zip(edge_index[0], edge_index[1]):
-        if src < num_nodes and dst < num_nodes:
-            G.add_edge(src, dst)
+    G.add_nodes_from(range(num_nodes))
+    # Filter on the edge_index's own device, so only the subgraph's edges are copied to the host
+    mask = (data.edge_index < num_nodes).all(dim=0)
+    G.add_edges_from(data.edge_index[:, mask].t().tolist())
     plt.figure(figsize=(8, 8))
     nx.draw(G, with_labels=True, node_color="skyblue", edge_color="gray")
     plt.title("Subgraph Visualization")
     plt.show()
 
-def visualize_embeddings(embeddings, method="umap", title="Embedding Visualization"):
+def visualize_embeddings(embeddings, method="umap", title="Embedding Visualization",
+                         reducer=None, max_points=5000, save_path=None):
     """
     Reduces embedding dimensions and plots them.
     
+    With RAPIDS cuML installed and a GPU available, UMAP/t-SNE run on the GPU on the
+    embeddings as they are on the device; otherwise the umap-learn / scikit-learn CPU
+    implementations are used.
+    
     Args:
         embeddings (Tensor or np.array): Node embeddings.
         method (str): "umap" or "tsne".
+        title (str): Plot title.
+        reducer (umap.UMAP or cuml UMAP, optional): Fitted UMAP reducer to reuse with transform() instead of refitting.
+        max_points (int, optional): Plot a fixed random subset of at most this many nodes.
+        save_path (str, optional): Save the figure to this path instead of showing it.
+    
+    Returns:
+        umap.UMAP, cuml UMAP or None: The fitted UMAP reducer, to pass back in on later calls.
     """
-    if isinstance(embeddings, torch.Tensor):
-        embeddings = embeddings.cpu().detach().numpy()
+    if method not in ("umap", "tsne"):
+        raise ValueError("Method must be either 'umap' or 'tsne'.")
+    if max_points is not None and len(embeddings) > max_points:
+        # Same seed every call so repeated plots show the same nodes
+        sample_idx = np.random.default_rng(42).choice(len(embeddings), max_points, replace=False)
+        if isinstance(embeddings, torch.Tensor):
+            sample_idx = torch.from_numpy(sample_idx).to(embeddings.device)
+        embeddings = embeddings[sample_idx]
+    
+    # A CPU reducer from an earlier call keeps the CPU path, so transform() sees the same library
+    use_gpu = _CUML_AVAILABLE and torch.cuda.is_available() and not isinstance(reducer, umap.UMAP)
+    if use_gpu:
+        # cuML consumes CuPy arrays directly, without a round trip through host memory
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = cupy.asarray(embeddings.detach().cuda())
+        else:
+            embeddings = cupy.asarray(embeddings)
+        umap_cls, tsne_cls = cuUMAP, cuTSNE
+    else:
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.cpu().detach().numpy()
+        umap_cls, tsne_cls = umap.UMAP, TSNE
+    
     if method == "umap":
-        reducer = umap.UMAP(n_neighbors=15, min_dist=0.1, random_state=42)
-        proj = reducer.fit_transform(embeddings)
-    elif method == "tsne":
-        proj = TSNE(n_components=2, random_state=42).fit_transform(embeddings)
+        if reducer is None:
+            reducer = umap_cls(n_neighbors=15, min_dist=0.1, random_state=42)
+            proj = reducer.fit_transform(embeddings)
+        else:
+            proj = reducer.transform(embeddings)
     else:
-        raise ValueError("Method must be either 'umap' or 'tsne'.")
+        proj = tsne_cls(n_components=2, random_state=42).fit_transform(embeddings)
+    if use_gpu:
+        proj = cupy.asnumpy(proj)
     
-    plt.figure(figsize=(8, 6))
+    fig = plt.figure(figsize=(8, 6))
     plt.scatter(proj[:, 0], proj[:, 1], s=5, alpha=0.7)
     plt.title(title)
     plt.xlabel("Component 1")
     plt.ylabel("Component 2")
-    plt.show()
+    if save_path:
+        fig.savefig(save_path)
+    else:
+        plt.show()
+    plt.close(fig)
+    return reducer
 
 if __name__ == "__main__":
     import os
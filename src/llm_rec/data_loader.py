@@ -5,9 +5,17 @@ Utilities for loading and filtering data for the product recommendation system.
 """
 
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import json
 from typing import Set, Dict, Tuple
 
+try:
+    import ijson
+    _IJSON_AVAILABLE = True
+except ImportError:
+    _IJSON_AVAILABLE = False
+
 
 def load_customer_ids_from_json(json_file: str) -> Set[str]:
     """
@@ -19,11 +27,14 @@ def load_customer_ids_from_json(json_file: str) -> Set[str]:
     Returns:
         Set of unique customer IDs
     """
-    with open(json_file, 'r') as f:
-        data = json.load(f)
-    # Extract the customer ID from the 'input' field, assuming format "Customer ID: <id>"
-    customer_ids = [entry['input'].replace('Customer ID: ', '').strip() for entry in data]
-    return set(customer_ids)
+    # Stream the 'input' fields instead of parsing the whole file into memory (with ijson),
+    # assuming format "Customer ID: <id>"
+    with open(json_file, 'rb') as f:
+        if _IJSON_AVAILABLE:
+            inputs = ijson.items(f, 'item.input')
+        else:
+            inputs = (example['input'] for example in json.load(f))
+        return {value.removeprefix('Customer ID: ').strip() for value in inputs}
 
 
 def load_and_filter_data(train_json: str, val_json: str, 
@@ -50,18 +61,25 @@ def load_and_filter_data(train_json: str, val_json: str,
     all_customer_ids = train_customers.union(val_customers)
     print(f"Total unique customers: {len(all_customer_ids)}")
 
-    # Filter transactions CSV
-    transactions_df = pd.read_csv(transactions_path)
-    filtered_transactions = transactions_df[transactions_df['customer_id'].isin(all_customer_ids)]
+    # Filter transactions CSV while scanning, so only matching rows are materialized
+    transactions_table = ds.dataset(transactions_path, format="csv").to_table(
+        filter=pc.field('customer_id').isin(list(all_customer_ids))
+    )
+    filtered_transactions = transactions_table.to_pandas()
     
-    # Filter customers CSV
-    customers_df = pd.read_csv(customers_path)
-    filtered_customers = customers_df[customers_df['customer_id'].isin(all_customer_ids)]
+    # Filter customers CSV with an inner merge on the unique ids (order of customers_df is kept;
+    # the large transactions filter runs inside the Arrow scan)
+    customers_df = pd.read_csv(customers_path, engine="pyarrow")
+    filtered_customers = customers_df.merge(
+        pd.DataFrame({'customer_id': list(all_customer_ids)}), on='customer_id', how='inner'
+    )
     
     # Filter articles CSV to only those referenced in the filtered transactions
     article_ids_in_transactions = filtered_transactions['article_id'].unique()
-    articles_df = pd.read_csv(articles_path)
-    filtered_articles = articles_df[articles_df['article_id'].isin(article_ids_in_transactions)]
+    articles_df = pd.read_csv(articles_path, engine="pyarrow")
+    filtered_articles = articles_df.merge(
+        pd.DataFrame({'article_id': article_ids_in_transactions}), on='article_id', how='inner'
+    )
     
     return filtered_transactions, filtered_customers, filtered_articles
 
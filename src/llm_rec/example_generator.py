@@ -5,13 +5,86 @@ Functions for generating training examples for the recommendation system.
 """
 
 import pandas as pd
+import numpy as np
 import json
+from dataclasses import dataclass
 from datetime import timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Union, Iterable, Iterator
+
+from id_mapper import map_customer_ids
+
+try:
+    from numba import njit
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+try:
+    import orjson
+    _ORJSON_AVAILABLE = True
+except ImportError:
+    _ORJSON_AVAILABLE = False
+
+try:
+    from joblib import Parallel, delayed, effective_n_jobs
+    _JOBLIB_AVAILABLE = True
+except ImportError:
+    _JOBLIB_AVAILABLE = False
+
+
+def _records(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """
+    Same result as df.to_dict(orient='records'), built from whole columns.
+    
+    Each column is converted to Python objects once with Series.tolist(), and the row
+    dicts are zipped together, instead of pandas inspecting and boxing every row.
+    """
+    columns = list(df.columns)
+    values = [df[col].tolist() for col in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def _history_splits(times, starts, ends, min_transactions, holdout_ns, max_transactions):
+    """
+    History/future split of every customer's date-sorted transaction range.
+    
+    Customers with at least min_transactions keep the last holdout_ns of their history as
+    future transactions, the others the last 30%. History is truncated to its last
+    max_transactions rows.
+    
+    Args:
+        times: int64 array of transaction timestamps (ns), sorted within each customer
+        starts, ends: int64 arrays with each customer's [start, end) row range
+        
+    Returns:
+        (hist_starts, splits): history is rows [hist_start, split), future [split, end)
+    """
+    n = len(starts)
+    hist_starts = np.empty(n, dtype=np.int64)
+    splits = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        start, end = starts[i], ends[i]
+        num_tx = end - start
+        if num_tx >= min_transactions:
+            if num_tx > 0:
+                # The range is sorted, so rows up to the cutoff are a prefix
+                cutoff = times[end - 1] - holdout_ns
+                split = start + np.searchsorted(times[start:end], cutoff, side='right')
+            else:
+                split = start
+        else:
+            split = start + int(num_tx * 0.7)
+        hist_starts[i] = max(start, split - max_transactions)
+        splits[i] = split
+    return hist_starts, splits
+
+if _NUMBA_AVAILABLE:
+    # Compiled once and cached on disk
+    _history_splits = njit(cache=True)(_history_splits)
 
 
 def generate_single_example(original_customer_id: str, 
-                           customer_id_mapping: Dict[str, int],
+                           customer_id_mapping: Union[pd.Series, Dict[str, int]],
                            filtered_customers: pd.DataFrame, 
                            filtered_transactions: pd.DataFrame,
                            filtered_articles: pd.DataFrame) -> Dict[str, Any]:
@@ -20,7 +93,7 @@ def generate_single_example(original_customer_id: str,
     
     Args:
         original_customer_id: Original customer ID
-        customer_id_mapping: Dictionary mapping original customer IDs to simple numeric IDs
+        customer_id_mapping: Mapping from original customer IDs to simple numeric IDs
         filtered_customers: DataFrame containing customer data
         filtered_transactions: DataFrame containing transaction data
         filtered_articles: DataFrame containing article data
@@ -31,6 +104,7 @@ def generate_single_example(original_customer_id: str,
     simple_customer_id = customer_id_mapping.get(original_customer_id)
     if simple_customer_id is None:
         raise ValueError(f"Mapping for customer {original_customer_id} not found")
+    simple_customer_id = int(simple_customer_id)
 
     # Retrieve Customer Profile
     cust_profile = filtered_customers[filtered_customers['customer_id'] == original_customer_id]
@@ -43,7 +117,7 @@ def generate_single_example(original_customer_id: str,
     if not cust_transactions.empty:
         # Merge each transaction with article features (on article_id)
         cust_transactions = cust_transactions.merge(filtered_articles, on='article_id', how='left')
-        transactions_list = cust_transactions.to_dict(orient='records')
+        transactions_list = _records(cust_transactions)
     else:
         transactions_list = []
 
@@ -63,29 +137,37 @@ def generate_single_example(original_customer_id: str,
     return input_data
 
 
-def generate_bulk_examples(customer_ids: List[str],
-                          customer_id_mapping: Dict[str, int],
-                          filtered_customers: pd.DataFrame,
-                          filtered_transactions: pd.DataFrame,
-                          filtered_articles: pd.DataFrame,
-                          min_transactions: int = 10,
-                          holdout_days: int = 7,
-                          max_transactions: int = 50) -> List[Dict[str, str]]:
+@dataclass
+class PreparedFrames:
     """
-    Generate bulk training examples for multiple customers with train/test split.
+    Column-filtered frames used for example generation, built once by prepare_frames.
+    
+    Attributes:
+        customers_by_id: Customer profiles indexed by customer_id
+        transactions: Transactions merged with article details, sorted by (customer_id, t_dat)
+        tx_customers: customer_id column of transactions, for [start, end) range lookups
+        tx_times: t_dat column of transactions as int64 nanoseconds
+    """
+    customers_by_id: pd.DataFrame
+    transactions: pd.DataFrame
+    tx_customers: np.ndarray
+    tx_times: np.ndarray
+
+
+def prepare_frames(filtered_customers: pd.DataFrame,
+                   filtered_transactions: pd.DataFrame,
+                   filtered_articles: pd.DataFrame) -> PreparedFrames:
+    """
+    Select, merge and sort the input frames once, so repeated (e.g. per shard) calls to
+    iter_bulk_examples / generate_bulk_examples can share the result.
     
     Args:
-        customer_ids: List of customer IDs to process
-        customer_id_mapping: Dictionary mapping original customer IDs to simple numeric IDs
         filtered_customers: DataFrame containing customer data
-        filtered_transactions: DataFrame containing transaction data with 't_dat' as datetime
+        filtered_transactions: DataFrame containing transaction data
         filtered_articles: DataFrame containing article data
-        min_transactions: Minimum transactions to use fixed holdout period
-        holdout_days: Number of days to hold out for testing if sufficient transactions
-        max_transactions: Maximum number of historical transactions to include
         
     Returns:
-        List of dictionaries containing input/output pairs for training
+        PreparedFrames
     """
     # Ensure transactions have datetime format
     if not pd.api.types.is_datetime64_dtype(filtered_transactions['t_dat']):
@@ -103,56 +185,110 @@ def generate_bulk_examples(customer_ids: List[str],
     filtered_transactions = filtered_transactions[relevant_tx_cols]
     filtered_articles = filtered_articles[relevant_article_cols]
     
-    training_examples = []
+    # Merge article details into all transactions once and sort them by (customer, date),
+    # so every customer's history is one contiguous [start, end) row range
+    filtered_transactions = filtered_transactions.merge(filtered_articles, on='article_id', how='left')
+    filtered_transactions = filtered_transactions.sort_values(by=['customer_id', 't_dat'], kind='stable',
+                                                              ignore_index=True)
+    cust_by_id = filtered_customers.drop_duplicates('customer_id').set_index('customer_id')
+    return PreparedFrames(cust_by_id, filtered_transactions, filtered_transactions['customer_id'].to_numpy(),
+                          filtered_transactions['t_dat'].to_numpy().astype('datetime64[ns]').view(np.int64))
 
-    for cust_id in customer_ids:
-        # Map the long customer ID to a simple numeric ID
-        simple_id = customer_id_mapping.get(cust_id)
-        if simple_id is None:
-            continue
-        
-        # Retrieve customer profile and keep only relevant columns, then remove the original customer_id key
-        cust_profile_df = filtered_customers[filtered_customers['customer_id'] == cust_id]
-        if cust_profile_df.empty:
-            continue
-        cust_profile = cust_profile_df.iloc[0].to_dict()
-        cust_profile.pop('customer_id', None)
+
+def generate_bulk_examples(customer_ids: List[str],
+                          customer_id_mapping: Union[pd.Series, Dict[str, int]],
+                          filtered_customers: Optional[pd.DataFrame],
+                          filtered_transactions: Optional[pd.DataFrame],
+                          filtered_articles: Optional[pd.DataFrame],
+                          min_transactions: int = 10,
+                          holdout_days: int = 7,
+                          max_transactions: int = 50,
+                          prepared: Optional[PreparedFrames] = None) -> List[Dict[str, str]]:
+    """
+    Generate bulk training examples for multiple customers with train/test split.
+    
+    Collects iter_bulk_examples into a list; see there for the arguments.
+    """
+    return list(iter_bulk_examples(customer_ids, customer_id_mapping, filtered_customers,
+                                   filtered_transactions, filtered_articles,
+                                   min_transactions, holdout_days, max_transactions, prepared))
+
+
+def iter_bulk_examples(customer_ids: List[str],
+                       customer_id_mapping: Union[pd.Series, Dict[str, int]],
+                       filtered_customers: Optional[pd.DataFrame],
+                       filtered_transactions: Optional[pd.DataFrame],
+                       filtered_articles: Optional[pd.DataFrame],
+                       min_transactions: int = 10,
+                       holdout_days: int = 7,
+                       max_transactions: int = 50,
+                       prepared: Optional[PreparedFrames] = None) -> Iterator[Dict[str, str]]:
+    """
+    Generate training examples one customer at a time, with train/test split.
+    
+    Yielding instead of collecting lets save_training_examples write each example as it
+    is produced, without holding all of them in memory.
+    
+    Args:
+        customer_ids: List of customer IDs to process
+        customer_id_mapping: Mapping from original customer IDs to simple numeric IDs
+        filtered_customers: DataFrame containing customer data
+        filtered_transactions: DataFrame containing transaction data with 't_dat' as datetime
+        filtered_articles: DataFrame containing article data
+        min_transactions: Minimum transactions to use fixed holdout period
+        holdout_days: Number of days to hold out for testing if sufficient transactions
+        max_transactions: Maximum number of historical transactions to include
+        prepared: Output of prepare_frames to reuse; when given, the three frames are ignored
         
-        # Retrieve the customer's transaction history and sort by date
-        cust_tx = filtered_transactions[filtered_transactions['customer_id'] == cust_id].copy()
-        cust_tx.sort_values(by='t_dat', inplace=True)
-        num_tx = len(cust_tx)
+    Yields:
+        Dictionaries containing input/output pairs for training
+    """
+    if prepared is None:
+        prepared = prepare_frames(filtered_customers, filtered_transactions, filtered_articles)
+    cust_by_id = prepared.customers_by_id
+    filtered_transactions = prepared.transactions
+    
+    # Map the long customer IDs to simple numeric IDs in one lookup, and drop customers
+    # without a mapping or a profile up front
+    mapped = map_customer_ids(customer_id_mapping, customer_ids)
+    valid = (mapped.notna() & mapped.index.isin(cust_by_id.index)).to_numpy()
+    customer_ids = np.asarray(customer_ids, dtype=object)[valid]
+    simple_ids = mapped.to_numpy()[valid].astype(np.int64).tolist()
+    
+    tx_customers = prepared.tx_customers
+    tx_starts = np.searchsorted(tx_customers, customer_ids, side='left')
+    tx_ends = np.searchsorted(tx_customers, customer_ids, side='right')
+    
+    # Cutoff strategy based on number of transactions, for all customers in one pass over
+    # their sorted ranges: history is [hist_start, split) (truncated), future [split, end)
+    holdout_ns = timedelta(days=holdout_days) // timedelta(microseconds=1) * 1000
+    hist_starts, splits = _history_splits(prepared.tx_times, tx_starts.astype(np.int64), tx_ends.astype(np.int64),
+                                          min_transactions, holdout_ns, max_transactions)
+    
+    for cust_id, simple_id, tx_start, tx_end, hist_start, split in zip(
+            customer_ids, simple_ids, tx_starts, tx_ends, hist_starts, splits):
+        # Retrieve customer profile and keep only relevant columns, without the original customer_id key
+        cust_profile = cust_by_id.loc[cust_id].to_dict()
         
-        # Apply cutoff strategy based on number of transactions
-        if num_tx >= min_transactions:
-            last_date = cust_tx['t_dat'].max()
-            cutoff_date = last_date - timedelta(days=holdout_days)
-            hist_tx = cust_tx[cust_tx['t_dat'] <= cutoff_date]
-            future_tx = cust_tx[cust_tx['t_dat'] > cutoff_date]
+        # Retrieve the customer's historical and future transactions, already sorted by date
+        hist_tx = filtered_transactions.iloc[hist_start:split]
+        future_tx = filtered_transactions.iloc[split:tx_end]
+        if tx_end - tx_start >= min_transactions:
             strategy_used = f"Fixed {holdout_days}-day cutoff."
         else:
-            split_idx = int(num_tx * 0.7)
-            hist_tx = cust_tx.iloc[:split_idx]
-            future_tx = cust_tx.iloc[split_idx:]
             strategy_used = "70/30 split due to low transaction count."
         
-        # Truncate historical transactions if there are too many
-        if len(hist_tx) > max_transactions:
-            hist_tx = hist_tx.iloc[-max_transactions:]
-        
-        # Merge historical transactions with article details and drop the original customer_id
+        # Historical transactions (article details already merged), without the original customer_id
         if not hist_tx.empty:
-            hist_tx = hist_tx.merge(filtered_articles, on='article_id', how='left')
             hist_tx = hist_tx.drop(columns=["customer_id"], errors='ignore')
-            hist_list = hist_tx.to_dict(orient='records')
+            hist_list = _records(hist_tx)
         else:
             hist_list = []
         
-        # Merge future transactions with article details for ground truth and drop the original customer_id
+        # Future transactions with article details for ground truth, without the original customer_id
         if not future_tx.empty:
-            future_tx = future_tx.merge(filtered_articles, on='article_id', how='left')
             future_tx = future_tx.drop(columns=["customer_id"], errors='ignore')
-            future_list = future_tx.to_dict(orient='records')
+            future_list = _records(future_tx)
         else:
             future_list = []
         
@@ -173,26 +309,85 @@ def generate_bulk_examples(customer_ids: List[str],
             "Ground_Truth_Future_Transactions": future_list
         }
         
-        training_examples.append({
+        yield {
             "input": json.dumps(input_data, indent=2, default=str),
             "output": json.dumps(output_data, indent=2, default=str)
-        })
+        }
+
+
+def iter_bulk_examples_parallel(customer_ids: List[str],
+                                customer_id_mapping: Union[pd.Series, Dict[str, int]],
+                                filtered_customers: Optional[pd.DataFrame],
+                                filtered_transactions: Optional[pd.DataFrame],
+                                filtered_articles: Optional[pd.DataFrame],
+                                min_transactions: int = 10,
+                                holdout_days: int = 7,
+                                max_transactions: int = 50,
+                                prepared: Optional[PreparedFrames] = None,
+                                n_jobs: int = -1,
+                                min_chunk_size: int = 50) -> Iterator[Dict[str, str]]:
+    """
+    iter_bulk_examples spread over worker processes, one chunk of customers per task.
+    
+    The frames are prepared once here and shared with the workers (joblib memory-maps
+    their large arrays); examples are yielded in customer order as chunks complete, so
+    the output matches iter_bulk_examples.
     
-    return training_examples
+    Args:
+        n_jobs: Number of worker processes (-1: all CPUs)
+        min_chunk_size: Smallest number of customers per task
+        (the other arguments are as for iter_bulk_examples)
+        
+    Yields:
+        Dictionaries containing input/output pairs for training
+    """
+    if prepared is None:
+        prepared = prepare_frames(filtered_customers, filtered_transactions, filtered_articles)
+    
+    num_workers = effective_n_jobs(n_jobs) if _JOBLIB_AVAILABLE else 1
+    chunk_size = max(min_chunk_size, -(-len(customer_ids) // num_workers))
+    chunks = [customer_ids[start:start + chunk_size] for start in range(0, len(customer_ids), chunk_size)]
+    if len(chunks) <= 1:
+        # Too few customers to be worth starting workers (or no joblib)
+        yield from iter_bulk_examples(customer_ids, customer_id_mapping, None, None, None,
+                                      min_transactions, holdout_days, max_transactions, prepared)
+        return
+    
+    results = Parallel(n_jobs=n_jobs, backend="loky", return_as="generator")(
+        delayed(generate_bulk_examples)(chunk, customer_id_mapping, None, None, None,
+                                        min_transactions, holdout_days, max_transactions, prepared)
+        for chunk in chunks
+    )
+    for examples in results:
+        yield from examples
 
 
-def save_training_examples(examples: List[Dict[str, str]], output_path: str) -> None:
+def save_training_examples(examples: Iterable[Dict[str, str]], output_path: str) -> int:
     """
-    Save training examples to a JSON file.
+    Save training examples to a JSON Lines file, one example per line.
+    
+    Examples are written as they are consumed, so a generator (iter_bulk_examples) is
+    never materialized.
     
     Args:
-        examples: List of training examples (input/output pairs)
-        output_path: Path to save the JSON file
+        examples: Iterable of training examples (input/output pairs)
+        output_path: Path to save the JSON Lines file
+        
+    Returns:
+        Number of examples written
     """
-    with open(output_path, 'w') as f:
-        json.dump(examples, f, indent=2, default=str)
+    num_examples = 0
+    with open(output_path, 'wb') as f:
+        for example in examples:
+            if _ORJSON_AVAILABLE:
+                f.write(orjson.dumps(example, default=str))
+            else:
+                f.write(json.dumps(example, default=str, ensure_ascii=False, separators=(',', ':')).encode())
+            f.write(b"\n")
+            num_examples += 1
     
-    print(f"Created training examples for {len(examples)} customers. Saved to {output_path}.")
+    print(f"Created training examples for {num_examples} customers. Saved to {output_path}.")
+    return num_examples
 
 
 if __name__ == "__main__":
@@ -221,4 +416,4 @@ if __name__ == "__main__":
     )
     
     # Save examples
-    save_training_examples(examples, 'test_training_examples.json')
+    save_training_examples(examples, 'test_training_examples.jsonl')
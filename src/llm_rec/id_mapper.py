@@ -4,11 +4,12 @@ id_mapper.py
 Utilities for creating and managing customer ID mappings.
 """
 
+import numpy as np
 import pandas as pd
-from typing import Dict
+from typing import Dict, Union
 
 
-def create_customer_id_mapping(customers_df: pd.DataFrame) -> Dict[str, int]:
+def create_customer_id_mapping(customers_df: pd.DataFrame) -> pd.Series:
     """
     Create a mapping from original customer IDs to simple numeric IDs.
     
@@ -16,31 +17,50 @@ def create_customer_id_mapping(customers_df: pd.DataFrame) -> Dict[str, int]:
         customers_df: DataFrame containing customer information with 'customer_id' column
         
     Returns:
-        Dictionary mapping original customer_id to simple numeric ID
+        Series indexed by original customer_id with the simple numeric ID (int32) as value
     """
-    # Create a mapping: long customer_id -> simple numeric ID (starting from 1)
+    # Create a mapping: long customer_id -> simple numeric ID (starting from 1), kept as a
+    # Series so lookups for many IDs at once are a single reindex
     unique_customer_ids = customers_df['customer_id'].unique()
-    customer_id_mapping = {cid: idx for idx, cid in enumerate(unique_customer_ids, start=1)}
-    return customer_id_mapping
+    return pd.Series(np.arange(1, len(unique_customer_ids) + 1, dtype=np.int32), index=unique_customer_ids)
 
 
-def save_customer_id_mapping(customer_id_mapping: Dict[str, int], output_path: str = 'customer_id_mapping.csv') -> None:
+def map_customer_ids(customer_id_mapping: Union[pd.Series, Dict[str, int]], customer_ids) -> pd.Series:
+    """
+    Look up the simple numeric IDs of many customers at once.
+    
+    Args:
+        customer_id_mapping: Mapping from create_customer_id_mapping (a plain dict is also accepted)
+        customer_ids: Original customer IDs
+        
+    Returns:
+        Series aligned with customer_ids; NaN where a customer has no mapping
+    """
+    if not isinstance(customer_id_mapping, pd.Series):
+        customer_id_mapping = pd.Series(customer_id_mapping)
+    return customer_id_mapping.reindex(customer_ids)
+
+
+def save_customer_id_mapping(customer_id_mapping: Union[pd.Series, Dict[str, int]],
+                             output_path: str = 'customer_id_mapping.csv') -> None:
     """
     Save customer ID mapping to CSV for future reference.
     
     Args:
-        customer_id_mapping: Dictionary mapping original customer_id to simple numeric ID
+        customer_id_mapping: Mapping from original customer_id to simple numeric ID
         output_path: Path to save the mapping CSV
     """
+    if not isinstance(customer_id_mapping, pd.Series):
+        customer_id_mapping = pd.Series(customer_id_mapping)
     mapping_df = pd.DataFrame({
-        'original_customer_id': list(customer_id_mapping.keys()),
-        'simple_customer_id': list(customer_id_mapping.values())
+        'original_customer_id': customer_id_mapping.index,
+        'simple_customer_id': customer_id_mapping.to_numpy()
     })
     mapping_df.to_csv(output_path, index=False)
     print(f"Customer ID mapping saved to {output_path}")
 
 
-def load_customer_id_mapping(mapping_path: str = 'customer_id_mapping.csv') -> Dict[str, int]:
+def load_customer_id_mapping(mapping_path: str = 'customer_id_mapping.csv') -> pd.Series:
     """
     Load customer ID mapping from CSV.
     
@@ -48,11 +68,10 @@ def load_customer_id_mapping(mapping_path: str = 'customer_id_mapping.csv') -> D
         mapping_path: Path to the mapping CSV
         
     Returns:
-        Dictionary mapping original customer_id to simple numeric ID
+        Series indexed by original customer_id with the simple numeric ID as value
     """
     mapping_df = pd.read_csv(mapping_path)
-    customer_id_mapping = dict(zip(mapping_df['original_customer_id'], mapping_df['simple_customer_id']))
-    return customer_id_mapping
+    return pd.Series(mapping_df['simple_customer_id'].to_numpy(), index=mapping_df['original_customer_id'].to_numpy())
 
 
 if __name__ == "__main__":
@@ -6,18 +6,25 @@ Main script to run the complete recommendation system pipeline:
 2. Create customer ID mappings
 3. Generate training examples
 4. Fine-tune the language model
+
+Fine-tuning uses every GPU (DistributedDataParallel) when launched with torchrun:
+    torchrun --nproc_per_node=N src/llm_rec/main.py [args]
+The first rank alone prepares the training data; the others wait for it.
 """
 
 import os
+import math
 import argparse
+from datetime import timedelta
 import pandas as pd
-from transformers import AutoTokenizer
+import torch
+import torch.distributed as dist
 
 # Import our modules
 from data_loader import load_and_filter_data, save_filtered_data
 from id_mapper import create_customer_id_mapping, save_customer_id_mapping
-from example_generator import generate_bulk_examples, save_training_examples
-from model_trainer import prepare_dataset, tokenize_dataset, fine_tune_model
+from example_generator import iter_bulk_examples_parallel, save_training_examples
+from model_trainer import load_tokenizer, load_or_tokenize_dataset, fine_tune_model
 
 
 def parse_arguments():
@@ -40,23 +47,41 @@ def parse_arguments():
                         help='Articles CSV file name')
     parser.add_argument('--num_examples', type=int, default=1000,
                         help='Number of training examples to generate')
+    parser.add_argument('--example_workers', type=int, default=-1,
+                        help='Number of processes generating training examples (-1: all CPUs)')
     parser.add_argument('--model_name', type=str, default='EleutherAI/gpt-neo-1.3B',
                         help='Pre-trained model to fine-tune')
     parser.add_argument('--epochs', type=int, default=3,
                         help='Number of training epochs')
+    parser.add_argument('--per_device_batch_size', type=int, default=2,
+                        help='Training batch size per GPU')
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
+                        help='Number of batches to accumulate gradients over per optimizer step')
+    parser.add_argument('--bf16', action='store_true',
+                        help='Force bfloat16 mixed precision (default: bf16 where the GPU supports it, else fp16)')
+    parser.add_argument('--ddp_find_unused_parameters', action='store_true',
+                        help='Let DDP search for parameters without gradients (slower; only needed if some are unused)')
+    parser.add_argument('--torch_compile', action='store_true',
+                        help='Compile the model forward/backward with torch.compile (inductor)')
+    parser.add_argument('--qlora', action='store_true',
+                        help='Train LoRA adapters on a 4-bit quantized model (requires bitsandbytes and peft)')
+    parser.add_argument('--stream_dataset', action='store_true',
+                        help='Stream and tokenize the training data lazily instead of loading it into memory')
+    parser.add_argument('--force_retokenize', action='store_true',
+                        help='Retokenize the training data even if a cached tokenized copy exists')
     parser.add_argument('--skip_fine_tuning', action='store_true',
                         help='Skip model fine-tuning step')
     
     return parser.parse_args()
 
 
-def main():
-    """Run the complete pipeline."""
-    args = parse_arguments()
-    
-    # Create output directory if it doesn't exist
-    os.makedirs(args.output_dir, exist_ok=True)
+def prepare_training_data(args) -> int:
+    """
+    Steps 1-3: load and filter the data, map the customer IDs and write the training examples.
     
+    Returns:
+        Number of training examples written
+    """
     # Step 1: Load and filter data
     print("\n=== Step 1: Loading and filtering data ===")
     train_json_path = os.path.join(args.data_dir, args.train_json)
@@ -84,36 +109,93 @@ def main():
     # Get a list of unique customer IDs to process
     customer_ids = filtered_transactions['customer_id'].unique()[:args.num_examples]
     
-    training_examples = generate_bulk_examples(
+    training_examples = iter_bulk_examples_parallel(
         customer_ids,
         customer_id_mapping,
         filtered_customers,
         filtered_transactions,
-        filtered_articles
+        filtered_articles,
+        n_jobs=args.example_workers
     )
     
-    examples_path = os.path.join(args.output_dir, f'finetuning_training_data_{len(training_examples)}_customers.json')
-    save_training_examples(training_examples, examples_path)
+    # Examples are streamed to disk, so the count in the file name is only known afterwards;
+    # the finished file replaces any earlier one atomically
+    partial_path = os.path.join(args.output_dir, 'finetuning_training_data.jsonl.partial')
+    num_examples = save_training_examples(training_examples, partial_path)
+    examples_path = os.path.join(args.output_dir, f'finetuning_training_data_{num_examples}_customers.jsonl')
+    os.replace(partial_path, examples_path)
+    return num_examples
+
+
+def main():
+    """Run the complete pipeline."""
+    args = parse_arguments()
+    
+    # Under torchrun/accelerate only the first rank prepares the data (steps 1-3); the
+    # other ranks wait for it and then join fine-tuning
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size > 1:
+        # The Trainer reuses this process group. Waiting for the data goes through a gloo
+        # group with a long timeout, since example generation can outlast the NCCL timeout
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+        data_group = dist.new_group(backend="gloo", timeout=timedelta(hours=6))
+    
+    # Create output directory if it doesn't exist
+    os.makedirs(args.output_dir, exist_ok=True)
+    
+    num_examples = None
+    if rank == 0:
+        num_examples = prepare_training_data(args)
+    if world_size > 1:
+        # Blocks the other ranks until the first one has written the examples file
+        shared = [num_examples]
+        dist.broadcast_object_list(shared, src=0, group=data_group)
+        num_examples = shared[0]
+    examples_path = os.path.join(args.output_dir, f'finetuning_training_data_{num_examples}_customers.jsonl')
     
     # Step 4: Fine-tune the model (optional)
     if not args.skip_fine_tuning:
         print("\n=== Step 4: Fine-tuning the language model ===")
         model_output_dir = os.path.join(args.output_dir, 'finetuned-model')
         
-        # Initialize tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        # Initialize tokenizer, shared by tokenization and fine-tuning
+        tokenizer = load_tokenizer(args.model_name)
         
-        # Prepare and tokenize dataset
-        dataset = prepare_dataset(examples_path)
-        tokenized_dataset = tokenize_dataset(dataset, tokenizer)
+        # Prepare and tokenize dataset, or reuse the copy from an earlier run on the same data.
+        # Under DDP only the first rank tokenizes (and saves); the others wait for it and load
+        # the saved copy (a streamed dataset is tokenized lazily by every rank instead)
+        cache_dir = os.path.join(args.output_dir, 'tokenized_cache')
+        if rank == 0 or args.stream_dataset:
+            tokenized_dataset = load_or_tokenize_dataset(
+                examples_path, tokenizer, cache_dir,
+                force=args.force_retokenize, save=True, streaming=args.stream_dataset
+            )
+        if world_size > 1 and not args.stream_dataset:
+            dist.barrier(group=data_group)
+            if rank != 0:
+                tokenized_dataset = load_or_tokenize_dataset(examples_path, tokenizer, cache_dir)
         
         # Set training arguments
         training_args = {
             "num_train_epochs": args.epochs,
             "logging_steps": 50,
             "save_total_limit": 2,
-            "fp16": True
+            "per_device_train_batch_size": args.per_device_batch_size,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            "ddp_find_unused_parameters": args.ddp_find_unused_parameters
         }
+        if args.bf16:
+            training_args.update({"bf16": True, "fp16": False})
+        if args.stream_dataset:
+            # A stream has no length, so the Trainer needs the step count up front
+            world_size = int(os.environ.get('WORLD_SIZE', 1))
+            examples_per_step = args.per_device_batch_size * args.gradient_accumulation_steps * world_size
+            training_args["max_steps"] = max(1, math.ceil(num_examples / examples_per_step) * args.epochs)
+        if args.torch_compile:
+            training_args.update({"torch_compile": True, "torch_compile_backend": "inductor"})
         
         # Fine-tune model
         fine_tune_model(
@@ -121,7 +203,8 @@ def main():
             tokenized_dataset,
             tokenizer,
             model_output_dir,
-            training_args
+            training_args,
+            qlora=args.qlora
         )
         
         print(f"\nFine-tuned model saved to {model_output_dir}")
@@ -4,47 +4,89 @@ model_trainer.py
 Functions for fine-tuning the language model on recommendation data.
 """
 
-from datasets import load_dataset, Dataset
+import os
+import hashlib
+import shutil
+import torch
+from datasets import load_dataset, load_from_disk, Dataset, IterableDataset
 from transformers import (
     AutoTokenizer, 
     AutoModelForCausalLM, 
     Trainer, 
     TrainingArguments, 
-    DataCollatorForLanguageModeling
+    DataCollatorForSeq2Seq
 )
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Union
 
+try:
+    from transformers import BitsAndBytesConfig
+    from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+    _QLORA_AVAILABLE = True
+except ImportError:
+    _QLORA_AVAILABLE = False
 
-def prepare_dataset(data_path: str) -> Dataset:
+# GPT-Neo attention and MLP projections that receive LoRA adapters
+LORA_TARGET_MODULES = ["q_proj", "v_proj", "k_proj", "out_proj", "c_fc", "c_proj"]
+
+# Text between an example's input and output in the training sequence
+OUTPUT_SEPARATOR = "\n\nOutput:\n"
+
+# Tokenizers loaded in this process, by model name
+_TOKENIZER_CACHE: Dict[str, Any] = {}
+
+
+def load_tokenizer(model_name: str):
+    """
+    Load the fast (Rust) tokenizer of a model, once per process.
+    
+    The same instance is shared by tokenization and fine-tuning, and repeated calls
+    (e.g. rerunning the pipeline in a REPL) skip parsing the vocabulary files again.
+    
+    Args:
+        model_name: Name or path of the pre-trained model
+    
+    Returns:
+        Hugging Face tokenizer
+    """
+    if model_name not in _TOKENIZER_CACHE:
+        _TOKENIZER_CACHE[model_name] = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    return _TOKENIZER_CACHE[model_name]
+
+
+def prepare_dataset(data_path: str, streaming: bool = False) -> Union[Dataset, IterableDataset]:
     """
     Load and prepare dataset for fine-tuning.
     
     Args:
-        data_path: Path to the training data JSON file
+        data_path: Path to the training data JSON (or JSON Lines) file
+        streaming: Read the file lazily as an IterableDataset instead of loading it whole
     
     Returns:
-        Dataset prepared for training
+        Dataset with "input" and "output" fields, joined by tokenize_dataset
     """
     # Load the JSON file with input and output fields
-    dataset = load_dataset("json", data_files={"train": data_path})
-    
-    # Combine "input" and "output" into a single "text" field for training
-    def combine_fields(example):
-        example["text"] = example["input"] + "\n\nOutput:\n" + example["output"]
-        return example
+    dataset = load_dataset("json", data_files={"train": data_path}, streaming=streaming)
+    return dataset["train"]
 
-    prepared_dataset = dataset["train"].map(combine_fields)
-    return prepared_dataset
 
-
-def tokenize_dataset(dataset: Dataset, tokenizer, max_length: int = 1024) -> Dataset:
+def tokenize_dataset(dataset: Union[Dataset, IterableDataset], tokenizer, max_length: int = 1024,
+                     batch_size: int = 4096, num_proc: Optional[int] = None) -> Union[Dataset, IterableDataset]:
     """
     Tokenize the dataset with the specified tokenizer.
     
+    Each training sequence is input + OUTPUT_SEPARATOR + output + EOS, spliced from the
+    separately tokenized parts (the separator is tokenized once). Labels are -100 over the
+    input and separator, so the loss covers only the output. Over-long sequences are
+    trimmed from the start of the input, so the output is always kept. Large batches
+    amortize the per-call overhead of a fast (Rust) tokenizer. An IterableDataset is
+    tokenized lazily, batch by batch, as training reads it.
+    
     Args:
-        dataset: Dataset with "text" field
+        dataset: Dataset with "input" and "output" fields
         tokenizer: Hugging Face tokenizer
         max_length: Maximum sequence length
+        batch_size: Number of examples per tokenizer call
+        num_proc: Number of tokenizing processes (default: half the CPUs)
     
     Returns:
         Tokenized dataset
@@ -53,42 +95,149 @@ def tokenize_dataset(dataset: Dataset, tokenizer, max_length: int = 1024) -> Dat
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
 
-    # Tokenize the dataset and set labels equal to input_ids with padding
-    def tokenize_function(example):
-        tokenized = tokenizer(
-            example["text"], 
-            truncation=True, 
-            max_length=max_length, 
-            padding="max_length"  # ensures all sequences have the same length
-        )
-        tokenized["labels"] = tokenized["input_ids"].copy()
+    separator_ids = tokenizer(OUTPUT_SEPARATOR, add_special_tokens=False)["input_ids"]
+
+    # Tokenize without padding; the data collator pads each batch to its longest sequence
+    def tokenize_function(batch):
+        input_ids = tokenizer(batch["input"], add_special_tokens=False)["input_ids"]
+        output_ids = tokenizer(batch["output"], add_special_tokens=False)["input_ids"]
+        tokenized = {"input_ids": [], "attention_mask": [], "labels": []}
+        for prompt, answer in zip(input_ids, output_ids):
+            # Cutting the joined sequence from the right would drop the output of every
+            # over-long example (no supervised tokens left), so trim the input's start
+            answer = (answer + [tokenizer.eos_token_id])[:max_length - len(separator_ids)]
+            prompt_budget = max_length - len(separator_ids) - len(answer)
+            prompt = (prompt[-prompt_budget:] if prompt_budget > 0 else []) + separator_ids
+            ids = prompt + answer
+            tokenized["input_ids"].append(ids)
+            tokenized["attention_mask"].append([1] * len(ids))
+            tokenized["labels"].append([-100] * len(prompt) + answer)
         return tokenized
 
-    tokenized_dataset = dataset.map(tokenize_function, batched=True)
+    if isinstance(dataset, IterableDataset):
+        return dataset.map(tokenize_function, batched=True, batch_size=batch_size,
+                           remove_columns=["input", "output"])
+
+    if num_proc is None:
+        num_proc = max(1, (os.cpu_count() or 1) // 2)
+    # More processes than batches would only add start-up cost
+    num_proc = min(num_proc, -(-len(dataset) // batch_size))
+    tokenized_dataset = dataset.map(tokenize_function, batched=True, batch_size=batch_size,
+                                    num_proc=num_proc if num_proc > 1 else None,
+                                    remove_columns=dataset.column_names)
+    return tokenized_dataset
+
+
+def load_or_tokenize_dataset(data_path: str, tokenizer, cache_dir: str, max_length: int = 1024,
+                             force: bool = False, save: bool = True,
+                             streaming: bool = False) -> Union[Dataset, IterableDataset]:
+    """
+    Prepare and tokenize the dataset, reusing a copy saved under cache_dir by an earlier run.
+    
+    With streaming=True the data is instead read and tokenized lazily during training
+    (memory independent of the corpus size), and nothing is cached.
+    
+    The cache is keyed on the training data's contents, the tokenizer and max_length, so a
+    regenerated but identical data file still hits it, and any change retokenizes.
+    
+    Args:
+        data_path: Path to the training data JSON (or JSON Lines) file
+        tokenizer: Hugging Face tokenizer
+        cache_dir: Directory holding tokenized datasets from earlier runs
+        max_length: Maximum sequence length
+        force: Retokenize even if a cached copy exists
+        save: Save a freshly tokenized dataset to cache_dir (e.g. only on the first rank)
+        streaming: Stream the data as an IterableDataset
+    
+    Returns:
+        Tokenized dataset
+    """
+    if streaming:
+        return tokenize_dataset(prepare_dataset(data_path, streaming=True), tokenizer, max_length)
+    
+    digest = hashlib.md5(f"{tokenizer.name_or_path}:{max_length}:{OUTPUT_SEPARATOR}:masked-input-left-trimmed:".encode())
+    with open(data_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    dataset_dir = os.path.join(cache_dir, f"tokenized_{digest.hexdigest()}")
+    
+    if os.path.isdir(dataset_dir) and not force:
+        print(f"Loading tokenized dataset from {dataset_dir}")
+        # tokenize_dataset, which sets the pad token, is skipped on a cache hit
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        return load_from_disk(dataset_dir)
+    
+    tokenized_dataset = tokenize_dataset(prepare_dataset(data_path), tokenizer, max_length)
+    if save:
+        # Written next to the cache and renamed into place, so an interrupted save never
+        # leaves a partial directory that a later run would take for a cache hit
+        tmp_dir = dataset_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tokenized_dataset.save_to_disk(tmp_dir)
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        os.replace(tmp_dir, dataset_dir)
     return tokenized_dataset
 
 
 def fine_tune_model(model_name: str, 
-                   tokenized_dataset: Dataset, 
+                   tokenized_dataset: Union[Dataset, IterableDataset], 
                    tokenizer,
                    output_dir: str = "./model-finetuned-recs",
-                   training_args: Optional[Dict[str, Any]] = None) -> None:
+                   training_args: Optional[Dict[str, Any]] = None,
+                   qlora: bool = False) -> None:
     """
     Fine-tune a language model on the recommendation dataset.
     
+    With qlora=True the base model is loaded in 4-bit NF4 (bitsandbytes) and frozen, and
+    only LoRA adapters are trained (peft); output_dir then receives the adapter weights.
+    A streamed (IterableDataset) tokenized_dataset has no length, so training_args must
+    set max_steps.
+    
     Args:
         model_name: Name or path of the pre-trained model
         tokenized_dataset: Tokenized dataset for training
         tokenizer: Tokenizer for the model
         output_dir: Directory to save the fine-tuned model
         training_args: Optional dictionary of training arguments to override defaults
+        qlora: Train LoRA adapters on a 4-bit quantized base model instead of all weights
     """
-    # Create data collator for language modeling
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    if qlora and not _QLORA_AVAILABLE:
+        raise ImportError("qlora=True requires the bitsandbytes and peft packages")
+    streaming = isinstance(tokenized_dataset, IterableDataset)
+    if streaming and not (training_args or {}).get("max_steps", 0) > 0:
+        raise ValueError("A streamed dataset requires max_steps in training_args")
 
-    # Load pre-trained model
-    model = AutoModelForCausalLM.from_pretrained(model_name)
+    # Create data collator padding each batch dynamically (to a multiple of 8 for tensor
+    # cores); the prompt-masked labels are padded with -100 instead of being rebuilt
+    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, pad_to_multiple_of=8, label_pad_token_id=-100)
+
+    # bf16 keeps fp32's dynamic range (no loss scaling) where the GPU supports it
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
 
+    # Load pre-trained model
+    if qlora:
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16 if use_bf16 else torch.float16
+        )
+        # Quantized weights cannot be moved after loading, so place them on this rank's GPU
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=quantization_config,
+            device_map={"": int(os.environ.get("LOCAL_RANK", 0))}
+        )
+        model = prepare_model_for_kbit_training(
+            model, use_gradient_checkpointing=True,
+            gradient_checkpointing_kwargs={"use_reentrant": False}
+        )
+        model = get_peft_model(model, LoraConfig(
+            r=16, lora_alpha=32, target_modules=LORA_TARGET_MODULES, task_type="CAUSAL_LM"
+        ))
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+    
     # Set up training arguments with defaults
     default_args = {
         "output_dir": output_dir,
@@ -96,11 +245,31 @@ def fine_tune_model(model_name: str,
         "logging_steps": 100,
         "learning_rate": 5e-5,
         "per_device_train_batch_size": 2,
+        "group_by_length": True,  # batch similar lengths together to minimize padding
         "num_train_epochs": 3,
         "weight_decay": 0.01,
+        # One multi-tensor kernel per step instead of per-parameter updates
+        "optim": "adamw_torch_fused" if torch.cuda.is_available() else "adamw_torch",
         "save_total_limit": 2,
-        "fp16": True,
+        "bf16": use_bf16,
+        "fp16": torch.cuda.is_available() and not use_bf16,
+        # Recompute activations in backward: much less activation memory for larger batches
+        "gradient_checkpointing": True,
+        "gradient_checkpointing_kwargs": {"use_reentrant": False},
+        # Under torchrun the Trainer wraps the model in DistributedDataParallel; every
+        # parameter of a causal LM gets a gradient, so DDP can skip the unused-parameter search
+        "ddp_find_unused_parameters": False,
+        "dataloader_num_workers": 4,
+        "dataloader_pin_memory": True,
     }
+    if streaming:
+        # Lengths are unknown up front, and the file's shards cap the useful workers
+        default_args.update({"group_by_length": False,
+                             "dataloader_num_workers": min(4, tokenized_dataset.n_shards)})
+    if qlora:
+        # Adapters train with a higher learning rate; the paged 8-bit optimizer keeps
+        # its (small) state out of GPU memory during spikes
+        default_args.update({"learning_rate": 2e-4, "optim": "paged_adamw_8bit"})
     
     # Override with provided arguments if any
     if training_args:
@@ -131,11 +300,11 @@ def fine_tune_model(model_name: str,
 if __name__ == "__main__":
     # Example usage
     model_name = "EleutherAI/gpt-neo-1.3B"
-    data_path = "finetuning_training_data_1000_customers.json"
+    data_path = "finetuning_training_data_1000_customers.jsonl"
     output_dir = "./gptneo-finetuned-recs"
     
     # Initialize tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer = load_tokenizer(model_name)
     
     # Prepare and tokenize dataset
     dataset = prepare_dataset(data_path)
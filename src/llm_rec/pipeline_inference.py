@@ -167,7 +167,6 @@ import pandas as pd
 import dill
 from torch.serialization import safe_globals
 import torch_geometric.data.data as tg_data
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
 
 # --- Step 1: Load Safe Data, Metadata, and Trained GNN Model ---
 
@@ -182,11 +181,27 @@ def load_safe_data(data_path, device):
     print(f"Loading safe data from: {data_path}")
     with safe_globals([tg_data.DataEdgeAttr]):
         data = torch.load(data_path, map_location=device, pickle_module=dill, weights_only=False)
+    # Place the graph tensors on the device once here, not on every recommendation call
+    data.edge_index = data.edge_index.to(device)
+    data.edge_attr = data.edge_attr.to(device)
     return data
 
+def save_graph_tensors(data, tensors_path):
+    # Only the tensors inference needs, as plain tensors: loading them needs neither dill
+    # nor the DataEdgeAttr class
+    torch.save({"edge_index": data.edge_index.cpu(), "edge_attr": data.edge_attr.cpu()}, tensors_path)
+
+def load_graph_tensors(tensors_path, device):
+    print(f"Loading graph tensors from: {tensors_path}")
+    # Memory-mapped: the file is paged in while copying to the device, not unpickled into RAM first
+    tensors = torch.load(tensors_path, map_location="cpu", mmap=True, weights_only=True)
+    return tg_data.Data(edge_index=tensors["edge_index"].to(device), edge_attr=tensors["edge_attr"].to(device))
+
 def load_meta(meta_path):
     with open(meta_path, "rb") as f:
         meta = pickle.load(f)
+    # Item index -> article ID, built once for all recommendation calls
+    meta["reverse_article_map"] = {v: k for k, v in meta["article_id_map"].items()}
     return meta
 
 def load_trained_model(model_path, num_users, num_items, embed_dim, num_layers, model_type, device):
@@ -201,40 +216,109 @@ def load_trained_model(model_path, num_users, num_items, embed_dim, num_layers,
     model.eval()
     return model
 
+def get_embeddings(model, data):
+    # The model and graph are fixed at inference time, so propagate once and reuse the result
+    if getattr(model, "_cached_emb", None) is None:
+        with torch.inference_mode():
+            model._cached_emb = model(data.edge_index, data.edge_attr)
+    return model._cached_emb
+
+def get_item_embeddings(model, data, meta):
+    # Item embeddings as one contiguous matrix for batched scoring, built once; bf16 on
+    # CUDA halves the memory read by every score matmul
+    if getattr(model, "_cached_items", None) is None:
+        item_embeddings = get_embeddings(model, data)[meta["num_customers"]:].contiguous()
+        if item_embeddings.device.type == "cuda":
+            item_embeddings = item_embeddings.to(torch.bfloat16)
+        model._cached_items = item_embeddings
+    return model._cached_items
+
+def score_topk(user_embedding, item_embeddings, top_k):
+    scores = torch.matmul(user_embedding, item_embeddings.t())
+    return torch.topk(scores, top_k, dim=1).indices
+
+_compiled_score_topk = None
+
+def compiled_score_topk(user_embedding, item_embeddings, top_k):
+    # On CUDA, compile the single-user scoring matmul and top-k into one captured CUDA graph
+    # (fixed shapes), so each query replays it instead of launching the kernels one by one
+    global _compiled_score_topk
+    if user_embedding.device.type != "cuda":
+        return score_topk(user_embedding, item_embeddings, top_k)
+    if _compiled_score_topk is None:
+        _compiled_score_topk = torch.compile(score_topk, mode="reduce-overhead", fullgraph=True, dynamic=False)
+    return _compiled_score_topk(user_embedding, item_embeddings, top_k)
+
 def get_recommendations(model, data, meta, user_id, top_k=10):
-    device = next(model.parameters()).device
     if user_id not in meta["customer_id_map"]:
         print(f"User ID {user_id} not found in meta.")
         return []
     u_idx = meta["customer_id_map"][user_id]
     num_users = meta["num_customers"]
     
-    with torch.no_grad():
-        embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
+    embeddings = get_embeddings(model, data)
     
     user_embedding = embeddings[u_idx].unsqueeze(0)
     item_embeddings = embeddings[num_users:]
-    scores = torch.matmul(user_embedding, item_embeddings.t()).squeeze(0)
-    _, topk_indices = torch.topk(scores, top_k)
+    with torch.inference_mode():
+        topk_indices = compiled_score_topk(user_embedding, item_embeddings, top_k).squeeze(0)
     topk_indices = topk_indices.cpu().tolist()
     
     # Convert item indices back to article IDs using reverse mapping
-    reverse_article_map = {v: k for k, v in meta["article_id_map"].items()}
+    reverse_article_map = meta["reverse_article_map"]
     recommendations = [reverse_article_map.get(i, f"Unknown({i})") for i in topk_indices]
     return recommendations
 
+def get_recommendations_batched(model, data, meta, user_ids, top_k=10):
+    """
+    Top-k recommendations for many users from one score GEMM and one row-wise topk.
+    
+    Returns a dict of user ID -> recommended article IDs ([] for unknown users).
+    """
+    device = next(model.parameters()).device
+    recommendations = {uid: [] for uid in user_ids}
+    known = [uid for uid in user_ids if uid in meta["customer_id_map"]]
+    for uid in user_ids:
+        if uid not in meta["customer_id_map"]:
+            print(f"User ID {uid} not found in meta.")
+    if not known:
+        return recommendations
+    u_idx = torch.as_tensor([meta["customer_id_map"][uid] for uid in known], device=device)
+    
+    embeddings = get_embeddings(model, data)
+    item_embeddings = get_item_embeddings(model, data, meta)
+    with torch.inference_mode():
+        # Score all users at once against the cached (bf16 on CUDA) item matrix
+        user_embeddings = embeddings[u_idx].to(item_embeddings.dtype)
+        topk_indices = score_topk(user_embeddings, item_embeddings, top_k).cpu().tolist()
+    
+    reverse_article_map = meta["reverse_article_map"]
+    for uid, indices in zip(known, topk_indices):
+        recommendations[uid] = [reverse_article_map.get(i, f"Unknown({i})") for i in indices]
+    return recommendations
+
 # ----- Parameters and File Paths -----
 data_dir = "./data/processed"           # Adjust as needed
 model_dir = "./output"                  # Adjust as needed
 safe_data_path = os.path.join(data_dir, "lightgcn_data_safe.pt")
+graph_tensors_path = os.path.join(data_dir, "lightgcn_graph_tensors.pt")
 meta_path = os.path.join(data_dir, "lightgcn_meta.pkl")
 model_file = "standard_lightgcN_best.pth"  # Adjust as needed
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device: {device}")
 
-# Load safe processed graph data and metadata
-data = load_safe_data(safe_data_path, device)
+# Load processed graph data and metadata; the graph tensors are extracted from the safe
+# data once and memory-mapped from then on (until the safe data is regenerated); without the
+# safe data, the extracted tensors are used as they are
+tensors_fresh = os.path.exists(graph_tensors_path) and (
+    not os.path.exists(safe_data_path) or os.path.getmtime(graph_tensors_path) >= os.path.getmtime(safe_data_path)
+)
+if tensors_fresh:
+    data = load_graph_tensors(graph_tensors_path, device)
+else:
+    data = load_safe_data(safe_data_path, device)
+    save_graph_tensors(data, graph_tensors_path)
 meta = load_meta(meta_path)
 num_users = meta["num_customers"]
 num_items = meta["num_articles"]
@@ -246,36 +330,49 @@ embed_dim = 64
 num_layers = 3
 model = load_trained_model(model_path, num_users, num_items, embed_dim, num_layers, model_type, device)
 
-# --- Step 2: Get Raw Recommendations for 1 User ---
-user_id = list(meta["customer_id_map"].keys())[0]  # Selecting the first user
-print(f"\nGenerating raw recommendations for user: {user_id}")
-raw_recs = get_recommendations(model, data, meta, user_id, top_k=10)
-print("Raw Article IDs recommended:", raw_recs)
+# --- Step 2: Get Raw Recommendations for a Batch of Users ---
+num_target_users = 4  # Adjust as needed
+user_ids = list(meta["customer_id_map"].keys())[:num_target_users]  # Selecting the first users
+print(f"\nGenerating raw recommendations for users: {user_ids}")
+# One score GEMM and one topk for all users instead of a get_recommendations call per user
+recs_by_user = get_recommendations_batched(model, data, meta, user_ids, top_k=10)
+for user_id, raw_recs in recs_by_user.items():
+    print(f"Raw Article IDs recommended for {user_id}:", raw_recs)
 
 # --- Step 3: Mapping Function to Enrich Raw Recommendations ---
 articles_csv_path = "./data/filtered_articles.csv"  # Adjust path as needed
 articles_df = pd.read_csv(articles_csv_path)
 
-def enrich_product_description(article_id, articles_df):
-    row = articles_df[articles_df["article_id"] == article_id]
-    if row.empty:
+# Index the article details by ID once, so each lookup is a dict access instead of a scan
+description_cols = [col for col in ["prod_name", "product_type_name", "product_group_name",
+                                    "colour_group_name", "detail_desc"] if col in articles_df.columns]
+articles_lookup = articles_df.drop_duplicates("article_id").set_index("article_id")[description_cols].to_dict("index")
+
+def enrich_product_description(article_id, articles_lookup):
+    row = articles_lookup.get(article_id)
+    if row is None:
         return f"Product with ID {article_id} (details not found)."
-    row = row.iloc[0]
     description = f"{row['prod_name']} – a {row['product_type_name']} from {row['product_group_name']} in {row['colour_group_name']}. {row.get('detail_desc', '')}"
     return description
 
-enriched_products = [enrich_product_description(aid, articles_df) for aid in raw_recs]
-print("\nEnriched Product Descriptions:")
-for i, desc in enumerate(enriched_products, 1):
-    print(f"{i}. {desc}")
-
-# --- Step 4: Construct a Revised Natural Language Prompt for the LLM ---
-prompt = (
-    "Below are candidate products recommended by our graph-based model. Please reformat and rewrite this information into a clear, numbered list of product recommendations. For each item, write a concise pointer that includes the product name and a brief summary of its key features. Do not include product IDs or bullet points beyond a simple numbered list.\n\n"
-    "Candidate Products:\n" +
-    "\n".join([f"{i}. {desc}" for i, desc in enumerate(enriched_products, 1)]) +
-    "\n\nPlease provide your recommendation as a numbered list."
-)
+enriched_by_user = {user_id: [enrich_product_description(aid, articles_lookup) for aid in raw_recs]
+                    for user_id, raw_recs in recs_by_user.items()}
+for user_id, enriched_products in enriched_by_user.items():
+    print(f"\nEnriched Product Descriptions for {user_id}:")
+    for i, desc in enumerate(enriched_products, 1):
+        print(f"{i}. {desc}")
+
+# --- Step 4: Construct a Revised Natural Language Prompt for the LLM (one per user) ---
+prompts = {
+    user_id: (
+        "Below are candidate products recommended by our graph-based model. Please reformat and rewrite this information into a clear, numbered list of product recommendations. For each item, write a concise pointer that includes the product name and a brief summary of its key features. Do not include product IDs or bullet points beyond a simple numbered list.\n\n"
+        "Candidate Products:\n" +
+        "\n".join([f"{i}. {desc}" for i, desc in enumerate(enriched_products, 1)]) +
+        "\n\nPlease provide your recommendation as a numbered list."
+    )
+    for user_id, enriched_products in enriched_by_user.items()
+}
+prompt = prompts[user_ids[0]]
 print("\nConstructed LLM Prompt:\n", prompt)
 
 
@@ -297,26 +394,43 @@ print("\nConstructed LLM Prompt:\n", prompt)
 
 
 # %%
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+import copy
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
 import torch
 
-model_name = "unsloth/Llama-3.2-1B-Instruct"
+try:
+    from vllm import LLM, SamplingParams
+    _VLLM_AVAILABLE = True
+except ImportError:
+    _VLLM_AVAILABLE = False
 
-# Load tokenizer & model
-tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
-device = 0 if torch.cuda.is_available() else -1
-
-# Create a text-generation pipeline from the loaded model
-pipe = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    device=device
-)
+model_name = "unsloth/Llama-3.2-1B-Instruct"
 
-# Example prompt
-prompt = (
+# vLLM (continuous batching, paged KV cache) serves the rewrites when installed on a GPU
+# machine; otherwise the Hugging Face model generates them in padded batches
+use_vllm = _VLLM_AVAILABLE and torch.cuda.is_available()
+if use_vllm:
+    # Leave some GPU memory to the GNN model loaded above
+    # Prefix caching reuses the KV cache of the shared instruction preamble across prompts
+    llm = LLM(model=model_name, dtype="bfloat16", gpu_memory_utilization=0.8, max_model_len=2048,
+              enable_prefix_caching=True)
+    sampling_params = SamplingParams(top_p=0.95, temperature=0.7, max_tokens=300)
+else:
+    # Load tokenizer & model
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, use_fast=True)
+    # Batched generation with a decoder-only model pads on the left, so every prompt ends
+    # right where generation starts
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, trust_remote_code=True, attn_implementation="sdpa",
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32
+    ).to("cuda" if torch.cuda.is_available() else "cpu")
+
+# Rewrite prompts: a static instruction/few-shot preamble shared by every user, followed by
+# each user's candidate products
+prompt_prefix = (
 """
 You are an expert product recommender. Your task is to rewrite a list of candidate product details into a concise, friendly, numbered list of recommendations. Do not copy the input verbatim; instead, use your own words to summarize each product's key features. Ensure that all products are rewritten in the same structured format.
 
@@ -338,25 +452,69 @@ Rewritten: "3. **Running Shoes** - Designed for comfort and performance, these l
 
 ### **Now, rewrite the following candidate products in the same structured format:**
 
-Candidate Products:
-1. NT Alva 2-pack(1) – a Vest top from Garment Upper body in White. Soft nursing tops in organic cotton jersey with narrow adjustable shoulder straps. Soft integral top with an elasticated hem and functional fastening for easier nursing access.
-2. Cat Tee. – a T-shirt from Garment Upper body in White. T-shirt in soft jersey.
-3. Cat Tee. – a T-shirt from Garment Upper body in Grey. T-shirt in soft jersey.
-4. Cat Tee. – a T-shirt from Garment Upper body in Pink. T-shirt in soft jersey.
-5. Cassia crew – a Sweater from Garment Upper body in Green. Long-sleeved top in soft sweatshirt fabric made from a cotton blend with a round neckline, low dropped shoulders and ribbing around the neckline, cuffs and hem.
-6. Becka hoodie – a Hoodie from Garment Upper body in Grey. Long-sleeved top in soft sweatshirt fabric with a jersey-lined, drawstring hood, kangaroo pocket and ribbing at the cuffs and hem. Soft brushed inside.
-7. Penny Wide Culotte – a Trousers from Garment Lower body in Black. 3/4-length trousers in woven fabric with a high, elasticated waist, concealed pockets in the side seams, fake welt back pockets and straight, wide legs.
-8. Seamless cheeky brief – an Underwear bottom from Underwear in Black. Briefs in microfibre with a high waist, lined gusset and cutaway coverage at the back. Designed with minimal seams for comfort.
-9. Babe LS – a T-shirt from Garment Upper body in Black. Long top in ribbed jersey made from a viscose blend with a wide neckline and long sleeves. Straight cut with high slits in the sides and a rounded hem.
-10. Bangkok V-neck sweater – a Sweater from Garment Upper body in Grey. Jumper in a soft, fine-knit viscose blend with a deep V-neck, long sleeves and ribbing around the neckline, cuffs and hem.
-
-**Now rewrite these in the same structured format as the examples above. Ensure all descriptions are short, engaging, and highlight key product features concisely.**
-
 """
 )
+rewrite_prompts = {
+    user_id: prompt_prefix + (
+        "Candidate Products:\n" +
+        "\n".join([f"{i}. {desc}" for i, desc in enumerate(enriched_products, 1)]) +
+        "\n\n**Now rewrite these in the same structured format as the examples above. Ensure all descriptions are short, engaging, and highlight key product features concisely.**\n\n"
+    )
+    for user_id, enriched_products in enriched_by_user.items()
+}
+
+def prefix_cache(prefix):
+    """Run the forward pass over a shared prompt prefix once and return its token IDs and KV cache."""
+    prefix_inputs = tokenizer(prefix, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        cache = model(**prefix_inputs, past_key_values=DynamicCache(), use_cache=True).past_key_values
+    return prefix_inputs["input_ids"], cache
 
-output = pipe(prompt, max_new_tokens=300, do_sample=True, top_p=0.95, temperature=0.7)
-print("Generated text:\n", output[0]["generated_text"])
+def rewrite_recommendations(prompts, batch_size=8, prefix=None):
+    """
+    Generate rewrites for a list of prompts (e.g. one per user), each returned with its prompt.
+    
+    vLLM schedules all prompts itself and caches shared prefixes automatically. With the
+    Hugging Face model, prompts that all start with prefix are generated one at a time from
+    a copy of the prefix's KV cache, so only their own tokens are prefilled; otherwise
+    batch_size prompts are tokenized in one call and generated in one decoder pass.
+    """
+    if use_vllm:
+        outputs = llm.generate(prompts, sampling_params)
+        return [prompt + output.outputs[0].text for prompt, output in zip(prompts, outputs)]
+    if prefix is not None and all(prompt.startswith(prefix) for prompt in prompts):
+        prefix_ids, cache = prefix_cache(prefix)
+        rewrites = []
+        for prompt in prompts:
+            # Tokenizing the whole prompt could merge tokens across the prefix boundary, so
+            # only the suffix is tokenized and appended to the cached prefix's token IDs
+            suffix_ids = tokenizer(prompt[len(prefix):], add_special_tokens=False,
+                                   return_tensors="pt")["input_ids"].to(model.device)
+            input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+            # generate extends the cache in place, so every prompt starts from a fresh copy
+            output_ids = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                        past_key_values=copy.deepcopy(cache), max_new_tokens=300,
+                                        do_sample=True, top_p=0.95, temperature=0.7,
+                                        pad_token_id=tokenizer.pad_token_id)
+            rewrites.append(prompt + tokenizer.decode(output_ids[0, input_ids.shape[1]:],
+                                                      skip_special_tokens=True))
+        return rewrites
+    rewrites = []
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        inputs = tokenizer(batch, padding=True, return_tensors="pt").to(model.device)
+        output_ids = model.generate(**inputs, max_new_tokens=300, do_sample=True, top_p=0.95, temperature=0.7,
+                                    pad_token_id=tokenizer.pad_token_id)
+        # Left padding lines every prompt up to the same length, so the new tokens start there
+        completions = tokenizer.batch_decode(output_ids[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+        rewrites.extend(prompt + completion for prompt, completion in zip(batch, completions))
+    return rewrites
+
+# One rewrite per target user, generated together
+# The users' prompts share prompt_prefix, so its KV cache is computed once and reused for each
+generated = rewrite_recommendations([rewrite_prompts[user_id] for user_id in user_ids], prefix=prompt_prefix)
+for user_id, text in zip(user_ids, generated):
+    print(f"Generated text for {user_id}:\n", text)
 
 
 # %%
@@ -119,11 +119,13 @@ def calculate_time_decay_weights(dates: pd.Series,
     if not pd.api.types.is_datetime64_dtype(dates):
         dates = pd.to_datetime(dates)
     
-    # Extract date component
-    date_vals = dates.dt.date
+    # Work on wall-clock dates for tz-aware series, matching the local date component
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
     
-    # Calculate days difference
-    days_diff = np.array([(reference_date - d).days for d in date_vals])
+    # Calculate days difference with datetime64[D] arithmetic
+    ref = np.datetime64(reference_date, 'D')
+    days_diff = (ref - dates.to_numpy().astype('datetime64[D]')).astype(np.int64)
     
     # Apply exponential decay
     weights = np.exp(-decay_rate * days_diff)
@@ -245,11 +247,10 @@ def clean_and_validate_data(df: pd.DataFrame,
             if col in df.columns:
                 df[col] = pd.to_datetime(df[col], errors='coerce')
     
-    # Remove duplicate rows
-    df = df.drop_duplicates()
-    
-    # Handle missing values (for demonstration, just drop rows with NA in any column)
-    df = df.dropna()
+    # Remove duplicate rows and handle missing values (for demonstration, just drop rows
+    # with NA in any column) with a single combined row mask
+    mask = ~df.duplicated(keep='first').to_numpy() & df.notna().all(axis=1).to_numpy()
+    df = df.loc[mask]
     
     return df
 
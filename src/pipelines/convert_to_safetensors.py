@@ -0,0 +1,56 @@
+"""
+convert_to_safetensors.py
+
+One-shot migration of the inference inputs to safetensors:
+- the trained model's state dict (<model>.pth -> <model>.safetensors)
+- the graph tensors of the dill-pickled safe data (lightgcn_data_safe.pt -> lightgcn_data_safe.safetensors)
+
+The inference scripts load the .safetensors files when they exist next to the originals.
+"""
+
+import os
+import argparse
+import torch
+import dill
+import torch_geometric.data.data as tg_data
+from torch.serialization import safe_globals
+from safetensors.torch import save_file
+
+# Define dummy DataEdgeAttr if not present
+if not hasattr(tg_data, "DataEdgeAttr"):
+    class DummyDataEdgeAttr:
+        pass
+    tg_data.DataEdgeAttr = DummyDataEdgeAttr
+
+def convert_model(model_path):
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True)
+    # safetensors stores each tensor as its own contiguous buffer
+    tensors = {name: tensor.contiguous() for name, tensor in state_dict.items()}
+    output_path = os.path.splitext(model_path)[0] + ".safetensors"
+    save_file(tensors, output_path)
+    print(f"Saved model weights to {output_path}")
+
+def convert_graph_data(data_path):
+    with safe_globals([tg_data.DataEdgeAttr]):
+        data = torch.load(data_path, map_location="cpu", pickle_module=dill, weights_only=False)
+    tensors = {
+        "edge_index": data.edge_index.contiguous(),
+        "edge_attr": torch.as_tensor(data.edge_attr, dtype=torch.float).contiguous(),
+    }
+    output_path = os.path.splitext(data_path)[0] + ".safetensors"
+    save_file(tensors, output_path)
+    print(f"Saved graph tensors to {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert model weights and graph data to safetensors")
+    parser.add_argument("--model_path", type=str, default="./graph_rec/output/standard_lightgcN_best.pth",
+                        help="Trained model state dict (.pth)")
+    parser.add_argument("--data_path", type=str, default="./data/processed/lightgcn_data_safe.pt",
+                        help="Safe processed graph data (.pt)")
+    args = parser.parse_args()
+    
+    convert_model(args.model_path)
+    convert_graph_data(args.data_path)
+
+if __name__ == "__main__":
+    main()
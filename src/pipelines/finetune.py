@@ -1,6 +1,26 @@
+"""
+finetune.py
+
+Supervised fine-tuning on the SFT data, followed by a generation test of the saved model.
+
+Runs on every local GPU (DistributedDataParallel through the Trainer) when launched with
+accelerate or torchrun:
+    accelerate launch --config_file src/pipelines/accelerate_config.yaml src/pipelines/finetune.py
+    torchrun --nproc_per_node=N src/pipelines/finetune.py
+"""
+
+import os
 import json
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments, DataCollatorForLanguageModeling
+
+# Unsloth patches transformers on import, so it is imported first
+try:
+    from unsloth import FastLanguageModel
+    _UNSLOTH_AVAILABLE = True
+except ImportError:
+    _UNSLOTH_AVAILABLE = False
+
+from transformers import AutoTokenizer, AutoModelForCausalLM, Trainer, TrainingArguments, DataCollatorForSeq2Seq
 from datasets import Dataset
 
 def run_finetuning():
@@ -33,31 +53,64 @@ def run_finetuning():
 
     # ----- Step 3: Prepare the Model and Tokenizer for Fine-Tuning -----
     model_name = "unsloth/Llama-3.2-1B-Instruct"
-    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
+    # LoRA on a 4-bit base through Unsloth's fused kernels when it is installed (CUDA only),
+    # otherwise full fine-tuning
+    # Unsloth places the model on the first GPU itself, so it is only used single-process
+    distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+    use_lora = _UNSLOTH_AVAILABLE and torch.cuda.is_available() and not distributed
+    if use_lora:
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name, max_seq_length=1024, dtype=None, load_in_4bit=True
+        )
+        model = FastLanguageModel.get_peft_model(
+            model, r=16, lora_alpha=16, target_modules=["q_proj", "k_proj", "v_proj", "o_proj"]
+        )
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
 
     # ----- Step 4: Tokenization Function -----
     # We combine the input and output using a clear delimiter for training.
     def tokenize_record(record):
         # We use "\n\n### Response:\n" as a delimiter between input and expected output.
-        full_text = record["input"] + "\n\n### Response:\n" + record["output"]
-        return tokenizer(full_text, truncation=True, max_length=1024)
+        # Labels are -100 over the input and delimiter, so the loss covers only the response.
+        prompt_ids = tokenizer(record["input"] + "\n\n### Response:\n")["input_ids"]
+        response_ids = tokenizer(record["output"], add_special_tokens=False)["input_ids"]
+        input_ids = (prompt_ids + response_ids)[:1024]
+        labels = ([-100] * len(prompt_ids) + response_ids)[:1024]
+        return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "labels": labels}
 
     tokenized_dataset = sft_dataset.map(tokenize_record, batched=False, remove_columns=["input", "output"])
 
     # ----- Step 5: Set Up Data Collator -----
-    data_collator = DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False)
+    # Pads input_ids with the pad token and the prompt-masked labels with -100
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, pad_to_multiple_of=8, label_pad_token_id=-100)
 
     # ----- Step 6: Define Training Arguments -----
+    use_bf16 = torch.cuda.is_available() and torch.cuda.is_bf16_supported()
     training_args = TrainingArguments(
         output_dir="./finetuned_model",
         overwrite_output_dir=True,
         num_train_epochs=3,                   # Adjust as needed
-        per_device_train_batch_size=1,        # For a single example fine-tuning, batch size 1 is sufficient
+        per_device_train_batch_size=8,        # Sized for a multi-example SFT set; a single example still runs
+        gradient_accumulation_steps=4,        # Effective batch of 32 per device
         save_steps=10,
         save_total_limit=2,
         prediction_loss_only=True,
-        fp16=True,                            # Enable FP16 if your GPU supports it
+        bf16=use_bf16,                        # bf16 where supported, else FP16 on the GPU
+        fp16=torch.cuda.is_available() and not use_bf16,
+        # Recompute activations in backward to fit the larger batch (Unsloth's LoRA model
+        # already checkpoints with its own kernels)
+        gradient_checkpointing=not use_lora,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        optim="adamw_torch_fused" if torch.cuda.is_available() else "adamw_torch",
+        dataloader_num_workers=4,
+        dataloader_pin_memory=True,
+        # Under accelerate/torchrun every parameter gets a gradient, so DDP can skip the
+        # unused-parameter search
+        ddp_find_unused_parameters=False,
     )
 
     # ----- Step 7: Initialize the Trainer and Fine-Tune -----
@@ -73,21 +126,33 @@ def run_finetuning():
     trainer.train()
 
     # ----- Step 8: Save the Fine-Tuned Model -----
-    model.save_pretrained("./finetuned_model")
-    tokenizer.save_pretrained("./finetuned_model")
+    if use_lora:
+        # Merge the adapters into 16-bit weights so the directory loads as a plain model
+        model.save_pretrained_merged("./finetuned_model", tokenizer, save_method="merged_16bit")
+    else:
+        # Writes from the main process only (and unwraps DDP)
+        trainer.save_model("./finetuned_model")
+    # The remaining ranks are done; only the main process tests the saved model
+    if not trainer.is_world_process_zero():
+        return
     print("\nFine-tuning complete. Model saved to ./finetuned_model")
 
     # ----- Testing the saved model -----
-    from transformers import pipeline
-    import torch
     # Load the fine-tuned model and tokenizer from the saved directory
     model_dir = "./finetuned_model"
-    model_ft = AutoModelForCausalLM.from_pretrained(model_dir, trust_remote_code=True)
-    tokenizer_ft = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True)
-    # Set device for inference (0 for CUDA if available, else -1 for CPU)
-    device_ft = 0 if torch.cuda.is_available() else -1
-    # Create a text-generation pipeline for the fine-tuned model
-    ft_pipe = pipeline("text-generation", model=model_ft, tokenizer=tokenizer_ft, device=device_ft)
+    # bf16 weights placed directly on the GPU by accelerate (fp32 on CPU), and fused
+    # scaled_dot_product_attention kernels for generation
+    if torch.cuda.is_available():
+        model_ft = AutoModelForCausalLM.from_pretrained(
+            model_dir, trust_remote_code=True, attn_implementation="sdpa",
+            torch_dtype=torch.bfloat16, device_map="auto"
+        )
+        # Static KV cache + compiled forward: the decode step is replayed as a CUDA graph
+        model_ft.generation_config.cache_implementation = "static"
+        model_ft.forward = torch.compile(model_ft.forward, mode="reduce-overhead", fullgraph=True)
+    else:
+        model_ft = AutoModelForCausalLM.from_pretrained(model_dir, trust_remote_code=True, attn_implementation="sdpa")
+    tokenizer_ft = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True, use_fast=True)
     # Construct a sample prompt in the same format as used for SFT dataset creation
     sample_prompt = (
         "Customer Profile:\nAge: 35, Membership: ACTIVE\n\n"
@@ -99,9 +164,12 @@ def run_finetuning():
         "### Response:"
     )
     # Generate recommendations using the fine-tuned model
-    ft_output = ft_pipe(sample_prompt, max_new_tokens=150, do_sample=True, top_p=0.95, temperature=0.7)
+    inputs = tokenizer_ft(sample_prompt, return_tensors="pt").to(model_ft.device)
+    with torch.inference_mode():
+        output_ids = model_ft.generate(**inputs, max_new_tokens=150, do_sample=True, top_p=0.95, temperature=0.7,
+                                       use_cache=True, pad_token_id=tokenizer_ft.eos_token_id)
     # Extract and print the output after the delimiter
-    generated_text = ft_output[0]["generated_text"]
+    generated_text = tokenizer_ft.decode(output_ids[0], skip_special_tokens=True)
     if "### Response:" in generated_text:
         final_output = generated_text.split("### Response:")[-1].strip()
     else:
@@ -1,11 +1,23 @@
 import os
+import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.nn.functional as F
 import pickle
 import pandas as pd
 import dill
 import torch_geometric.data.data as tg_data
 from torch.serialization import safe_globals
-from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+from safetensors.torch import load_file
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# Columns of the articles CSV the product descriptions are built from
+ARTICLE_COLUMNS = ["article_id", "prod_name", "product_type_name", "product_group_name", "colour_group_name", "detail_desc"]
+
+# A line break (any str.splitlines() separator) with the whitespace around it: collapsing
+# these to "\n" strips every line and drops blank lines in one pass
+_LINE_BREAK = re.compile(r"\s*[\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]\s*")
 
 # --- Ensure DataEdgeAttr is defined (dummy if not present) ---
 if not hasattr(tg_data, "DataEdgeAttr"):
@@ -14,15 +26,37 @@ if not hasattr(tg_data, "DataEdgeAttr"):
     tg_data.DataEdgeAttr = DummyDataEdgeAttr
     print("Defined dummy DataEdgeAttr.")
 
+def to_device(tensor, device):
+    # Host-to-GPU copies from pinned memory run as async DMA on the current stream
+    if torch.device(device).type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
 def load_safe_data(data_path, device):
     print(f"Loading safe data from: {data_path}")
     with safe_globals([tg_data.DataEdgeAttr]):
-        data = torch.load(data_path, map_location=device, pickle_module=dill, weights_only=False)
+        data = torch.load(data_path, map_location="cpu", pickle_module=dill, weights_only=False)
+    # Place the graph tensors on the device once here, not on every recommendation call
+    data.edge_index = to_device(data.edge_index, device)
+    data.edge_attr = to_device(torch.as_tensor(data.edge_attr), device)
     return data
 
+def load_graph_data(data_path, device):
+    # Prefer the safetensors copy of the graph tensors (see convert_to_safetensors.py):
+    # memory-mapped and loaded without unpickling, so no dill or DataEdgeAttr needed
+    tensors_path = os.path.splitext(data_path)[0] + ".safetensors"
+    if not os.path.exists(tensors_path):
+        return load_safe_data(data_path, device)
+    print(f"Loading graph tensors from: {tensors_path}")
+    tensors = load_file(tensors_path)
+    return tg_data.Data(edge_index=to_device(tensors["edge_index"], device),
+                        edge_attr=to_device(tensors["edge_attr"], device))
+
 def load_meta(meta_path):
     with open(meta_path, "rb") as f:
         meta = pickle.load(f)
+    # Item index -> article ID, built once for all recommendation calls
+    meta["reverse_article_map"] = {v: k for k, v in meta["article_id_map"].items()}
     return meta
 
 def load_trained_model(model_path, num_users, num_items, embed_dim, num_layers, model_type, device):
@@ -31,40 +65,142 @@ def load_trained_model(model_path, num_users, num_items, embed_dim, num_layers,
         model = EnhancedLightGCN(num_users, num_items, embed_dim=embed_dim, num_layers=num_layers).to(device)
     else:
         model = LightGCN(num_users, num_items, embed_dim=embed_dim, num_layers=num_layers).to(device)
-    print(f"Loading model from {model_path}")
-    state_dict = torch.load(model_path, map_location=device)
+    # Prefer a safetensors copy of the weights next to the checkpoint (see convert_to_safetensors.py)
+    weights_path = os.path.splitext(model_path)[0] + ".safetensors"
+    if os.path.exists(weights_path):
+        print(f"Loading model from {weights_path}")
+        state_dict = load_file(weights_path, device=str(device))
+    else:
+        print(f"Loading model from {model_path}")
+        state_dict = torch.load(model_path, map_location=device, weights_only=True)
     model.load_state_dict(state_dict)
     model.eval()
     return model
 
-def get_recommendations(model, data, meta, user_id, top_k=10):
-    device = next(model.parameters()).device
-    if user_id not in meta["customer_id_map"]:
-        print(f"User ID {user_id} not found in meta.")
-        return []
-    u_idx = meta["customer_id_map"][user_id]
-    num_users = meta["num_customers"]
-    
+# Warm-state getters: a long-running process importing this module (e.g. a server)
+# loads each input once and reuses it across calls; a one-shot run behaves as before
+@functools.lru_cache(maxsize=1)
+def get_meta(meta_path):
+    return load_meta(meta_path)
+
+@functools.lru_cache(maxsize=1)
+def get_graph_data(data_path, device):
+    return load_graph_data(data_path, device)
+
+@functools.lru_cache(maxsize=1)
+def get_gnn(model_path, num_users, num_items, embed_dim, num_layers, model_type, device):
+    return load_trained_model(model_path, num_users, num_items, embed_dim, num_layers, model_type, device)
+
+def get_embeddings(model, data):
+    # Weights and graph are fixed at inference time, so propagate once per model; the
+    # loaders above already placed the graph on the model's device
+    if getattr(model, "_cached_emb", None) is None:
+        with torch.no_grad():
+            model._cached_emb = model(data.edge_index, data.edge_attr)
+    return model._cached_emb
+
+def embeddings_path_for(model_path):
+    # Written by precompute_embeddings.py next to the checkpoint it was computed from
+    return os.path.splitext(model_path)[0] + "_embeddings.safetensors"
+
+def has_fresh_embeddings(model_path):
+    embeddings_path = embeddings_path_for(model_path)
+    if not os.path.exists(embeddings_path):
+        return False
+    return not os.path.exists(model_path) or os.path.getmtime(embeddings_path) >= os.path.getmtime(model_path)
+
+@functools.lru_cache(maxsize=None)
+def load_embeddings(embeddings_path, device):
+    print(f"Loading precomputed embeddings from {embeddings_path}")
+    return load_file(embeddings_path, device=device)["embeddings"]
+
+@functools.lru_cache(maxsize=1)
+def get_item_embeddings(embeddings, num_users):
+    # Item rows as one contiguous matrix, built once per embeddings tensor; bf16 on CUDA
+    # halves the memory read by every (memory-bound) scoring matmul
+    item_embeddings = embeddings[num_users:].contiguous()
+    if item_embeddings.device.type == "cuda":
+        item_embeddings = item_embeddings.to(torch.bfloat16)
+    return item_embeddings
+
+def score_users(embeddings, user_idxs, num_users):
+    # Scores of a batch of users against all items with one GEMM: (B, num_items)
+    item_embeddings = get_item_embeddings(embeddings, num_users)
+    return F.linear(embeddings[user_idxs].to(item_embeddings.dtype), item_embeddings)
+
+def get_recommendations_batch(model, data, meta, user_ids, top_k=10, embeddings=None):
+    """Top-k article IDs for several users with one GEMM and one topk ([] for unknown users)."""
+    recommendations = {user_id: [] for user_id in user_ids}
+    known = [user_id for user_id in user_ids if user_id in meta["customer_id_map"]]
+    for user_id in user_ids:
+        if user_id not in meta["customer_id_map"]:
+            print(f"User ID {user_id} not found in meta.")
+    if not known:
+        return recommendations
+    if embeddings is None:
+        embeddings = get_embeddings(model, data)
+    user_idxs = torch.as_tensor([meta["customer_id_map"][user_id] for user_id in known], device=embeddings.device)
     with torch.no_grad():
-        embeddings = model(data.edge_index.to(device), data.edge_attr.to(device))
-    
-    user_embedding = embeddings[u_idx].unsqueeze(0)
-    item_embeddings = embeddings[num_users:]
-    scores = torch.matmul(user_embedding, item_embeddings.t()).squeeze(0)
-    _, topk_indices = torch.topk(scores, top_k)
-    topk_indices = topk_indices.cpu().tolist()
-    
-    reverse_article_map = {v: k for k, v in meta["article_id_map"].items()}
-    recommendations = [reverse_article_map.get(i, f"Unknown({i})") for i in topk_indices]
+        scores = score_users(embeddings, user_idxs, meta["num_customers"])
+        topk_indices = torch.topk(scores, top_k, dim=1).indices.cpu().tolist()
+    reverse_article_map = meta["reverse_article_map"]
+    for user_id, indices in zip(known, topk_indices):
+        recommendations[user_id] = [reverse_article_map.get(i, f"Unknown({i})") for i in indices]
     return recommendations
 
-def enrich_product_description(article_id, articles_df):
-    row = articles_df[articles_df["article_id"] == article_id]
-    if row.empty:
-        return f"Product with ID {article_id} (details not found)."
-    row = row.iloc[0]
-    description = f"{row['prod_name']} – a {row['product_type_name']} from {row['product_group_name']} in {row['colour_group_name']}. {row.get('detail_desc', '')}"
-    return description
+def get_recommendations(model, data, meta, user_id, top_k=10, embeddings=None):
+    return get_recommendations_batch(model, data, meta, [user_id], top_k=top_k, embeddings=embeddings)[user_id]
+
+def enrich_product_descriptions(article_ids, articles_by_id):
+    # One reindex on the article_id index and column-wise string concatenation for all IDs
+    rows = articles_by_id.reindex(article_ids)
+    descriptions = (
+        rows["prod_name"].astype(str) + " – a " + rows["product_type_name"].astype(str) +
+        " from " + rows["product_group_name"].astype(str) + " in " + rows["colour_group_name"].astype(str) +
+        ". " + rows["detail_desc"].fillna("").astype(str)
+    ).to_numpy(dtype=object)
+    missing = rows["prod_name"].isna().to_numpy()
+    descriptions[missing] = [f"Product with ID {aid} (details not found)." for aid, m in zip(article_ids, missing) if m]
+    return descriptions.tolist()
+
+def compile_for_generation(model):
+    # Static KV cache gives the decode step fixed shapes, so the compiled forward can be
+    # captured once as a CUDA graph and replayed for every generated token
+    model.generation_config.cache_implementation = "static"
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+    return model
+
+def load_llm(model_name, load_in_8bit=False, compile=False):
+    # bf16 (or int8) weights placed directly on the GPU by accelerate, and fused
+    # scaled_dot_product_attention kernels for generation
+    kwargs = {"trust_remote_code": True, "attn_implementation": "sdpa"}
+    if torch.cuda.is_available():
+        kwargs["device_map"] = "auto"
+        kwargs["torch_dtype"] = torch.bfloat16
+        if load_in_8bit:
+            from transformers import BitsAndBytesConfig
+            kwargs["quantization_config"] = BitsAndBytesConfig(load_in_8bit=True)
+    model = AutoModelForCausalLM.from_pretrained(model_name, **kwargs)
+    model.eval()
+    # CUDA graphs only pay off on the GPU; bitsandbytes int8 layers do not compile
+    if compile and torch.cuda.is_available() and not load_in_8bit:
+        model = compile_for_generation(model)
+    return model
+
+@functools.lru_cache(maxsize=1)
+def get_articles(articles_csv_path):
+    # Multithreaded Arrow CSV parsing, reading only the columns used in the descriptions
+    articles_df = pd.read_csv(articles_csv_path, engine="pyarrow", usecols=ARTICLE_COLUMNS)
+    return articles_df.drop_duplicates("article_id").set_index("article_id")
+
+@functools.lru_cache(maxsize=1)
+def get_llm(model_name, load_in_8bit=False, compile=False):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True, use_fast=True)
+    return tokenizer, load_llm(model_name, load_in_8bit=load_in_8bit, compile=compile)
+
+# Background threads for the disk-bound loading (CSV parsing, LLM weights), created once
+# so a long-running process reuses them across calls
+_IO_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="inference-io")
 
 def inference_pipeline():
     # ----- Parameters and File Paths -----
@@ -73,34 +209,45 @@ def inference_pipeline():
     safe_data_path = os.path.join(data_dir, "lightgcn_data_safe.pt")
     meta_path = os.path.join(data_dir, "lightgcn_meta.pkl")
     model_file = "standard_lightgcN_best.pth"  # Adjust as needed
+    articles_csv_path = "./data/filtered_articles.csv"  # Adjust path as needed
+    model_name = "unsloth/Llama-3.2-1B-Instruct"
+    load_in_8bit = False  # int8 weights via bitsandbytes (CUDA only)
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
-    # Load safe processed graph data and metadata
-    data = load_safe_data(safe_data_path, device)
-    meta = load_meta(meta_path)
+    # Read the articles CSV and load the LLM in the background while the GNN recommends
+    articles_future = _IO_POOL.submit(get_articles, articles_csv_path)
+    llm_future = _IO_POOL.submit(get_llm, model_name, load_in_8bit, True)
+
+    meta = get_meta(meta_path)
     num_users = meta["num_customers"]
     num_items = meta["num_articles"]
 
-    # Load the trained GNN model
     model_path = os.path.join(model_dir, model_file)
-    model_type = "standard"  # or "enhanced"
-    embed_dim = 64
-    num_layers = 3
-    model = load_trained_model(model_path, num_users, num_items, embed_dim, num_layers, model_type, device)
+    if has_fresh_embeddings(model_path):
+        # Embeddings precomputed by precompute_embeddings.py: no graph, no model, no forward pass
+        data, model = None, None
+        embeddings = load_embeddings(embeddings_path_for(model_path), str(device))
+    else:
+        # Load safe processed graph data and the trained GNN model
+        data = get_graph_data(safe_data_path, device)
+        model_type = "standard"  # or "enhanced"
+        embed_dim = 64
+        num_layers = 3
+        model = get_gnn(model_path, num_users, num_items, embed_dim, num_layers, model_type, device)
+        embeddings = get_embeddings(model, data)
 
     # --- Generate Recommendations for 1 User ---
     user_id = list(meta["customer_id_map"].keys())[0]  # Selecting the first user
     print(f"\nGenerating raw recommendations for user: {user_id}")
-    raw_recs = get_recommendations(model, data, meta, user_id, top_k=10)
+    raw_recs = get_recommendations(model, data, meta, user_id, top_k=10, embeddings=embeddings)
     print("Raw Article IDs recommended:", raw_recs)
 
     # --- Enrich Recommendations ---
-    articles_csv_path = "./data/filtered_articles.csv"  # Adjust path as needed
-    articles_df = pd.read_csv(articles_csv_path)
+    articles_by_id = articles_future.result()
 
-    enriched_products = [enrich_product_description(aid, articles_df) for aid in raw_recs]
+    enriched_products = enrich_product_descriptions(raw_recs, articles_by_id)
     print("\nEnriched Product Descriptions:")
     for i, desc in enumerate(enriched_products, 1):
         print(f"{i}. {desc}")
@@ -115,14 +262,14 @@ def inference_pipeline():
     print("\nConstructed LLM Prompt:\n", prompt)
 
     # --- LLM Paraphrasing ---
-    model_name = "unsloth/Llama-3.2-1B-Instruct"
-    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-    model_llm = AutoModelForCausalLM.from_pretrained(model_name, trust_remote_code=True)
-    device_llm = 0 if torch.cuda.is_available() else -1
-    llm_pipe = pipeline("text-generation", model=model_llm, tokenizer=tokenizer, device=device_llm)
+    tokenizer, model_llm = llm_future.result()
 
-    llm_out = llm_pipe(prompt, max_new_tokens=1500, do_sample=True, top_p=0.95, temperature=0.7)
-    generated_text = llm_out[0]["generated_text"]
+    # Tokenize once and call generate directly (no pipeline pre/post-processing per call)
+    inputs = tokenizer(prompt, return_tensors="pt").to(model_llm.device)
+    with torch.inference_mode():
+        output_ids = model_llm.generate(**inputs, max_new_tokens=1500, do_sample=True, top_p=0.95, temperature=0.7,
+                                        use_cache=True, pad_token_id=tokenizer.eos_token_id)
+    generated_text = tokenizer.decode(output_ids[0], skip_special_tokens=True)
     if "### Response:" in generated_text:
         final_output = generated_text.split("### Response:")[-1].strip()
     else:
@@ -131,8 +278,7 @@ def inference_pipeline():
     print("\nFinal Paraphrased Output from LLM:\n", final_output)
 
     # --- Post-Processing the LLM Output ---
-    final_output_clean = final_output.replace("*", "")
-    final_output_clean = "\n".join([line.strip() for line in final_output_clean.splitlines() if line.strip() != ""])
+    final_output_clean = _LINE_BREAK.sub("\n", final_output.replace("*", "")).strip()
 
     output_file = "data/sft/SFT_data_2.txt"
     with open(output_file, "w") as f:
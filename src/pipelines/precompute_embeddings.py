@@ -0,0 +1,47 @@
+"""
+precompute_embeddings.py
+
+Runs the LightGCN forward pass once and stores the final user/item embeddings
+(<model>_embeddings.safetensors next to the checkpoint). Weights and graph are fixed
+at inference time, so inference.py and golden_gen.py load these instead of the
+model and graph and only do the top-k scoring. Re-run after retraining: the
+pipelines ignore embeddings older than the checkpoint.
+"""
+
+import argparse
+import torch
+from safetensors.torch import save_file
+from inference import load_graph_data, load_meta, load_trained_model, get_embeddings, embeddings_path_for
+
+def precompute_embeddings(model_path, data_path, meta_path, model_type="standard", embed_dim=64, num_layers=3):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using device: {device}")
+
+    data = load_graph_data(data_path, device)
+    meta = load_meta(meta_path)
+    model = load_trained_model(model_path, meta["num_customers"], meta["num_articles"],
+                               embed_dim, num_layers, model_type, device)
+    embeddings = get_embeddings(model, data)
+
+    output_path = embeddings_path_for(model_path)
+    save_file({"embeddings": embeddings.float().cpu().contiguous()}, output_path)
+    print(f"Saved {tuple(embeddings.shape)} embeddings to {output_path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute LightGCN embeddings for inference")
+    parser.add_argument("--model_path", type=str, default="./graph_rec/output/standard_lightgcN_best.pth",
+                        help="Trained model state dict (.pth)")
+    parser.add_argument("--data_path", type=str, default="./data/processed/lightgcn_data_safe.pt",
+                        help="Safe processed graph data (.pt)")
+    parser.add_argument("--meta_path", type=str, default="./data/processed/lightgcn_meta.pkl",
+                        help="Metadata pickle with the id maps")
+    parser.add_argument("--model_type", type=str, default="standard", choices=["standard", "enhanced"])
+    parser.add_argument("--embed_dim", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=3)
+    args = parser.parse_args()
+
+    precompute_embeddings(args.model_path, args.data_path, args.meta_path,
+                          args.model_type, args.embed_dim, args.num_layers)
+
+if __name__ == "__main__":
+    main()